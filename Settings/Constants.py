@@ -16,6 +16,9 @@ subimage_border = 32     # border around subimage to avoid edge effects
 fratio_local = False     # determine fratio (Fn/Fr) from subimage (T) or full frame (F)
 dxdy_local = False       # determine dx and dy from subimage (T) or full frame (F)
 transient_nsigma = 6     # required significance in Scorr for transient detection
+transient_halo = 16      # [pix] halo around the central part of the subimages used
+                         # in the transient detection performed on each subimage;
+                         # cannot be larger than [subimage_border]
 
 # add optional fake stars for testing purposes
 nfakestars = 1           # number of fake stars to be added to each subimage; first star
@@ -37,6 +40,11 @@ bkg_boxsize = 240        # size of region used to determine
                          # background (all methods)
 bkg_filtersize = 5       # size of filter used for smoothing the above
                          # regions (all methods)
+bkg_objmask_inproc = True # if True, the object mask used in method 2 is
+                         # created in-process from a thresholded detection,
+                         # and SExtractor does not save any check-images
+bkg_objmask_nsigma = 1.5 # detection threshold (in sigma) of the above
+bkg_objmask_minarea = 3  # minimum number of connected pixels above threshold
 
 #===============================================================================
 # Header keywords
@@ -63,6 +71,7 @@ pixscale = 0.563
 key_exptime = 'EXPTIME'
 key_filter = 'FILTER'
 key_obsdate = 'DATE-OBS'
+key_fieldid = 'OBJECT'
 
 #===============================================================================
 # initial seeing estimate
@@ -102,6 +111,23 @@ size_vignet_ref = 71     # size of the square VIGNETs saved in the SExtractor
 psf_stars_s2n_min = 20   # minimum signal-to-noise ratio for PSF stars
                          # (don't set this too high as otherwise the PSF
                          #  will be mainly based on bright stars)
+psf_stars_nmax = 20000   # maximum number of PSF stars fed to PSFEx; if there are
+                         # more candidates, they are selected evenly over a grid
+                         # of cells and over flux (0 = no maximum)
+psf_stars_ngrid = 5      # number of grid cells along each image axis used for
+                         # the selection of PSF stars (at most 10)
+psf_vignet_inproc = True # if True, SExtractor does not save the VIGNETs of all
+                         # sources; they are cut out for the PSF stars only
+                         # when the catalog for PSFEx is prepared
+psf_lut_use = True       # use a lookup table of PSF images for the optimal
+                         # photometry, rather than building the PSF for each
+                         # source separately
+psf_lut_npos = 8         # number of field positions along each axis and
+psf_lut_nphase = 16      # number of subpixel phase intervals along each axis
+                         # of the PSF lookup table
+psf_lut_tol = 1e-3       # maximum allowed difference between the lookup table
+                         # and the exact PSF, relative to the PSF peak; if
+                         # exceeded, the exact PSF is used for all sources
                          
 #===============================================================================
 # Astrometry
@@ -109,6 +135,37 @@ psf_stars_s2n_min = 20   # minimum signal-to-noise ratio for PSF stars
 # WCS
 skip_wcs = Talse         # skip Astrometry.net step if image already
                          # contains a reliable WCS solution
+# before running Astrometry.net, check if the WCS already present in
+# the image header is accurate enough by matching the brightest
+# sources to the calibration catalog; if so, Astrometry.net is skipped
+wcs_verify = True
+wcs_verify_dist = 3.     # matching radius [arcsec]
+wcs_verify_minfrac = 0.5 # minimum fraction of bright sources matched
+wcs_verify_maxoff = 0.5  # maximum median offset [arcsec]
+wcs_verify_maxstd = 0.3  # maximum standard deviation of offsets [arcsec]
+# if the existing WCS is not accurate enough, try to refine it by
+# fitting a TPV polynomial of order [astronet_tweak_order] to the
+# calibration stars matched to the brightest sources before running
+# Astrometry.net; the refined WCS is accepted if the standard
+# deviation of the residuals is below [wcs_verify_maxstd]
+wcs_refine = True
+wcs_refine_dist = 10.    # initial matching radius [arcsec]
+wcs_refine_niter = 3     # number of match-and-fit iterations
+wcs_refine_nsigma = 3.   # outlier rejection threshold [sigma]
+# only save the header of the WCS-corrected image, in [base]_wcs.head,
+# instead of writing the full image [base]_wcs.fits; the pixels are
+# then read from the original image
+wcs_header_only = True
+# for large numbers of positions (at least [wcs_interp_nmin]), evaluate
+# the sky to pixel transformation with bicubic splines fitted on a
+# grid with a spacing of [wcs_interp_step] pixels, which is refined
+# until the maximum error is below [wcs_interp_tol] pixels
+wcs_interp = True
+wcs_interp_nmin = 10000
+wcs_interp_step = 64
+wcs_interp_tol = 0.001
+# number of WCS transformations kept in memory
+wcs_cache_size = 8
 # Astrometry.net's tweak order
 astronet_tweak_order = 3
 # only search in Astrometry.net index files within this radius of the
@@ -116,8 +173,26 @@ astronet_tweak_order = 3
 astronet_radius = 1.5
 pixscale_varyfrac = 0.02 # pixscale solution found by Astrometry.net will
                          # be within this fraction of the assumed pixscale
+# directory with the Astrometry.net index files; if it exists, only
+# the index files overlapping with the field are passed to solve-field
+# (set to None to use all index files in its default configuration)
+astronet_index_dir = '/usr/local/astrometry/data'
+# if True, solve-field loads all selected index files into memory at
+# once (the 'inparallel' backend option); if False, they are loaded
+# one at a time, which requires less memory
+astronet_inparallel = False
 # calibration catalog used for both astrometry and photometry
 cal_cat = '/media/data/pmv/PhotCalibration/ML_calcat_kur_allsky_ext1deg_20181115.fits'
+# directory with the HEALPix-partitioned, column-oriented version of
+# [cal_cat] created with [zogy.make_cal_store]; if it exists, it is
+# used instead of [cal_cat] to select the stars in the field-of-view
+cal_cat_store = cal_cat.replace('.fits', '_hpx')
+# maximum size [MB] of the in-process cache of calibration star
+# selections used by [zogy.read_cal_cat]; 0 disables the cache
+cal_cache_maxmem = 500
+# the cached selections extend this far [deg] beyond the field-of-view
+# so that they can be reused for nearby field centers
+cal_cache_margin = 0.25
 ast_nbright = 1000       # brightest no. of objects in the field to use for astrometry
 ast_filter = 'r'         # magnitude column to sort in brightness
 
@@ -130,11 +205,19 @@ apphot_radii = [0.66, 1.5, 5] # list of radii in units of FWHM
                               # in SExtractor general
 # PSF fitting
 dosex_psffit = False     # do extra SExtractor run with PSF fitting
+psffit = False           # perform PSF fitting (flux and position) in addition
+                         # to the optimal photometry, using [flux_psffit_batch]
+# limiting flux/magnitude
+limflux_boxsize = 240    # size of the boxes of the grid on which the limiting
+                         # flux is determined
+save_limmag_map = False  # save map of 5-sigma limiting magnitude on the
+                         # above grid to [base]_limmag.fits
                               
 # Photometric calibration
 obs_lat = -32.38722      # observatory latitude in degrees (North)
 obs_long = 20.81667      # observatory longitude in degrees (East)
 obs_height = 1798.       # observatory height in meters above sealevel
+airmass_hardie = False   # apply Hardie (1962) correction to sec(z) airmass
 # these [ext_coeff] are mean extinction estimates for Sutherland in
 # the MeerLICHT filters:
 ext_coeff = {'u':0.52, 'g':0.23, 'q':0.15, 'r':0.12, 'i':0.08, 'z':0.06}
@@ -168,6 +251,12 @@ swarp_cfg = cfg_dir+'swarp.config'           # SWarp configuration file
 mask_value = {'bad': 1, 'cosmic': 2, 'saturated': 4, 'saturated_connected': 8,
               'satellite': 16, 'edge': 32}
 
+# data type of the thumbnail images in the transient catalogue:
+# 'float32', 'float16' (stored as 16-bit integers containing the
+# float16 bit pattern) or 'int16' (scaled integers, with the scale and
+# zero point of each thumbnail recorded in additional columns)
+thumbnail_dtype = 'float32'
+
 # switch on/off different functions
 redo = False             # execute functions even if output file exist
 verbose = True           # print out extra info
@@ -4,7 +4,7 @@ import astropy.io.fits as fits
 from astropy.io import ascii
 #from astropy.stats import sigma_clipped_stats
 from astropy.wcs import WCS
-from astropy.table import Table
+from astropy.table import Table, vstack
 import numpy as np
 #import numpy.fft as fft
 import matplotlib
@@ -14,8 +14,13 @@ import os
 import subprocess
 from scipy import ndimage
 from scipy import stats
+from scipy.spatial import cKDTree
 import time
 import importlib
+import collections
+import glob
+import re
+import itertools
 # these are important to speed up the FFTs
 import pyfftw
 import pyfftw.interfaces.numpy_fft as fft
@@ -36,7 +41,7 @@ from lmfit import minimize, Minimizer, Parameters, Parameter, report_fit
 from sip_tpv import sip_to_pv
 
 import resource
-from skimage import restoration, measure
+from skimage import restoration
 #import inpaint
 import logging
 import sys, traceback
@@ -48,7 +53,9 @@ from functools import partial
 #from contextlib import contextmanager
 
 from astropy.time import Time
-from astropy.coordinates import SkyCoord, EarthLocation, AltAz
+from astropy.coordinates import SkyCoord, EarthLocation, GCRS, CIRS
+from astropy.coordinates import get_body_barycentric_posvel
+import astropy.constants as const
 
 from numpy.lib.recfunctions import append_fields, drop_fields, rename_fields, stack_arrays
 #from memory_profiler import profile
@@ -290,14 +297,22 @@ def optimal_subtraction(new_fits=None, ref_fits=None, new_fits_mask=None,
             version = result.stdout.read().split()[2].decode('UTF-8')
             header['S-VERS'] = (version, 'SExtractor version used')
 
-        # determine WCS solution of new_fits
+        # determine WCS solution of new_fits; if [C.wcs_header_only]
+        # is True, only the header of the WCS-corrected image is saved
+        # (in [base]_wcs.head) rather than the full [base]_wcs.fits
+        # image (see [read_wcs_image])
         fits_wcs = base+'_wcs.fits'
         data_cal = None
-        if not os.path.isfile(fits_wcs) or C.redo:
+        if ((not os.path.isfile(fits_wcs) and not os.path.isfile(fits_wcs.replace('.fits','.head')))
+            or C.redo):
             try:
                 if not C.skip_wcs:
                     data_cal = run_wcs(base+'.fits', fits_wcs, ra, dec, pixscale, xsize, ysize,
                                        header, log)
+                elif C.wcs_header_only:
+                    # just save header of original image
+                    header_orig = read_hdulist (base+'.fits', ext_header=0)
+                    write_header_file (header_orig, fits_wcs.replace('.fits','.head'))
                 else:
                     # just copy original image to _wcs.fits image
                     cmd = ['cp', base+'.fits', fits_wcs]
@@ -402,7 +417,7 @@ def optimal_subtraction(new_fits=None, ref_fits=None, new_fits_mask=None,
     # prepare cubes with shape (nsubs, ysize_fft, xsize_fft) with new,
     # ref, psf and background images
     if new:
-        data_new, psf_new, psf_orig_new, data_new_bkg, data_new_bkg_std, data_new_mask = (
+        data_new, psf_new, data_new_bkg, data_new_bkg_std, data_new_mask = (
             prep_optimal_subtraction(base_new+'_wcs.fits', nsubs, 'new', fwhm_new, header_new,
                                      log, fits_mask=new_fits_mask, data_cal=data_cal_new)
         )
@@ -410,7 +425,7 @@ def optimal_subtraction(new_fits=None, ref_fits=None, new_fits_mask=None,
     # same for [ref_fits]; if either [new_fits] was not defined,
     # [ref_fits_remap] will be None
     if ref_fits is not None:
-        data_ref, psf_ref, psf_orig_ref, data_ref_bkg, data_ref_bkg_std, data_ref_mask = (
+        data_ref, psf_ref, data_ref_bkg, data_ref_bkg_std, data_ref_mask = (
             prep_optimal_subtraction(base_ref+'_wcs.fits', nsubs, 'ref', fwhm_ref, header_ref,
                                      log, fits_mask=ref_fits_mask, ref_fits_remap=ref_fits_remap,
                                      data_cal=data_cal_ref)
@@ -491,7 +506,7 @@ def optimal_subtraction(new_fits=None, ref_fits=None, new_fits_mask=None,
             for nsub in range(nsubs):
                 index_fake = [slice(nsub*C.nfakestars, (nsub+1)*C.nfakestars)]
                 fakestar_xcoord[index_fake], fakestar_ycoord[index_fake], \
-                    fakestar_flux_input[index_fake] = add_fakestars (psf=psf_orig_new[nsub],
+                    fakestar_flux_input[index_fake] = add_fakestars (psf=psf_new[nsub],
                                                                      data=data_new[nsub],
                                                                      bkg=data_new_bkg[nsub],
                                                                      readnoise=readnoise_new,
@@ -522,11 +537,32 @@ def optimal_subtraction(new_fits=None, ref_fits=None, new_fits_mask=None,
                                        fratio_sub=fratio_sub,
                                        dx_sub=dx_sub, dy_sub=dy_sub,
                                        log=log)
+
+        # the subimages are subtracted one at a time by a single
+        # worker thread, as [run_ZOGY] already uses [nthreads] threads
+        # for its FFTs and the FFTW planning in [run_ZOGY] is not
+        # thread-safe; the transients in each subimage are detected
+        # with [get_trans_tile] by a separate pool of [nthreads]
+        # threads as soon as the subimage is finished, so that the
+        # detection overlaps with the subtraction of the next
+        # subimages; the candidates of all subimages are merged in
+        # [merge_trans_tiles]
         pool = ThreadPool(1)
+        pool_trans = ThreadPool(nthreads)
         try:
-            results_pool_zogy = pool.map(zogy_subloop_partial, range(nsubs))
+            results_pool_zogy = []
+            results_pool_trans = []
+            for nsub, result in enumerate(pool.imap(zogy_subloop_partial, range(nsubs))):
+                results_pool_zogy.append(result)
+                __, __, data_Scorr, data_Fpsf, data_Fpsferr = result
+                results_pool_trans.append(pool_trans.apply_async(
+                    get_trans_tile, (data_Scorr, data_Fpsf, data_Fpsferr, data_new_mask[nsub],
+                                     data_ref_mask[nsub]), {'log': log}))
+            tables_trans = [result.get() for result in results_pool_trans]
             pool.close()
             pool.join()
+            pool_trans.close()
+            pool_trans.join()
         except Exception as e:
             zogy_processed = False
             log.info(traceback.format_exc())
@@ -674,12 +710,19 @@ def optimal_subtraction(new_fits=None, ref_fits=None, new_fits_mask=None,
         header_zogy['Z-FPEMED'] = (median_Fpsferr, '[e-] median Fpsferr full image')
         header_zogy['Z-FPESTD'] = (std_Fpsferr, '[e-] sigma (STD) Fpsferr full image')
 
-        # find transients using function [get_trans_alt], which
+        # the transients were detected in the subimages by the
+        # [pool_trans] threads using function [get_trans_tile], which
         # applies threshold cuts directly on Scorr for the transient
-        # detection, rather than running SExtractor (see below)
+        # detection, rather than running SExtractor; merge these into
+        # a single table using [merge_trans_tiles], and record them
+        # with function [get_trans]
+        table_trans = merge_trans_tiles (tables_trans, cuts_ima, data_Scorr_full,
+                                         data_Fpsf_full, data_Fpsferr_full,
+                                         data_new_mask_full, data_ref_mask_full, log)
         ntrans = get_trans (data_new_full, data_ref_full, data_Scorr_full,
                             data_Fpsf_full, data_Fpsferr_full,
-                            data_new_mask_full, data_ref_mask_full, header_new, log)
+                            data_new_mask_full, data_ref_mask_full, header_new, log,
+                            table_trans=table_trans)
 
         # add header keyword(s):
         header_zogy['T-NSIGMA'] = (C.transient_nsigma, '[sigma] transient detection threshold')
@@ -816,13 +859,12 @@ def optimal_subtraction(new_fits=None, ref_fits=None, new_fits_mask=None,
             cat_trans_out = base_newref+'_trans.fits'
             thumbnail_data = [data_new_full, data_ref_full, data_D_full, data_Scorr_full]
             thumbnail_keys = ['THUMBNAIL_RED', 'THUMBNAIL_REF', 'THUMBNAIL_D', 'THUMBNAIL_SCORR']
-            # need to take care of objects closer than 32/2 pixels to
-            # the full image edge in creation of thumbnails - results
-            # in an error if transients are close to the edge
+            # thumbnails of objects closer than 32/2 pixels to the
+            # full image edge are padded with zeros
             result = format_cat (cat_trans, cat_trans_out, log, cat_type='trans',
                                  thumbnail_data=thumbnail_data, thumbnail_keys=thumbnail_keys,
-                                 thumbnail_size=32, header_toadd=header_newzogy,
-                                 exptime=exptime_new)
+                                 thumbnail_size=32, thumbnail_dtype=C.thumbnail_dtype,
+                                 header_toadd=header_newzogy, exptime=exptime_new)
 
     end_time = os.times()
     if new and ref:
@@ -994,14 +1036,56 @@ def read_hdulist (fits_file, ext_data=None, ext_header=None, dtype=None,
                 return 
             
 
+################################################################################
+
+def write_header_file (header, filename):
+
+    """Function that writes [header] to the text file [filename] with
+    one 80-character card per line; this is the format of the
+    external headers (.head files) read by SExtractor and SWarp."""
+
+    with open(filename, 'w') as f:
+        for card in header.cards:
+            f.write(str(card)+'\n')
+            
+            
+################################################################################
+
+def read_wcs_image (fits_wcs, read_data=True, dtype=None):
+
+    """Function that returns the data (if [read_data] is True) and
+    header of the WCS-corrected image [fits_wcs], i.e. [base]_wcs.fits.
+    If [C.wcs_header_only] was True when [fits_wcs] was produced (see
+    [sex_wcs]), this image was not written, and the data are read
+    from the original image [base].fits instead, combined with the
+    header saved in the text file [base]_wcs.head."""
+
+    if os.path.isfile(fits_wcs):
+        if read_data:
+            return read_hdulist (fits_wcs, ext_data=0, ext_header=0, dtype=dtype)
+        else:
+            return read_hdulist (fits_wcs, ext_header=0)
+
+    header = fits.Header.fromfile(fits_wcs.replace('.fits','.head'), sep='\n',
+                                  endcard=False, padding=False)
+    if read_data:
+        data = read_hdulist (fits_wcs.replace('_wcs.fits','.fits'), ext_data=0, dtype=dtype)
+        return data, header
+    else:
+        return header
+
+
 ################################################################################
 
 def format_cat (cat_in, cat_out, log, thumbnail_data=None, thumbnail_keys=None,
-                thumbnail_size=32, cat_type=None, header_toadd=None, exptime=0.):
+                thumbnail_size=32, thumbnail_dtype='float32', cat_type=None,
+                header_toadd=None, exptime=0.):
 
     """Function that formats binary fits table [cat_in] according to
         MeerLICHT/BlackGEM specifications and saves the resulting
-        binary fits table [cat_out].
+        binary fits table [cat_out]. The thumbnail images are
+        recorded with data type [thumbnail_dtype], which can be
+        'float32', 'float16' or 'int16' (see [C.thumbnail_dtype]).
 
     """
     
@@ -1121,42 +1205,77 @@ def format_cat (cat_in, cat_out, log, thumbnail_data=None, thumbnail_keys=None,
         # number of thumbnail images to add
         nthumbnails = len(thumbnail_keys)
         
-        # coordinates to loop
+        # coordinates of the thumbnails
         xcoords = data['XWIN_IMAGE']
         ycoords = data['YWIN_IMAGE']
-        ncoords = len(xcoords)
+
+        # pixel indices of the thumbnails, centered on the pixel
+        # containing the source for an odd [thumbnail_size], and on
+        # the lower left corner of the pixel with index
+        # int(coordinate) for an even size; parts of the thumbnails
+        # that are off the image are set to zero, as if the image was
+        # padded with zeros
+        hsize = int(thumbnail_size/2)
+        if thumbnail_size % 2 == 0:
+            xpos = xcoords.astype(int)
+            ypos = ycoords.astype(int)
+        else:
+            xpos = (xcoords-0.5).astype(int)
+            ypos = (ycoords-0.5).astype(int)
+        index_tn = np.arange(thumbnail_size) - hsize
+        y_index = ypos[:,None] + index_tn
+        x_index = xpos[:,None] + index_tn
 
         # loop thumbnails
         for i_tn in range(nthumbnails):
 
             ysize, xsize = thumbnail_data[i_tn].shape
-            
-            # initialise output column
-            data_col = np.zeros((ncoords,thumbnail_size,thumbnail_size))
-            
-            # loop x,y coordinates
-            for i_pos in range(ncoords):
-
-                # get index around x,y position using function [get_index_around_xy]
-                index = get_index_around_xy(ysize, xsize, ycoords[i_pos], xcoords[i_pos],
-                                            thumbnail_size)
-                # record in data_col
-                try:
-                    data_col[i_pos] = thumbnail_data[i_tn][index]
-                except ValueError as ve:
-                    log.info('skipping object at x,y: {:.0f},{:.0f} due to ValueError: {}'.
-                             format(xcoords[i_pos], ycoords[i_pos], ve))
-                    
+
+            # extract all thumbnails at once, using indices clipped
+            # to the image, and set the pixels off the image to zero
+            mask_y = (y_index >= 0) & (y_index < ysize)
+            mask_x = (x_index >= 0) & (x_index < xsize)
+            data_col = thumbnail_data[i_tn][np.clip(y_index, 0, ysize-1)[:,:,None],
+                                            np.clip(x_index, 0, xsize-1)[:,None,:]]
+            data_col[~(mask_y[:,:,None] & mask_x[:,None,:])] = 0
+
             # add column to table
             dim_str = '('+str(thumbnail_size)+','+str(thumbnail_size)+')'
             key = thumbnail_keys[i_tn]
-            col = fits.Column(name=key, format=formats[key][0], unit=formats[key][1], 
-                              disp=formats[key][2], array=data_col, dim=dim_str)
-            columns.append(col)
+            if thumbnail_dtype == 'float16':
+                # float16 is not a FITS data type, so record its bit
+                # pattern as 16-bit integers; use
+                # .astype('int16').view('float16') to convert back
+                col = fits.Column(name=key, format=thumbnail_size2+'I', unit=formats[key][1],
+                                  disp=formats[key][2], dim=dim_str,
+                                  array=data_col.astype('float16').view('int16'))
+                columns.append(col)
+            elif thumbnail_dtype == 'int16':
+                # scale each thumbnail to the range of 16-bit
+                # integers: value = zero + scale * integer
+                data_min = np.amin(data_col, axis=(1,2))
+                data_max = np.amax(data_col, axis=(1,2))
+                zero = 0.5*(data_max + data_min)
+                scale = (data_max - data_min) / 65534.
+                scale[scale==0] = 1.
+                data_int = np.rint((data_col - zero[:,None,None]) / scale[:,None,None])
+                col = fits.Column(name=key, format=thumbnail_size2+'I', unit='',
+                                  disp='int16', dim=dim_str, array=data_int.astype('int16'))
+                columns.append(col)
+                columns.append(fits.Column(name=key+'_ZERO', format='E', unit=formats[key][1],
+                                           disp='flt32', array=zero))
+                columns.append(fits.Column(name=key+'_SCALE', format='E', unit=formats[key][1],
+                                           disp='flt32', array=scale))
+            else:
+                col = fits.Column(name=key, format=formats[key][0], unit=formats[key][1], 
+                                  disp=formats[key][2], array=data_col, dim=dim_str)
+                columns.append(col)
 
             
     hdu = fits.BinTableHDU.from_columns(columns)
     hdu.header += header
+    if thumbnail_data is not None and thumbnail_keys is not None:
+        hdu.header['TN-DTYPE'] = (thumbnail_dtype, 'data type of thumbnail images')
     hdu.writeto(cat_out, overwrite=True)
     
     if C.timing:
@@ -1165,61 +1284,10 @@ def format_cat (cat_in, cat_out, log, thumbnail_data=None, thumbnail_keys=None,
     return
 
 
-################################################################################
-
-def get_index_around_xy(ysize, xsize, ycoord, xcoord, size):
-
-    if size % 2 == 0:
-        oddsized = False
-        xpos = int(xcoord)
-        ypos = int(ycoord)
-    else:
-        oddsized = True
-        xpos = int(xcoord-0.5)
-        ypos = int(ycoord-0.5)
-
-    hsize = int(size/2)
-
-    # if footprint is partially off the image, just go ahead
-    # with the pixels on the image
-    y1 = max(0, ypos-hsize)
-    x1 = max(0, xpos-hsize)
-    if oddsized:
-        y2 = min(ysize, ypos+hsize+1)
-        x2 = min(xsize, xpos+hsize+1)
-        # make sure axis sizes are odd
-        if (x2-x1) % 2 == 0:
-            if x1==0:
-                x2 -= 1
-            else:
-                x1 += 1
-        if (y2-y1) % 2 == 0:
-            if y1==0:
-                y2 -= 1
-            else:
-                y1 += 1
-    else:
-        y2 = min(ysize, ypos+hsize)
-        x2 = min(xsize, xpos+hsize)
-        # make sure axis sizes are even
-        if (x2-x1) % 2 != 0:
-            if x1==0:
-                x2 -= 1
-            else:
-                x1 += 1
-        if (y2-y1) % 2 != 0:
-            if y1==0:
-                y2 -= 1
-            else:
-                y1 += 1
-
-    return [slice(y1,y2),slice(x1,x2)]
-
-
 ################################################################################
 
 def get_trans (data_new, data_ref, data_Scorr, data_Fpsf, data_Fpsferr,
-               data_new_mask, data_ref_mask, header_new, log):
+               data_new_mask, data_ref_mask, header_new, log, table_trans=None):
 
     """Function that selects transient candidates from the significance
     array (data_Scorr), estimates their approximate position, and fits
@@ -1231,10 +1299,98 @@ def get_trans (data_new, data_ref, data_Scorr, data_Fpsf, data_Fpsferr,
     to be fit to these data arrays is a combination of the PSFs of the
     new and ref image, i.e. P_D in ZOGY-speak.
 
+    If [table_trans] is provided, e.g. the merged output of the
+    transient detection performed on the subimages (see
+    [get_trans_tile] and [merge_trans_tiles]), the detection on the
+    full-frame arrays is skipped and this table is used instead.
+
     """
 
     if C.timing: t = time.time()
 
+    if table_trans is None:
+        # detect and measure the regions on the full-frame arrays
+        # using function [get_trans_regions]
+        table_trans = get_trans_regions (data_Scorr, data_Fpsf, data_Fpsferr,
+                                         data_new_mask, data_ref_mask, log=log)
+
+    # try fitting P_D (combination of PSFs of new and ref images)
+    # to D, Scorr, Fpsf and Fpsferr images in order to:
+    #
+    # (1) use chi2 of PSF fit to D to discard fake transients
+    #
+    # (2) improve the estimate of the peak value in Scorr, Fpsf
+    #     and Fpsferr, which should be possible as the PSF is
+    #     better sampled than the image pixels
+
+    color_ds9 = 'green'
+            
+    # loop arrays and discard entries within some number of
+    # pixels (3xFWHM?) of each other 
+    #for i in range(ntrans):
+
+    ntrans = len(table_trans)
+    log.info('ntrans: {}'.format(ntrans))
+
+    # create output table with the relevant transients
+    table = table_trans['XWIN_IMAGE', 'YWIN_IMAGE', 'ERRX2WIN_IMAGE', 'ERRY2WIN_IMAGE',
+                        'ERRXYWIN_IMAGE', 'ELONGATION', 'S2N', 'FLUX_PSF', 'FLUXERR_PSF']
+    # add number
+    table['NUMBER'] = np.arange(ntrans)+1
+    # add RA and DEC
+    wcs = wcs_transform(header_new)
+    ra, dec = wcs.all_pix2world(table['XWIN_IMAGE'], table['YWIN_IMAGE'], 1)
+    table['ALPHAWIN_J2000'] = ra
+    table['DELTAWIN_J2000'] = dec
+    
+    # create output fits catalog
+    table.write(base_newref+'.transcat', format='fits', overwrite=True)
+
+    # determine output transient catalogue array, containing
+    # columns similar to these:
+    #keys_to_record = ['NUMBER', 'XWIN_IMAGE', 'YWIN_IMAGE',
+    #                  'ERRX2WIN_IMAGE', 'ERRY2WIN_IMAGE', 'ERRXYWIN_IMAGE', 
+    #                  'ELONGATION', 'ALPHAWIN_J2000', 'DELTAWIN_J2000',
+    #                  'FLAGS', 'IMAFLAGS_ISO', 'FWHM_IMAGE', 'CLASS_STAR',    
+    #                  'FLUX_MAX', 'FLUX_PSF', 'FLUXERR_PSF']
+    # e.g.: x, y, errx, erry, alphawin_j2000, deltawin_j2000, flags,
+    #       peak significance and error, peak Fpsf and error, peak Fpsferr and error,
+    #       PSF flux and error from D, chi2 (should be similar for all fits; if not,
+    #       record separate chi2 for each fit).
+
+    # prepare ds9 region file using function [prep_ds9regions]
+    if C.make_plots:
+        result = prep_ds9regions(base_newref+'_ds9regions.txt',
+                                 table['XWIN_IMAGE'], table['YWIN_IMAGE'], 
+                                 radius=5., width=2, color=color_ds9)
+
+    if C.timing:
+        log_timing_memory (t0=t, label='get_trans', log=log)
+        
+    return ntrans
+
+
+################################################################################
+
+def get_trans_regions (data_Scorr, data_Fpsf, data_Fpsferr, data_new_mask,
+                       data_ref_mask, keep_edge=False, log=None):
+
+    """Function that detects the transient candidates in the significance
+    array [data_Scorr] and measures their position, shape, peak
+    significance, and peak PSF flux and its error from [data_Fpsf] and
+    [data_Fpsferr]. The input arrays can be the full frame or a
+    subimage. Returns a table of the regions that pass the cuts on
+    area, sign and flagged pixels, with the pixel coordinates
+    (XWIN_IMAGE and YWIN_IMAGE) in the frame of the input arrays.
+    Besides the output columns of [get_trans], the table contains the
+    (zero-based) indices of the peak pixel (Y_PEAK, X_PEAK), the
+    bounding box of the region (Y_MIN, Y_MAX, X_MIN, X_MAX) and
+    whether the region touches the edge of the input arrays (EDGE). If
+    [keep_edge] is True, regions touching the edge are kept
+    irrespective of the cuts, as they may be truncated.
+
+    """
+
     # mask of pixels with absolute values >= C.transient_sigma
     mask_significant_init = (np.abs(data_Scorr) >= C.transient_nsigma).astype('uint8')
     
@@ -1264,186 +1420,321 @@ def get_trans (data_new, data_ref, data_Scorr, data_Fpsf, data_Fpsferr,
     #           mask_significant=mask_significant, data_Scorr=data_Scorr,
     #           data_Scorr_regions=data_Scorr_regions)
 
-    if C.verbose:
+    if C.verbose and log is not None:
         log.info('nregions: {}'.format(nregions))
         
-    # using skimage.measure.regionprops; see
-    # http://scikit-image.org/docs/dev/api/skimage.measure.html#skimage.measure.regionprops
-    # for list of attributes of [props]
-    #region = measure.regionprops(data_Scorr_regions, intensity_image=data_Scorr, cache=True)
-    region = measure.regionprops(data_Scorr_regions, cache=True)
-
-    # initialize arrays
-    mask_keep = np.zeros(nregions, dtype=bool)
-    npixels_array = np.zeros(nregions)
-    x_array = np.zeros(nregions)
-    y_array = np.zeros(nregions)
-    errx2_array = np.zeros(nregions)
-    erry2_array = np.zeros(nregions)
-    errxy_array = np.zeros(nregions)
-    elongation_array = np.zeros(nregions)
-    Scorr_array = np.zeros(nregions)
-    flux_array = np.zeros(nregions)
-    fluxerr_array = np.zeros(nregions)
-    
-    t1 = time.time()
-    # loop over the regions:
-    for i in range(nregions):
-        
-        # determine the indices of the input data arrays corresponding
-        # to the current region with the significant pixels
-        region_temp = region[i]
-        coords = region_temp.coords
-        y_index = coords[:,0]
-        x_index = coords[:,1]
-        index_region = [y_index, x_index]
-
-        data_new_region = data_new[index_region]
-        data_ref_region = data_ref[index_region]
-        #data_D_region = data_D[index_region]
-        data_Scorr_region = data_Scorr[index_region]
-        data_Fpsf_region = data_Fpsf[index_region]
-        data_Fpsferr_region = data_Fpsferr[index_region]
-
-        # rectangular bounding box of the current region; N.B.: this
-        # includes pixels that are not significant and is mostly for
-        # displaying purpose
-        bbox = region_temp.bbox
-        # xmin, ymin, xmax, ymax are indices, not pixel coordinates;
-        # they can be directly used to slice an array, i.e. xmax and
-        # ymax already have 1 added
-        xmin, ymin, xmax, ymax = bbox
-        index_bbox = [slice(xmin,xmax),slice(ymin,ymax)]
-         
-        # check if region is affected by one or more flagged pixels in
-        # the input new and ref mask arrays; for the moment, discard
-        # the region if sum of flags in either new or ref mask is
-        # nonzero
-        if np.sum(data_new_mask[index_region]) > 0 or np.sum(data_ref_mask[index_region]):
-            continue
+    # all per-region quantities are determined at once, using the
+    # label-sorted arrays of the pixels that are part of a region,
+    # rather than looping over the regions (see older zogy versions)
+
+    # indices of pixels in regions, in raster order, and sorted by
+    # label; the stable sort keeps the raster order within a region
+    y_index, x_index = np.nonzero(data_Scorr_regions)
+    labels = data_Scorr_regions[y_index, x_index]
+    index_sort = np.argsort(labels, kind='stable')
+    y_index = y_index[index_sort]
+    x_index = x_index[index_sort]
+    labels = labels[index_sort]
+    # label index starting from zero
+    labels -= 1
+
+    data_Scorr_pix = data_Scorr[y_index, x_index].astype('float64')
+    data_Fpsf_pix = data_Fpsf[y_index, x_index]
+    data_Fpsferr_pix = data_Fpsferr[y_index, x_index].astype('float64')
+    
+    # number of pixels in each region
+    npixels_array = np.bincount(labels, minlength=nregions)
+    
+    # number of pixels flagged in either new or ref mask
+    mask_flagged = ((data_new_mask[y_index, x_index] != 0) |
+                    (data_ref_mask[y_index, x_index] != 0))
+    nflagged = np.bincount(labels, weights=mask_flagged, minlength=nregions)
+
+    # discard region if it contains both positively significant and
+    # negatively significant values; also determine the bounding box
+    # of each region
+    if nregions > 0:
+        index_start = np.concatenate(([0], np.cumsum(npixels_array)[:-1]))
+        Scorr_max = np.maximum.reduceat(data_Scorr_pix, index_start)
+        Scorr_min = np.minimum.reduceat(data_Scorr_pix, index_start)
+        # y_index is sorted within each region
+        y_min = y_index[index_start]
+        y_max = y_index[index_start+npixels_array-1]
+        x_min = np.minimum.reduceat(x_index, index_start)
+        x_max = np.maximum.reduceat(x_index, index_start)
+    else:
+        Scorr_max = Scorr_min = np.zeros(0)
+        y_min = y_max = x_min = x_max = np.zeros(0, dtype=int)
+    mask_mixed = ((Scorr_max >= C.transient_nsigma) & (Scorr_min <= -C.transient_nsigma))
 
-        # discard if region area is too small or too big
-        npixels = len(coords)
-        if npixels < 3 or npixels > 1000:
-            continue
+    # regions touching the edge of the input arrays
+    ysize, xsize = data_Scorr.shape
+    mask_edge = ((y_min == 0) | (y_max == ysize-1) | (x_min == 0) | (x_max == xsize-1))
+    
+    # discard if region is affected by one or more flagged pixels in
+    # the input new and ref mask arrays or if region area is too small
+    # or too big
+    mask_keep = ((nflagged == 0) & (npixels_array >= 3) & (npixels_array <= 1000) &
+                 ~mask_mixed)
+    if keep_edge:
+        mask_keep |= mask_edge
+    
+    # pixel with peak absolute significance in each region; the
+    # first pixel in raster order in case of ties
+    index_peak = np.lexsort((np.arange(len(labels)), -np.abs(data_Scorr_pix), labels))
+    if nregions > 0:
+        index_peak = index_peak[index_start]
+    Scorr_array = data_Scorr_pix[index_peak]
+    flux_array = data_Fpsf_pix[index_peak]
+    fluxerr_array = data_Fpsferr_pix[index_peak]
+
+    # intensity used in the moments is the significance, with the
+    # sign flipped for negative transients
+    I = data_Scorr_pix * np.sign(Scorr_array)[labels]
+    x_pix = x_index + 1.
+    y_pix = y_index + 1.
+
+    # position weighted by I, as defined in the SExtractor manual
+    def sum_regions (weights):
+        return np.bincount(labels, weights=weights, minlength=nregions)
+
+    I_sum = sum_regions(I)
+    I_sum[I_sum==0] = np.nan
+    x_array = sum_regions(I * x_pix) / I_sum
+    y_array = sum_regions(I * y_pix) / I_sum
 
-        # discard if region contains both positively significant as
-        # negatively significant values
-        if (np.amax(data_Scorr_region) >= C.transient_nsigma and
-            np.amin(data_Scorr_region) <= -C.transient_nsigma):
-            continue
+    # 2nd order moments: X2, Y2, XY
+    x2_array = sum_regions(I * x_pix**2) / I_sum - x_array**2
+    y2_array = sum_regions(I * y_pix**2) / I_sum - y_array**2
+    xy_array = sum_regions(I * x_pix * y_pix) / I_sum - x_array*y_array
 
-        # x and y indices of peak significance
-        index_peak = np.abs(data_Scorr_region).argmax()
-        XPEAK = x_index[index_peak]
-        YPEAK = y_index[index_peak]
-        Scorr_peak = data_Scorr_region[index_peak]
-        if False:
-            log.info('XPEAK: {}, YPEAK: {}, Scorr_peak: {}'.format(XPEAK, YPEAK, Scorr_peak))
+    # position errors: ERRX2, ERRY2, ERRXY
+    I_var = I + data_Fpsferr_pix
+    I_sum2 = I_sum**2
+    dx = x_pix - x_array[labels]
+    dy = y_pix - y_array[labels]
+    errx2_array = sum_regions(I_var * dx**2) / I_sum2
+    erry2_array = sum_regions(I_var * dy**2) / I_sum2
+    errxy_array = sum_regions(I_var * dx * dy) / I_sum2
 
-        # flux and fluxerr
-        flux_peak = data_Fpsf_region[index_peak]
-        fluxerr_peak = data_Fpsferr_region[index_peak]
-        
-        color_ds9 = 'green'
-        if Scorr_peak < 0.:
-            color_ds9 = 'pink'
-            data_Scorr_region = -data_Scorr_region
-        
-        # using function [trans_measure], obtain a number of
-        # quantities, such as central pixel coordinates and
-        # elongation, weighted with image [intensity]
-        X, Y, X2, Y2, XY, ERRX2, ERRY2, ERRXY, A, B, THETA, ERRA, ERRB, ERRTHETA = (
-            trans_measure(data_Scorr_region, x_index+1, y_index+1, var_bkg=data_Fpsferr_region))
-        if B!=0:
-            ELONGATION = A/B
-        else:
-            ELONGATION = 100.
-        ELLIPTICITY = 1-B/A
+    # use function [get_shape_parameters] to get A, B, THETA and their
+    # errors for all regions that are kept at once
+    A, B, THETA, ERRA, ERRB, ERRTHETA = get_shape_parameters (
+        x2_array[mask_keep], y2_array[mask_keep], xy_array[mask_keep],
+        errx2_array[mask_keep], erry2_array[mask_keep], errxy_array[mask_keep])
+    elongation_array = np.full(np.sum(mask_keep), 100.)
+    mask_B = (B != 0)
+    elongation_array[mask_B] = A[mask_B] / B[mask_B]
+
+    # create table of the regions that are kept
+    table = Table([x_array[mask_keep], y_array[mask_keep], errx2_array[mask_keep],
+                   erry2_array[mask_keep], errxy_array[mask_keep], elongation_array,
+                   Scorr_array[mask_keep], flux_array[mask_keep], fluxerr_array[mask_keep],
+                   y_index[index_peak][mask_keep], x_index[index_peak][mask_keep],
+                   y_min[mask_keep], y_max[mask_keep], x_min[mask_keep], x_max[mask_keep],
+                   mask_edge[mask_keep]],
+                  names=('XWIN_IMAGE', 'YWIN_IMAGE', 'ERRX2WIN_IMAGE', 'ERRY2WIN_IMAGE',
+                         'ERRXYWIN_IMAGE', 'ELONGATION', 'S2N', 'FLUX_PSF', 'FLUXERR_PSF',
+                         'Y_PEAK', 'X_PEAK', 'Y_MIN', 'Y_MAX', 'X_MIN', 'X_MAX', 'EDGE'))
+
+    return table
 
-        if False:
-            log.info('X: {:.2f}, Y: {:.2f}, X2: {:2f}, Y2: {:2f}, XY: {:.2f}, ERRX2: {:.2f}, ERRY2: {:.2f}, ERRXY: {:.2f}, A: {:.2f}, B: {:.2f}, THETA: {:.2f}, ERRA: {:.2f}, ERRB: {:.2f}, ERRTHETA: {:.2f}, ELONGATION: {:.2f}, ELLIPTICITY: {:.2f}'.format(X, Y, X2, Y2, XY, ERRX2, ERRY2, ERRXY, A, B, THETA, ERRA, ERRB, ERRTHETA, ELONGATION, ELLIPTICITY))
-
-        # try fitting P_D (combination of PSFs of new and ref images)
-        # to D, Scorr, Fpsf and Fpsferr images in order to:
-        #
-        # (1) use chi2 of PSF fit to D to discard fake transients
-        #
-        # (2) improve the estimate of the peak value in Scorr, Fpsf
-        #     and Fpsferr, which should be possible as the PSF is
-        #     better sampled than the image pixels
-        
-        
-        # fill output lists
-        mask_keep[i] = True
-        npixels_array[i] = npixels
-        x_array[i] = X
-        y_array[i] = Y
-        errx2_array[i] = ERRX2
-        erry2_array[i] = ERRY2
-        errxy_array[i] = ERRXY
-        elongation_array[i] = ELONGATION
-        Scorr_array[i] = Scorr_peak
-        flux_array[i] = flux_peak
-        fluxerr_array[i] = fluxerr_peak
-        
-        if False:
-            ds9_arrays(new=data_new[index_bbox],
-                       ref=data_ref[index_bbox],
-                       #D=data_D[index_bbox],
-                       Scorr=data_Scorr[index_bbox],
-                       Fpsf=data_Fpsf[index_bbox],
-                       Fpsferr=data_Fpsferr[index_bbox],
-                       mask_new=data_new_mask[index_bbox],
-                       mask_ref=data_ref_mask[index_bbox])
-            
-    # loop arrays and discard entries within some number of
-    # pixels (3xFWHM?) of each other 
-    #for i in range(ntrans):
 
-    ntrans = np.sum(mask_keep)
-    log.info('ntrans: {}'.format(ntrans))
+################################################################################
 
-    # create output table:
-    table_all = Table([x_array, y_array, errx2_array, erry2_array, errxy_array,
-                       elongation_array, Scorr_array, flux_array, fluxerr_array],
-                      names=('XWIN_IMAGE', 'YWIN_IMAGE', 'ERRX2WIN_IMAGE', 'ERRY2WIN_IMAGE',
-                             'ERRXYWIN_IMAGE', 'ELONGATION', 'S2N', 'FLUX_PSF', 'FLUXERR_PSF'))
-    # keep relevant transients
-    table = table_all[mask_keep]
-    # add number
-    table['NUMBER'] = np.arange(ntrans)+1
-    # add RA and DEC
-    wcs = WCS(header_new)
-    ra, dec = wcs.all_pix2world(table['XWIN_IMAGE'], table['YWIN_IMAGE'], 1)
-    table['ALPHAWIN_J2000'] = ra
-    table['DELTAWIN_J2000'] = dec
+def get_trans_tile (data_Scorr, data_Fpsf, data_Fpsferr, data_new_mask,
+                    data_ref_mask, log=None):
+
+    """Function that detects the transient candidates in a single
+    subimage, using function [get_trans_regions] on the central
+    [C.subimage_size] pixels plus a halo of [C.transient_halo] pixels
+    on each side. Only the regions that have at least one pixel inside
+    the central part of the subimage are returned; regions that
+    extend into the halo (HALO) may also be detected in a neighbouring
+    subimage and are deduplicated in [merge_trans_tiles]. Pixel
+    coordinates are in the frame of the subimage including its
+    border.
+
+    """
+
+    if C.timing and log is not None: t = time.time()
+
+    size = C.subimage_size
+    border = C.subimage_border
+    halo = min(C.transient_halo, border)
+
+    # detection window: the central part plus the halo
+    i1, i2 = border-halo, border+size+halo
+    index_window = [slice(i1,i2), slice(i1,i2)]
+    table = get_trans_regions (data_Scorr[index_window], data_Fpsf[index_window],
+                               data_Fpsferr[index_window], data_new_mask[index_window],
+                               data_ref_mask[index_window], keep_edge=True, log=log)
+
+    # convert to the frame of the subimage including its border
+    for col in ['XWIN_IMAGE', 'YWIN_IMAGE', 'Y_PEAK', 'X_PEAK', 'Y_MIN', 'Y_MAX',
+                'X_MIN', 'X_MAX']:
+        table[col] += i1
+        
+    # discard regions entirely inside the halo
+    mask_valid = ((table['Y_MAX'] >= border) & (table['Y_MIN'] < border+size) &
+                  (table['X_MAX'] >= border) & (table['X_MIN'] < border+size))
+    table = table[mask_valid]
     
-    # create output fits catalog
-    table.write(base_newref+'.transcat', format='fits', overwrite=True)
+    # regions extending into the halo, and whether the peak pixel is
+    # inside the central part
+    table['HALO'] = ((table['Y_MIN'] < border) | (table['Y_MAX'] >= border+size) |
+                     (table['X_MIN'] < border) | (table['X_MAX'] >= border+size))
+    table['OWNER'] = ((table['Y_PEAK'] >= border) & (table['Y_PEAK'] < border+size) &
+                      (table['X_PEAK'] >= border) & (table['X_PEAK'] < border+size))
 
-    # determine output transient catalogue array, containing
-    # columns similar to these:
-    #keys_to_record = ['NUMBER', 'XWIN_IMAGE', 'YWIN_IMAGE',
-    #                  'ERRX2WIN_IMAGE', 'ERRY2WIN_IMAGE', 'ERRXYWIN_IMAGE', 
-    #                  'ELONGATION', 'ALPHAWIN_J2000', 'DELTAWIN_J2000',
-    #                  'FLAGS', 'IMAFLAGS_ISO', 'FWHM_IMAGE', 'CLASS_STAR',    
-    #                  'FLUX_MAX', 'FLUX_PSF', 'FLUXERR_PSF']
-    # e.g.: x, y, errx, erry, alphawin_j2000, deltawin_j2000, flags,
-    #       peak significance and error, peak Fpsf and error, peak Fpsferr and error,
-    #       PSF flux and error from D, chi2 (should be similar for all fits; if not,
-    #       record separate chi2 for each fit).
+    if C.timing and log is not None:
+        log_timing_memory (t0=t, label='get_trans_tile', log=log)
+    
+    return table
 
-    # prepare ds9 region file using function [prep_ds9regions]
-    if C.make_plots:
-        result = prep_ds9regions(base_newref+'_ds9regions.txt',
-                                 x_array[mask_keep], y_array[mask_keep], 
-                                 radius=5., width=2, color=color_ds9)
 
-    if C.timing:
-        log_timing_memory (t0=t, label='get_trans', log=log)
+################################################################################
+
+def merge_trans_tiles (tables_tiles, cuts_ima, data_Scorr, data_Fpsf, data_Fpsferr,
+                       data_new_mask, data_ref_mask, log):
+
+    """Function that merges the transient tables [tables_tiles] of the
+    subimages as determined by [get_trans_tile] into a single table
+    with the pixel coordinates in the full-frame image, whose
+    bottom-left corners of the central parts of the subimages are
+    defined by [cuts_ima]. Regions detected in more than one subimage
+    are deduplicated, keeping the detection from the subimage that
+    contains the peak pixel. Regions that were truncated by the edge
+    of the detection window are measured again on the full-frame
+    arrays.
+
+    """
+
+    if C.timing: t = time.time()
+    log.info('Executing merge_trans_tiles ...')
+
+    # convert to full-frame coordinates and stack the tables
+    tables = []
+    for nsub, table in enumerate(tables_tiles):
+        dy = cuts_ima[nsub][0] - C.subimage_border
+        dx = cuts_ima[nsub][2] - C.subimage_border
+        for col in ['YWIN_IMAGE', 'Y_PEAK', 'Y_MIN', 'Y_MAX']:
+            table[col] += dy
+        for col in ['XWIN_IMAGE', 'X_PEAK', 'X_MIN', 'X_MAX']:
+            table[col] += dx
+        tables.append(table)
+    table = vstack(tables)
+
+    # measure truncated regions again on the full-frame arrays in
+    # a box around the region, which is grown until the region is
+    # no longer truncated by the box
+    ysize, xsize = data_Scorr.shape
+    index_edge = np.nonzero(table['EDGE'])[0]
+    mask_keep = np.ones(len(table), dtype=bool)
+    for i in index_edge:
+        margin = max(2*C.transient_halo, 16)
+        while True:
+            y1 = max(0, table['Y_MIN'][i]-margin)
+            y2 = min(ysize, table['Y_MAX'][i]+margin+1)
+            x1 = max(0, table['X_MIN'][i]-margin)
+            x2 = min(xsize, table['X_MAX'][i]+margin+1)
+            index_box = [slice(y1,y2), slice(x1,x2)]
+            table_box = get_trans_regions (data_Scorr[index_box], data_Fpsf[index_box],
+                                           data_Fpsferr[index_box], data_new_mask[index_box],
+                                           data_ref_mask[index_box], keep_edge=True)
+            # identify the region containing the peak pixel
+            y_peak = table['Y_PEAK'][i] - y1
+            x_peak = table['X_PEAK'][i] - x1
+            mask_match = ((table_box['Y_MIN'] <= y_peak) & (table_box['Y_MAX'] >= y_peak) &
+                          (table_box['X_MIN'] <= x_peak) & (table_box['X_MAX'] >= x_peak))
+            if np.sum(mask_match) == 0:
+                break
+            j = np.nonzero(mask_match)[0][np.argmin((table_box['Y_PEAK'][mask_match]-y_peak)**2 +
+                                                    (table_box['X_PEAK'][mask_match]-x_peak)**2)]
+            # region is truncated if it touches an edge of the box
+            # that is not an edge of the image
+            if ((table_box['Y_MIN'][j] == 0 and y1 > 0) or
+                (table_box['Y_MAX'][j] == y2-y1-1 and y2 < ysize) or
+                (table_box['X_MIN'][j] == 0 and x1 > 0) or
+                (table_box['X_MAX'][j] == x2-x1-1 and x2 < xsize)):
+                margin *= 2
+                continue
+            # the region is complete; as it does not touch the edge of
+            # the box, it passed the cuts already, unless the box edge
+            # it touches is an edge of the image, in which case it is
+            # measured once more without keeping the regions touching
+            # the edge irrespective of the cuts
+            if table_box['EDGE'][j]:
+                y_peak, x_peak = table_box['Y_PEAK'][j], table_box['X_PEAK'][j]
+                table_box = get_trans_regions (data_Scorr[index_box], data_Fpsf[index_box],
+                                               data_Fpsferr[index_box],
+                                               data_new_mask[index_box],
+                                               data_ref_mask[index_box])
+                mask_match = ((table_box['Y_PEAK'] == y_peak) &
+                              (table_box['X_PEAK'] == x_peak))
+            else:
+                mask_match = (np.arange(len(table_box)) == j)
+            break
+            
+        if np.sum(mask_match) == 0:
+            # region did not pass the cuts
+            mask_keep[i] = False
+            continue
+        j = np.nonzero(mask_match)[0][0]
+        for col in table_box.colnames:
+            table[col][i] = table_box[col][j]
+        for col in ['YWIN_IMAGE', 'Y_PEAK', 'Y_MIN', 'Y_MAX']:
+            table[col][i] += y1
+        for col in ['XWIN_IMAGE', 'X_PEAK', 'X_MIN', 'X_MAX']:
+            table[col][i] += x1
+        # flag it as such, so that it is considered in the
+        # deduplication below
+        table['HALO'][i] = True
+
+    table = table[mask_keep]
+
+    # deduplicate regions extending into the halo; consider them in
+    # order of preference: peak pixel inside the central part of the
+    # subimage, not truncated by the detection window and highest
+    # absolute significance
+    index_halo = np.nonzero(table['HALO'])[0]
+    order = np.lexsort((-np.abs(table['S2N'][index_halo]),
+                        table['EDGE'][index_halo],
+                        ~table['OWNER'][index_halo]))
+    index_halo = index_halo[order]
+    y_peak = np.array(table['Y_PEAK'])
+    x_peak = np.array(table['X_PEAK'])
+    # two detections are considered duplicates if the peak pixel of
+    # each is inside the bounding box of the other
+    def inside (i, j):
+        return ((y_peak[i] >= table['Y_MIN'][j]) & (y_peak[i] <= table['Y_MAX'][j]) &
+                (x_peak[i] >= table['X_MIN'][j]) & (x_peak[i] <= table['X_MAX'][j]))
+
+    mask_keep = np.ones(len(table), dtype=bool)
+    index_kept = []
+    for i in index_halo:
+        if len(index_kept) > 0:
+            j = np.array(index_kept)
+            if np.any(inside(i,j) & inside(j,i)):
+                mask_keep[i] = False
+                continue
+        index_kept.append(i)
+
+    ndup = np.sum(~mask_keep)
+    table = table[mask_keep]
         
-    return ntrans
+    # sort the candidates in raster order of the peak pixel, similar
+    # to the order of the full-frame detection
+    table = table[np.lexsort((table['X_PEAK'], table['Y_PEAK']))]
+    
+    if C.verbose:
+        log.info('number of duplicate regions removed: {}'.format(ndup))
+        log.info('number of truncated regions measured again: {}'.format(len(index_edge)))
+
+    if C.timing:
+        log_timing_memory (t0=t, label='merge_trans_tiles', log=log)
+
+    return table
 
 
 ################################################################################
@@ -1464,64 +1755,20 @@ def prep_ds9regions(filename, x, y, radius=5, width=2, color='green'):
     return
     
 
-################################################################################
-
-def trans_measure(I, x_index, y_index, var_bkg=0.):
-
-    """Function that determines a number of positional quantities
-    (adopting the definitions as described in the SExtractor manual)
-    based on the input intensity array [I] and the corresponding
-    indices of the x,y coordinates [x_index] and [y_index]. These
-    three input arrays should have the same shape. [var_bkg]
-    determines the local background noise, which is added to [I] to
-    estimate the flux uncertainty used in the position uncertainty
-    calculations.
-
-    """
-    
-    assert I.shape == x_index.shape
-    assert x_index.shape == y_index.shape
-
-    # determine position (in pixel coordinates) weighted by I
-    I_sum = np.sum(I)
-    X = np.sum(I * x_index) / I_sum
-    Y = np.sum(I * y_index) / I_sum
-
-    # 2nd order moments: X2, Y2, XY
-    X2 = np.sum(I * x_index**2) / I_sum - X**2
-    Y2 = np.sum(I * y_index**2) / I_sum - Y**2
-    XY = np.sum(I * x_index * y_index) / I_sum - X*Y
-    
-    # Position errors: ERRX2, ERRY2, ERRXY
-    I_var = I + var_bkg
-    I_sum2 = I_sum**2
-    ERRX2 = np.sum(I_var * (x_index - X)**2) / I_sum2
-    ERRY2 = np.sum(I_var * (y_index - Y)**2) / I_sum2
-    ERRXY = np.sum(I_var * (x_index - X)*(y_index - Y)) / I_sum2
-
-    # use function [get_shape_parameters] to get A, B, THETA and their
-    # errors
-    A, B, THETA, ERRA, ERRB, ERRTHETA = get_shape_parameters (X2, Y2, XY, ERRX2, ERRY2, ERRXY)
-
-    return X, Y, X2, Y2, XY, ERRX2, ERRY2, ERRXY, A, B, THETA, ERRA, ERRB, ERRTHETA
-
-
 ################################################################################
 
 def get_shape_parameters (x2, y2, xy, errx2, erry2, errxy):
 
     """Function to calculate a, b, theta, erra, errb, errtheta from x2,
-    y2, xy, errx2, erry2, errxy (see SExtractor manual). """
+    y2, xy, errx2, erry2, errxy (see SExtractor manual). The inputs
+    can be scalars or arrays. """
 
     # Eq. 24 from SExtractor manual:
     term1 = (x2 + y2) / 2
     term2 = np.sqrt(0.25*(x2-y2)**2 + xy**2)
     a = np.sqrt(term1 + term2)
-    # Eq. 25 from SExtractor manual:
-    if term1 >= term2:
-        b = np.sqrt(term1 - term2)
-    else:
-        b = 0.
+    # Eq. 25 from SExtractor manual; b is zero if term1 < term2
+    b = np.sqrt(np.maximum(term1 - term2, 0.))
     # Eq. 21 from SExtractor manual:
     theta = 0.5*np.arctan2( 2*xy, x2-y2 )
     theta *= 180 / np.pi
@@ -1533,11 +1780,8 @@ def get_shape_parameters (x2, y2, xy, errx2, erry2, errxy):
     term1 = (errx2 + erry2) / 2
     term2 = np.sqrt(0.25*(errx2-erry2)**2 + errxy**2)
     erra = np.sqrt(term1 + term2)
-    # Eq. 37 from SExtractor manual:
-    if term1 >= term2:
-        errb = np.sqrt(term1 - term2)
-    else:
-        errb = 0.
+    # Eq. 37 from SExtractor manual; errb is zero if term1 < term2
+    errb = np.sqrt(np.maximum(term1 - term2, 0.))
     # Eq. 38 from SExtractor manual:
     errtheta = 0.5*np.arctan2( 2*errxy, errx2-erry2 )
     errtheta *= 180 / np.pi
@@ -1565,12 +1809,114 @@ def get_shape_parameters (x2, y2, xy, errx2, erry2, errxy):
     return a, b, theta, erra, errb, errtheta
 
 
+################################################################################
+
+class PSFModel:
+
+    """PSFEx model read from the PSF output binary table of PSFEx: the
+    basis of polynomial coefficient images [basis] at the PSFEx
+    sampling and the definition of the polynomial in [header], for any
+    number of context parameters (POLNAXIS), groups (POLNGRP) and
+    group degrees (POLDEG[1..]). The polynomial terms are ordered as in
+    PSFEx, i.e. with the exponent of the first context parameter
+    running fastest, subject to the maximum degree of each group. The
+    PSF images of a batch of positions are obtained with
+    [get_config] by contracting the design matrix of the polynomial
+    terms with the basis, and are resampled to the image pixel scale
+    with [resample].
+
+    """
+
+    def __init__(self, basis, header):
+
+        self.basis = np.asarray(basis, dtype='float64')
+        self.ndim = header['POLNAXIS']
+        self.names = [header['POLNAME{}'.format(i+1)] for i in range(self.ndim)]
+        self.zero = np.array([header['POLZERO{}'.format(i+1)] for i in range(self.ndim)])
+        self.scal = np.array([header['POLSCAL{}'.format(i+1)] for i in range(self.ndim)])
+        # group (starting at 0) of each context parameter and degree
+        # of each group
+        self.group = np.array([header['POLGRP{}'.format(i+1)]-1 for i in range(self.ndim)],
+                              dtype=int)
+        ngroup = header['POLNGRP'] if self.ndim > 0 else 0
+        self.degree = np.array([header['POLDEG{}'.format(g+1)] for g in range(ngroup)],
+                               dtype=int)
+        self.exponents = self.terms()
+        if len(self.exponents) != len(self.basis):
+            raise ValueError('number of polynomial terms ({}) does not match number of '
+                             'PSFEx basis images ({})'.format(len(self.exponents),
+                                                              len(self.basis)))
+        # resampling matrices saved by [resample]
+        self.zoom_matrix = {}
+
+
+    def terms(self):
+        """Exponents of the context parameters with shape (number of
+        terms, POLNAXIS), in the order of the PSFEx basis."""
+
+        # the product below runs fastest over its last element, so
+        # reverse the context parameters
+        ranges = [range(self.degree[g]+1) for g in self.group[::-1]]
+        exponents = [expo[::-1] for expo in itertools.product(*ranges)
+                     if np.all(np.bincount(self.group, weights=expo[::-1],
+                                           minlength=len(self.degree)) <= self.degree)]
+        return np.array(exponents, dtype=int).reshape(len(exponents), self.ndim)
+
+
+    def design(self, context):
+        """Design matrix with shape (number of positions, number of
+        terms) of the context parameter values [context], a sequence
+        of POLNAXIS arrays (e.g. X_IMAGE and Y_IMAGE)."""
+
+        if len(context) < self.ndim:
+            raise ValueError('PSFEx model requires {} context parameters: {}'
+                             .format(self.ndim, self.names))
+        context = [np.atleast_1d(np.asarray(c, dtype='float64')) for c in context]
+        npos = max([len(c) for c in context]) if context else 1
+        matrix = np.ones((npos, len(self.exponents)))
+        for i in range(self.ndim):
+            value = (context[i] - self.zero[i]) / self.scal[i]
+            # powers of this parameter up to the degree of its group
+            powers = value[:,None] ** np.arange(self.degree[self.group[i]]+1)
+            matrix *= powers[:,self.exponents[:,i]]
+        return matrix
+
+
+    def get_config(self, context):
+        """PSF images at the PSFEx sampling with shape (number of
+        positions, PSFAXIS2, PSFAXIS1) for the context parameter
+        values [context] (see [design])."""
+
+        return np.einsum('nk,kij->nij', self.design(context), self.basis)
+
+
+    def resample(self, psf_config, zoom, order=3):
+        """Resample the PSF image(s) [psf_config] with the factor
+        [zoom], identical to ndimage.zoom with spline order [order]
+        applied to each image, but for all images at once by
+        multiplying with the (cached) 1D resampling matrices of both
+        axes."""
+
+        psf_config = np.asarray(psf_config, dtype='float64')
+        ny, nx = psf_config.shape[-2:]
+        matrices = []
+        for n in [ny, nx]:
+            key = (n, zoom, order)
+            if key not in self.zoom_matrix:
+                # zoom is linear and separable, so resampling the unit
+                # vectors provides its matrix
+                self.zoom_matrix[key] = ndimage.zoom(np.eye(n), (zoom, 1), order=order)
+            matrices.append(self.zoom_matrix[key])
+
+        return np.matmul(np.matmul(matrices[0], psf_config), matrices[1].T)
+
+
 ################################################################################
 
 def get_psfoptflux_xycoords (psfex_bintable, D, S, D_mask, RON, xcoords, ycoords,
                              dx2=0, dy2=0, dxy=0, satlevel=50000, replace_satdata=False,
                              psf_oddsized=True, psffit=False, get_limflux=False,
-                             limflux_nsigma=5., log=None):
+                             limflux_nsigma=5., batch_size=5000, log=None):
 
     """Function that returns the optimal flux and its error (using the
        function [flux_optimal] of a source at pixel positions
@@ -1579,7 +1925,8 @@ def get_psfoptflux_xycoords (psfex_bintable, D, S, D_mask, RON, xcoords, ycoords
        [RON]. [D], [S] and [RON] are assumed to be in electrons.
     
        [D] is a 2D array meant to be the full image. [S] can be a 2D
-       array with the same shape as [D] or a scalar. [xcoords] and
+       array with the same shape as [D], a [BackgroundModel] or a
+       scalar. [xcoords] and
        [ycoords] are arrays, and the output flux and its error will be
        arrays as well.
     
@@ -1594,6 +1941,12 @@ def get_psfoptflux_xycoords (psfex_bintable, D, S, D_mask, RON, xcoords, ycoords
        [flux_opt]; [fluxerr_opt] will contain zeros in that case, and
        PSF fitting is not performed even if [psffit]=True.
 
+       If neither [replace_satdata] nor [get_limflux] is True, the
+       cutouts of [batch_size] sources are gathered in padded 3D
+       stacks and their optimal fluxes are determined at once with
+       the function [flux_optimal_batch]; if [psffit] is True, the
+       PSF fitting is performed with [flux_psffit_batch].
+
     """
         
     log.info('Executing get_psfoptflux_xycoords ...')
@@ -1667,6 +2020,171 @@ def get_psfoptflux_xycoords (psfex_bintable, D, S, D_mask, RON, xcoords, ycoords
     # define psf_hsize
     psf_hsize = int(psf_size/2)
 
+    psf_model = PSFModel(data, header)
+    
+    # function to build the normalized PSF image at the image
+    # pixel scale for integer position [xcoord_int],[ycoord_int],
+    # shifted by [xshift],[yshift]; if [noshift] is True, the
+    # non-shifted PSF is also returned (otherwise None). The PSF image
+    # at the PSFEx sampling can be provided with [psf_ima_config].
+    def get_psf_xy (xcoord_int, ycoord_int, xshift, yshift, noshift=False,
+                    psf_ima_config=None):
+
+        if psf_ima_config is not None:
+            pass
+        elif ncoords==1 or C.use_single_psf:
+            psf_ima_config = data[0]
+        else:
+            psf_ima_config = psf_model.get_config([xcoord_int, ycoord_int])[0]
+
+        # if [psf_samp_update] is lower than unity, then perform this
+        # shift before the PSF image is re-sampled to the image
+        # pixels, as the original PSF will have higher resolution in
+        # that case
+        order = 2
+        if psf_samp_update < 1:
+            # multiply with PSF sampling to get shift in units of image
+            # pixels
+            xshift *= psf_samp_update
+            yshift *= psf_samp_update
+            # shift PSF
+            psf_ima_shift = ndimage.shift(psf_ima_config, (yshift, xshift), order=order)
+            # using Eran's function:
+            #psf_ima_shift = image_shift_fft(psf_ima_config, xshift, yshift)
+            # resample PSF image at image pixel scale
+            psf_ima_shift_resized = psf_model.resample(psf_ima_shift, psf_samp_update, order=order)
+            # also resample non-shifted PSF image at image pixel scale
+            # only required if psf-fitting is performed
+            if noshift:
+                psf_ima_resized = psf_model.resample(psf_ima_config, psf_samp_update, order=order)
+        else:
+            # resample PSF image at image pixel scale
+            psf_ima_resized = psf_model.resample(psf_ima_config, psf_samp_update, order=order)
+            # shift PSF
+            psf_ima_shift_resized = ndimage.shift(psf_ima_resized, (yshift, xshift), order=order)
+            # using Eran's function:
+            #psf_ima_shift_resized = image_shift_fft(psf_ima_resized, xshift, yshift)
+
+        # clean and normalize PSF
+        psf_shift = clean_norm_psf(psf_ima_shift_resized, C.psf_clean_factor)
+        # also return normalized PSF without any shift
+        # only required if psf-fitting is performed
+        if noshift:
+            psf_noshift = clean_norm_psf(psf_ima_resized, C.psf_clean_factor)
+        else:
+            psf_noshift = None
+
+        return psf_shift, psf_noshift
+
+
+    # the PSF lookup table contains the PSF images built with
+    # [get_psf_xy] on a grid of [C.psf_lut_npos] x [C.psf_lut_npos]
+    # field positions and ([C.psf_lut_nphase]+1)^2 subpixel shifts
+    # between -0.5 and 0.5 pixels. The PSF of a source is then
+    # obtained by bilinear interpolation in both position and shift
+    # in function [get_psf_lut]. Only use it if building the table
+    # is cheaper than building the PSF for each source.
+    if ncoords==1 or C.use_single_psf:
+        npos = 1
+    else:
+        npos = C.psf_lut_npos
+    nphase = C.psf_lut_nphase
+    use_lut = (C.psf_lut_use and not psffit and ncoords > npos**2 * (nphase+1)**2)
+
+    if use_lut:
+
+        if C.timing: t1 = time.time()
+        
+        if npos == 1:
+            xpos_lut = np.array([xsize/2.])
+            ypos_lut = np.array([ysize/2.])
+        else:
+            xpos_lut = np.linspace(1, xsize, npos)
+            ypos_lut = np.linspace(1, ysize, npos)
+        shift_lut = np.linspace(-0.5, 0.5, nphase+1)
+
+        # PSF images at the PSFEx sampling at all positions of the
+        # lookup table
+        ygrid_lut, xgrid_lut = np.meshgrid(ypos_lut.astype(int), xpos_lut.astype(int),
+                                           indexing='ij')
+        if npos == 1:
+            psf_config_lut = data[0:1]
+        else:
+            psf_config_lut = psf_model.get_config([xgrid_lut.ravel(), ygrid_lut.ravel()])
+
+        psf_lut = np.zeros((npos, npos, nphase+1, nphase+1, psf_size, psf_size),
+                           dtype='float32')
+        def fill_psf_lut (ipos):
+            iy, ix = divmod(ipos, npos)
+            for iy_shift in range(nphase+1):
+                for ix_shift in range(nphase+1):
+                    psf_lut[iy, ix, iy_shift, ix_shift], __ = get_psf_xy (
+                        int(xpos_lut[ix]), int(ypos_lut[iy]),
+                        shift_lut[ix_shift], shift_lut[iy_shift],
+                        psf_ima_config=psf_config_lut[ipos])
+
+        pool = ThreadPool(nthreads)
+        pool.map(fill_psf_lut, range(npos**2))
+        pool.close()
+        pool.join()
+
+        # helper function to determine the indices of the two grid
+        # points bracketing [value] on the regular grid [grid] and
+        # their weights for linear interpolation
+        def weights_lut (value, grid):
+            if len(grid) == 1:
+                return [0, 0], [1., 0.]
+            f = (value - grid[0]) / (grid[1] - grid[0])
+            f = min(max(f, 0), len(grid)-1)
+            i0 = min(int(f), len(grid)-2)
+            w1 = f - i0
+            return [i0, i0+1], [1.-w1, w1]
+
+        def get_psf_lut (xcoord, ycoord, xshift, yshift):
+            iy, wy = weights_lut (ycoord, ypos_lut)
+            ix, wx = weights_lut (xcoord, xpos_lut)
+            iy_shift, wy_shift = weights_lut (yshift, shift_lut)
+            ix_shift, wx_shift = weights_lut (xshift, shift_lut)
+            weights = np.einsum('i,j,k,l->ijkl', wy, wx, wy_shift, wx_shift)
+            psf_nodes = psf_lut[np.ix_(iy, ix, iy_shift, ix_shift)]
+            return np.tensordot(weights, psf_nodes, axes=4).astype('float32')
+
+        # check accuracy of lookup table against the exact PSF
+        # halfway between its nodes, where the error of the linear
+        # interpolation is largest: at all midpoints between the
+        # position nodes, each combined with midpoints between the
+        # shift nodes that cycle through the range of shifts
+        def midpoints (grid):
+            if len(grid) == 1:
+                return grid
+            return (grid[:-1] + grid[1:]) / 2.
+        ycheck, xcheck = [a.ravel() for a in np.meshgrid(midpoints(ypos_lut),
+                                                         midpoints(xpos_lut),
+                                                         indexing='ij')]
+        ncheck = len(xcheck)
+        shift_mid = midpoints(shift_lut)
+        xshift_check = shift_mid[np.arange(ncheck) % len(shift_mid)]
+        yshift_check = shift_mid[::-1][(np.arange(ncheck)//2) % len(shift_mid)]
+        psf_lut_err = 0.
+        for k in range(ncheck):
+            psf_check, __ = get_psf_xy (int(xcheck[k]), int(ycheck[k]),
+                                        xshift_check[k], yshift_check[k])
+            psf_check_lut = get_psf_lut (int(xcheck[k]), int(ycheck[k]),
+                                         xshift_check[k], yshift_check[k])
+            psf_lut_err = max(psf_lut_err, (np.amax(np.abs(psf_check_lut-psf_check)) /
+                                            np.amax(psf_check)))
+        log.info('maximum relative difference between PSF lookup table and exact PSF: {:.2e}'
+                 .format(psf_lut_err))
+        if psf_lut_err > C.psf_lut_tol:
+            log.info('Warning: PSF lookup table not accurate enough (tolerance: {}); '
+                     'using exact PSF instead'.format(C.psf_lut_tol))
+            use_lut = False
+            del psf_lut
+
+        if C.timing:
+            log_timing_memory (t0=t1, label='building PSF lookup table', log=log)
+
+            
     # previously this was a loop; now turned to a function to
     # try pool.map multithreading below
     # loop coordinates
@@ -1732,21 +2250,6 @@ def get_psfoptflux_xycoords (psfex_bintable, D, S, D_mask, RON, xcoords, ycoords
         else:
             S_sub = S[index]
 
-        # get P_shift and P_noshift
-        x = (int(xcoords[i]) - polzero1) / polscal1
-        y = (int(ycoords[i]) - polzero2) / polscal2
-
-        if ncoords==1 or C.use_single_psf:
-            psf_ima_config = data[0]
-        else:
-            if poldeg==2:
-                psf_ima_config = (data[0] + data[1] * x + data[2] * x**2 + 
-                                  data[3] * y + data[4] * x * y + data[5] * y**2)
-            elif poldeg==3:
-                psf_ima_config = (data[0] + data[1] * x + data[2] * x**2 + data[3] * x**3 +
-                                  data[4] * y + data[5] * x * y + data[6] * x**2 * y +
-                                  data[7] * y**2 + data[8] * x * y**2 + data[9] * y**3)
-
         # shift to the subpixel center of the object (object at
         # fractional pixel position 0.5,0.5 doesn't need the PSF to
         # shift if the PSF image is constructed to be even)
@@ -1756,42 +2259,19 @@ def get_psfoptflux_xycoords (psfex_bintable, D, S, D_mask, RON, xcoords, ycoords
         else:
             xshift = (xcoords[i]-int(xcoords[i])-0.5)
             yshift = (ycoords[i]-int(ycoords[i])-0.5)
-                    
-        # if [psf_samp_update] is lower than unity, then perform this
-        # shift before the PSF image is re-sampled to the image
-        # pixels, as the original PSF will have higher resolution in
-        # that case
-        order = 2
+
+        # get P_shift and P_noshift, either from the lookup table
+        # or by building it at the position of the source
+        if use_lut:
+            psf_shift = get_psf_lut (xcoords[i], ycoords[i], xshift, yshift)
+        else:
+            psf_shift, psf_noshift = get_psf_xy (int(xcoords[i]), int(ycoords[i]),
+                                                 xshift, yshift, noshift=psffit)
+
         if psf_samp_update < 1:
-            # multiply with PSF sampling to get shift in units of image
-            # pixels
+            # shift in units of image pixels applied in [get_psf_xy]
             xshift *= psf_samp_update
             yshift *= psf_samp_update
-            # shift PSF
-            psf_ima_shift = ndimage.shift(psf_ima_config, (yshift, xshift), order=order)
-            # using Eran's function:
-            #psf_ima_shift = image_shift_fft(psf_ima_config, xshift, yshift)
-            # resample PSF image at image pixel scale
-            psf_ima_shift_resized = ndimage.zoom(psf_ima_shift, psf_samp_update, order=order)
-            # also resample non-shifted PSF image at image pixel scale
-            # only required if psf-fitting is performed
-            if psffit:
-                psf_ima_resized = ndimage.zoom(psf_ima_config, psf_samp_update, order=order)
-        else:
-            # resample PSF image at image pixel scale
-            psf_ima_resized = ndimage.zoom(psf_ima_config, psf_samp_update, order=order)
-            # shift PSF
-            psf_ima_shift_resized = ndimage.shift(psf_ima_resized, (yshift, xshift), order=order)
-            # using Eran's function:
-            #psf_ima_shift_resized = image_shift_fft(psf_ima_resized, xshift, yshift)
-
-
-        # clean and normalize PSF
-        psf_shift = clean_norm_psf(psf_ima_shift_resized, C.psf_clean_factor)
-        # also return normalized PSF without any shift
-        # only required if psf-fitting is performed
-        if psffit:
-            psf_noshift = clean_norm_psf(psf_ima_resized, C.psf_clean_factor)
 
         # extract subsection from psf_shift and psf_noshift
         y1_P = y1 - (ypos - psf_hsize)
@@ -1804,6 +2284,20 @@ def get_psfoptflux_xycoords (psfex_bintable, D, S, D_mask, RON, xcoords, ycoords
         # only required if psf-fitting is performed
         if psffit:
             P_noshift = psf_noshift[index_P]
+
+        if use_batch:
+            # add cutouts to the padded stacks defined below and leave
+            # the optimal flux determination to [flux_optimal_batch]
+            j = i - batch_stacks['i_start']
+            batch_stacks['P'][j][index_P] = P_shift
+            batch_stacks['D'][j][index_P] = D_sub
+            batch_stacks['S'][j][index_P] = S_sub
+            batch_stacks['mask_use'][j][index_P] = (D_mask_sub==0)
+            if psffit:
+                batch_stacks['P_noshift'][j][index_P] = P_noshift
+                batch_stacks['xshift'][j] = xshift
+                batch_stacks['yshift'][j] = yshift
+            return
         
         if get_limflux:
             # determine limiting flux at this position using flux_optimal_s2n
@@ -1836,8 +2330,8 @@ def get_psfoptflux_xycoords (psfex_bintable, D, S, D_mask, RON, xcoords, ycoords
                 # (P_noshift) to the exact source position.  Redefine
                 # them here with respect to the fractional coordinates
                 # xcoords and ycoords
-                xshift_psf[i] += xshift
-                yshift_psf[i] += yshift
+                xshift_psf[i] -= xshift
+                yshift_psf[i] -= yshift
                         
                 #print 'i, flux_opt[i], fluxerr_opt[i], flux_psf[i], fluxerr_psf[i]',\
                     #    i, flux_opt[i], fluxerr_opt[i], flux_psf[i], fluxerr_psf[i]
@@ -1867,9 +2361,51 @@ def get_psfoptflux_xycoords (psfex_bintable, D, S, D_mask, RON, xcoords, ycoords
                                             maskopt=mask_use.astype(int), S_sub=S_sub, P=P_shift,
                                             D_replaced=D[index])
 
+    # the optimal fluxes are determined for batches of [batch_size]
+    # sources at the same time with [flux_optimal_batch], and if
+    # [psffit] is True, the PSF fitting with [flux_psffit_batch];
+    # limiting fluxes and the replacement of saturated pixels are
+    # done per source
+    use_batch = (batch_size > 1 and not get_limflux and not replace_satdata)
+
     if C.timing: t1 = time.time()
     pool = ThreadPool(nthreads)
-    pool.map(loop_psfoptflux_xycoords, range(ncoords), chunksize=1000)
+    if use_batch:
+        batch_stacks = {}
+        for i_start in range(0, ncoords, batch_size):
+            i_stop = min(i_start+batch_size, ncoords)
+            nbatch = i_stop - i_start
+            shape_stack = (nbatch, psf_size, psf_size)
+            batch_stacks['i_start'] = i_start
+            batch_stacks['P'] = np.zeros(shape_stack, dtype='float32')
+            batch_stacks['D'] = np.zeros(shape_stack, dtype='float32')
+            batch_stacks['S'] = np.zeros(shape_stack, dtype='float32')
+            batch_stacks['mask_use'] = np.zeros(shape_stack, dtype=bool)
+            if psffit:
+                batch_stacks['P_noshift'] = np.zeros(shape_stack, dtype='float32')
+                batch_stacks['xshift'] = np.zeros(nbatch)
+                batch_stacks['yshift'] = np.zeros(nbatch)
+            pool.map(loop_psfoptflux_xycoords, range(i_start, i_stop), chunksize=1000)
+            index_batch = slice(i_start, i_stop)
+            # the final mask of [flux_optimal_batch] is also used in
+            # the PSF fitting, as in the per-source loop above
+            flux_opt[index_batch], fluxerr_opt[index_batch], batch_stacks['mask_use'] = (
+                flux_optimal_batch (batch_stacks['P'], batch_stacks['D'], batch_stacks['S'],
+                                    RON, mask_use=batch_stacks['mask_use'], log=log))
+            if psffit:
+                (flux_psf[index_batch], fluxerr_psf[index_batch], xshift_psf[index_batch],
+                 yshift_psf[index_batch], chi2_psf[index_batch]) = (
+                     flux_psffit_batch (batch_stacks['P_noshift'], batch_stacks['D'],
+                                        batch_stacks['S'], RON, flux_opt[index_batch],
+                                        batch_stacks['xshift'], batch_stacks['yshift'],
+                                        mask_use=batch_stacks['mask_use'], log=log))
+                # shifts with respect to [xcoords] and [ycoords]; see
+                # also the per-source PSF fitting above
+                xshift_psf[index_batch] -= batch_stacks['xshift']
+                yshift_psf[index_batch] -= batch_stacks['yshift']
+        del batch_stacks
+    else:
+        pool.map(loop_psfoptflux_xycoords, range(ncoords), chunksize=1000)
     pool.close()
     pool.join()
     if C.verbose: log.info('ncoords: {}'.format(ncoords))
@@ -1957,6 +2493,106 @@ def flux_psffit(P, D, S, RON, flux_opt, xshift, yshift, mask_use=None, log=None)
         result.params['xshift'].value, result.params['yshift'].value, chi2_red
     
 
+################################################################################
+
+def flux_psffit_batch (P, D, S, RON, flux_opt, xshift, yshift, mask_use=None,
+                       niters=10, log=None):
+
+    """Function that fits the flux and position of a batch of sources,
+    similar to function [flux_psffit] for a single source, but
+    vectorised across the sources. [P], [D] and [S] are 3D arrays
+    with shape (number of sources, ysize, xsize) containing the
+    cutouts of the non-shifted PSF, data and sky ([S] can also be a
+    scalar), [RON] is the read-out noise and [mask_use] is a boolean
+    array with the same shape indicating the pixels to use. [flux_opt],
+    [xshift] and [yshift] are the initial values of the flux and the
+    shift of the PSF with respect to the cutout center. The PSF is
+    shifted in the Fourier domain, which also provides the analytic
+    derivatives of the shifted PSF with respect to the shifts, and
+    [niters] Levenberg-Marquardt steps are performed for all sources
+    at once. As in [flux_psffit], the flux is required to be
+    non-negative and the shifts to be within +-2 pixels. Returns the
+    fitted flux, its error, x- and y-shift and the reduced chi2.
+
+    """
+
+    if C.timing: t = time.time()
+    
+    nsrc = P.shape[0]
+    if np.isscalar(S):
+        S = S * np.ones(P.shape, dtype='float32')
+    if mask_use is None:
+        mask_use = np.ones(D.shape, dtype=bool)
+    npix = np.sum(mask_use.reshape(nsrc,-1), axis=1)
+        
+    # Fourier transform of the PSFs and the frequencies
+    P_fft = fft.fft2(P, axes=(1,2), threads=nthreads)
+    ky = np.fft.fftfreq(P.shape[1]).reshape(1,-1,1)
+    kx = np.fft.fftfreq(P.shape[2]).reshape(1,1,-1)
+
+    # function to evaluate the chi2 and the (Levenberg-Marquardt)
+    # normal equations of the fit at parameters [params], which is
+    # an array with shape (nsrc, 3) containing flux, xshift and
+    # yshift
+    def eval_fit (params):
+        flux = params[:,0].reshape(-1,1,1)
+        phase = np.exp(-2j*np.pi*(kx*params[:,1].reshape(-1,1,1) +
+                                  ky*params[:,2].reshape(-1,1,1)))
+        P_shift = np.real(fft.ifft2(P_fft*phase, axes=(1,2), threads=nthreads))
+        dPdx = np.real(fft.ifft2(P_fft*phase*(-2j*np.pi*kx), axes=(1,2), threads=nthreads))
+        dPdy = np.real(fft.ifft2(P_fft*phase*(-2j*np.pi*ky), axes=(1,2), threads=nthreads))
+        model = flux * P_shift
+        # variance from the model, as in [flux_psffit]
+        var = RON**2 + model + S
+        mask_neg = (var <= 0)
+        var[mask_neg] = RON**2 + D[mask_neg]
+        weights = np.zeros(P.shape)
+        mask_ok = (mask_use & (var > 0))
+        weights[mask_ok] = 1./var[mask_ok]
+        resid = D - S - model
+        chi2 = np.sum((weights*resid**2).reshape(nsrc,-1), axis=1)
+        # Jacobian of the model with respect to flux, xshift and yshift
+        jac = np.stack([P_shift, flux*dPdx, flux*dPdy], axis=1).reshape(nsrc,3,-1)
+        weights = weights.reshape(nsrc,1,-1)
+        alpha = np.einsum('nip,njp->nij', jac*weights, jac)
+        beta = np.einsum('nip,np->ni', jac*weights, resid.reshape(nsrc,-1))
+        return chi2, alpha, beta
+
+    params = np.stack([np.maximum(flux_opt, 0.),
+                       np.clip(xshift, -2, 2), np.clip(yshift, -2, 2)], axis=1)
+    chi2, alpha, beta = eval_fit (params)
+    lambda_lm = np.full(nsrc, 1e-3)
+    for i in range(niters):
+        # damped normal equations
+        alpha_lm = alpha + (lambda_lm.reshape(-1,1,1) *
+                            alpha*np.eye(3).reshape(1,3,3))
+        delta = np.einsum('nij,nj->ni', np.linalg.pinv(alpha_lm), beta)
+        params_new = params + delta
+        params_new[:,0] = np.maximum(params_new[:,0], 0.)
+        params_new[:,1:] = np.clip(params_new[:,1:], -2, 2)
+        chi2_new, alpha_new, beta_new = eval_fit (params_new)
+        # accept the steps that improve chi2 and decrease damping;
+        # increase damping for the others
+        mask_acc = (chi2_new <= chi2)
+        params[mask_acc] = params_new[mask_acc]
+        chi2[mask_acc] = chi2_new[mask_acc]
+        alpha[mask_acc] = alpha_new[mask_acc]
+        beta[mask_acc] = beta_new[mask_acc]
+        lambda_lm = np.where(mask_acc, lambda_lm/10., lambda_lm*10.)
+
+    # flux error from covariance matrix, scaled with the reduced chi2
+    # similar to lmfit
+    covar = np.linalg.pinv(alpha)
+    dof = np.maximum(npix-3, 1)
+    fluxerr = np.sqrt(np.abs(covar[:,0,0]) * chi2 / dof)
+    chi2_red = chi2 / np.maximum(npix, 1)
+
+    if C.timing:
+        log_timing_memory (t0=t, label='flux_psffit_batch', log=log)
+        
+    return params[:,0], fluxerr, params[:,1], params[:,2], chi2_red
+    
+
 ################################################################################
 
 def get_optflux (P, D, S, V):
@@ -2140,6 +2776,110 @@ def flux_optimal (P, D, S, RON, nsigma_inner=10, P_noshift=None,
     return flux_opt, fluxerr_opt
     
 
+################################################################################
+
+def flux_optimal_batch (P, D, S, RON, mask_use=None, nsigma_inner=10,
+                        nsigma_outer=5, max_iters=10, log=None):
+
+    """Function that calculates the optimal fluxes and corresponding
+    errors of a batch of sources, in the same way as function
+    [flux_optimal] does for a single source, but vectorised across
+    the sources. [P], [D] and [S] are 3D arrays with shape (number of
+    sources, ysize, xsize) containing the cutouts of the PSF, data and
+    sky, where [S] can also be a scalar, and [RON] is the read-out
+    noise. The boolean array [mask_use] with the same shape indicates
+    the pixels that can be used; cutouts that are smaller than the
+    stack (e.g. sources near the image edge) should be padded with
+    zeros in [P] and with False in [mask_use]. The iterative
+    variance, flux and rejection updates are performed for all
+    sources that have not converged yet, until all have converged or
+    [max_iters] is reached. Besides the fluxes and errors, the final
+    [mask_use] is returned, i.e. without the negative pixels and the
+    rejected outliers, as [flux_optimal] does for a single source by
+    updating its input mask.
+
+    """
+
+    if C.timing: t = time.time()
+    
+    nsrc = P.shape[0]
+    if np.isscalar(S):
+        S = S * np.ones(P.shape, dtype='float32')
+
+    if mask_use is None:
+        mask_use = np.ones(D.shape, dtype=bool)
+    else:
+        mask_use = np.copy(mask_use)
+    # do not use any negative pixel values in D
+    mask_use &= (D >= 0)
+
+    # [mask_inner] - the central pixels of each source where P
+    # values are higher than 0.25 of the central P value
+    P_max = np.amax(P.reshape(nsrc,-1), axis=1).reshape(nsrc,1,1)
+    mask_inner = (P >= 0.25*P_max)
+    # squared rejection threshold for each pixel
+    nsigma2_reject = np.where(mask_inner, nsigma_inner**2, nsigma_outer**2)
+    
+    flux_opt = np.zeros(nsrc)
+    fluxerr_opt = np.zeros(nsrc)
+    flux_opt_old = np.full(nsrc, np.inf)
+
+    # indices of sources that have not converged yet
+    index_todo = np.arange(nsrc)
+    for i in range(max_iters):
+
+        P_todo = P[index_todo]
+        D_todo = D[index_todo]
+        S_todo = S[index_todo]
+        mask_todo = mask_use[index_todo]
+        
+        if i==0:
+            # initial variance estimate (see Eq. 12 from Horne 1986)
+            V = RON**2 + D_todo
+        else:
+            # improved variance (see Eq. 13 from Horne 1986)
+            V = (RON**2 + S_todo +
+                 flux_opt[index_todo].reshape(-1,1,1) * P_todo)
+
+        # optimal flux, similar to [get_optflux]; pixels that are not
+        # used are set to zero to avoid non-finite values
+        P_over_V = np.where(mask_todo, P_todo/np.where(mask_todo, V, 1.), 0.)
+        D_min_S = np.where(mask_todo, D_todo-S_todo, 0.)
+        denominator = np.sum((P_over_V * P_todo).reshape(len(index_todo),-1), axis=1)
+        numerator = np.sum((P_over_V * D_min_S).reshape(len(index_todo),-1), axis=1)
+        mask_nonzero = (denominator != 0)
+        flux_todo = np.zeros(len(index_todo))
+        fluxerr_todo = np.zeros(len(index_todo))
+        flux_todo[mask_nonzero] = numerator[mask_nonzero] / denominator[mask_nonzero]
+        fluxerr_todo[mask_nonzero] = 1./np.sqrt(denominator[mask_nonzero])
+        flux_opt[index_todo] = flux_todo
+        fluxerr_opt[index_todo] = fluxerr_todo
+
+        # stopping criteria identical to those in [flux_optimal]
+        mask_done = ~mask_nonzero
+        mask_done[mask_nonzero] = (np.abs(flux_opt_old[index_todo][mask_nonzero]-
+                                          flux_todo[mask_nonzero])
+                                   / fluxerr_todo[mask_nonzero] < 0.1)
+        flux_opt_old[index_todo] = flux_todo
+
+        # reject any discrepant values of the sources that have not
+        # converged yet
+        mask_cont = ~mask_done
+        index_cont = index_todo[mask_cont]
+        if len(index_cont) == 0:
+            break
+        
+        sigma2 = ((D_todo[mask_cont] - flux_todo[mask_cont].reshape(-1,1,1) *
+                   P_todo[mask_cont] - S_todo[mask_cont])**2 / V[mask_cont])
+        mask_use[index_cont] &= ~(sigma2 > nsigma2_reject[index_cont])
+        index_todo = index_cont
+
+    if C.timing:
+        log_timing_memory (t0=t, label='flux_optimal_batch', log=log)
+        
+    return flux_opt, fluxerr_opt, mask_use
+    
+
 ################################################################################
 
 def flux_optimal_s2n (P, S, RON, s2n, fwhm=5., max_iters=10, epsilon=1e-6):
@@ -2173,14 +2913,87 @@ def flux_optimal_s2n (P, S, RON, s2n, fwhm=5., max_iters=10, epsilon=1e-6):
         # new estimate of D
         D = S + flux_opt * P
 
-        # get optimal flux
-        flux_opt, fluxerr_opt = get_optflux(P, D, S, V)
+        # get optimal flux
+        flux_opt, fluxerr_opt = get_optflux(P, D, S, V)
+
+        # break out of loop if S/N sufficiently close
+        if abs(flux_opt/fluxerr_opt - s2n) / s2n < epsilon:
+            break
+        
+    return flux_opt
+    
+
+################################################################################
+
+def get_limflux_map (psf, centers, S, RON, nsigma, shape, log, boxsize=None,
+                     max_iters=10, epsilon=1e-6):
+
+    """Function that returns a map of the [nsigma] limiting flux,
+    i.e. the total flux required for a point source to be detected
+    with a signal-to-noise ratio of [nsigma] using optimal
+    extraction, on a grid of boxes with size [boxsize] (default:
+    [C.limflux_boxsize]) covering the image with shape [shape]. For
+    each grid point this is the same as what function
+    [flux_optimal_s2n] returns, but evaluated for all grid points at
+    once. [psf] is the cube of normalized PSF images at the
+    subimage [centers] (as returned by [get_psf] and
+    [centers_cutouts], respectively); for each grid point the PSF of
+    the nearest subimage is used. The sky background [S] can be a
+    [BackgroundModel], a 2D array with shape [shape] or a scalar, and
+    [RON] is the read-out noise.
+
+    """
+
+    if C.timing: t = time.time()
+    log.info('Executing get_limflux_map ...')
+
+    if boxsize is None:
+        boxsize = C.limflux_boxsize
+    
+    # grid of box centers
+    ysize, xsize = shape
+    ny = max(1, int(ysize/boxsize))
+    nx = max(1, int(xsize/boxsize))
+    ygrid = ((np.arange(ny)+0.5) * ysize/ny).astype(int)
+    xgrid = ((np.arange(nx)+0.5) * xsize/nx).astype(int)
+    yy, xx = np.meshgrid(ygrid, xgrid, indexing='ij')
+    yy = yy.ravel()
+    xx = xx.ravel()
+    npoints = len(yy)
+
+    # PSF of the nearest subimage
+    dist2 = ((yy.reshape(-1,1) - centers[:,0])**2 +
+             (xx.reshape(-1,1) - centers[:,1])**2)
+    P = psf[np.argmin(dist2, axis=1)].astype('float64')
+    psf_size = P.shape[-1]
+
+    # background at the pixels of the PSF footprints
+    offsets = np.arange(psf_size) - int(psf_size/2)
+    ypix = (yy.reshape(-1,1,1) + offsets.reshape(1,-1,1)) * np.ones(P.shape, dtype=int)
+    xpix = (xx.reshape(-1,1,1) + offsets.reshape(1,1,-1)) * np.ones(P.shape, dtype=int)
+    if isinstance(S, BackgroundModel):
+        S_grid = S.at('bkg', ypix, xpix).astype('float64')
+    elif np.isscalar(S):
+        S_grid = S
+    else:
+        S_grid = S[np.clip(ypix, 0, ysize-1), np.clip(xpix, 0, xsize-1)].astype('float64')
 
-        # break out of loop if S/N sufficiently close
-        if abs(flux_opt/fluxerr_opt - s2n) / s2n < epsilon:
+    # iterate until the optimal flux error implies S/N=[nsigma]; see
+    # also function [flux_optimal_s2n]
+    V = RON**2 + S_grid + np.zeros(P.shape)
+    fluxerr = 1./np.sqrt(np.sum((P**2/V).reshape(npoints,-1), axis=1))
+    limflux = nsigma * fluxerr
+    for i in range(max_iters):
+        V = RON**2 + S_grid + limflux.reshape(-1,1,1) * P
+        fluxerr = 1./np.sqrt(np.sum((P**2/V).reshape(npoints,-1), axis=1))
+        if np.all(np.abs(limflux/fluxerr - nsigma) / nsigma < epsilon):
             break
-        
-    return flux_opt
+        limflux = nsigma * fluxerr
+
+    if C.timing:
+        log_timing_memory (t0=t, label='get_limflux_map', log=log)
+
+    return limflux.reshape(ny, nx)
     
 
 ################################################################################
@@ -2337,21 +3150,17 @@ def prep_optimal_subtraction(input_fits, nsubs, imtype, fwhm, header, log,
         base = base_ref
 
     # read in input_fits header
-    data_wcs, header_wcs = read_hdulist (input_fits, ext_data=0, ext_header=0,
-                                         dtype='float32')
+    data_wcs, header_wcs = read_wcs_image (input_fits, dtype='float32')
 
     # get gain, readnoise, pixscale and saturation level from header
     keywords = ['gain', 'ron', 'pixscale', 'satlevel']
     gain, readnoise, pixscale, satlevel = read_header(header, keywords, log)
     ysize, xsize = np.shape(data_wcs)
         
-    # read in background image
-    fits_bkg = base+'_bkg.fits'
-    data_bkg = read_hdulist (fits_bkg, ext_data=0, dtype='float32')
-    
-    # read in background std image
-    fits_bkg_std = base+'_bkg_std.fits'
-    data_bkg_std = read_hdulist (fits_bkg_std, ext_data=0, dtype='float32')
+    # read in background and its standard deviation as a
+    # [BackgroundModel], which only evaluates the background for the
+    # pixels that are requested rather than the full image
+    data_bkg = read_bkg_model (base, (ysize, xsize), log)
 
     # function to create a minimal mask of saturated pixels and the
     # adjacent pixels from input data, in case mask image is not
@@ -2381,11 +3190,16 @@ def prep_optimal_subtraction(input_fits, nsubs, imtype, fwhm, header, log,
 
         # the reference background maps and mask need to be projected
         # to the coordinate frame of the new or remapped reference
-        # image. At the moment this is done with swarp, but this is a
-        # very slow solution. Tried to improve this using functions
-        # [xy_index_ref] and [get_data_remap] (see older zogy
-        # versions), but these fail when there is rotation between the
-        # images, resulting in rotated masks.
+        # image. For the background model this is done through the
+        # WCS transformation between the images (see
+        # [BackgroundModel.remap]); for the mask this is done with
+        # swarp, but this is a very slow solution. Tried to improve
+        # this using functions [xy_index_ref] and [get_data_remap]
+        # (see older zogy versions), but these fail when there is
+        # rotation between the images, resulting in rotated masks.
+        header_new_wcs = read_wcs_image (base_new+'_wcs.fits', read_data=False)
+        data_ref_bkg_remap = data_bkg.remap(header_wcs, header_new_wcs,
+                                            data_ref_remap.shape)
 
         use_swarp = True
         if use_swarp:
@@ -2406,10 +3220,6 @@ def prep_optimal_subtraction(input_fits, nsubs, imtype, fwhm, header, log,
                 data_remapped = read_hdulist (fits_out, ext_data=0)
                 return data_remapped
                 
-            # remap reference image background
-            data_ref_bkg_remap = run_swarp(fits_bkg, data_bkg)
-            # remap reference image background std
-            data_ref_bkg_std_remap = run_swarp(fits_bkg_std, data_bkg_std)
             # remap reference mask image if it exists
             if fits_mask is not None:
                 # SWarp turns integer mask into float during processing,
@@ -2424,15 +3234,13 @@ def prep_optimal_subtraction(input_fits, nsubs, imtype, fwhm, header, log,
     # convert counts to electrons
     satlevel *= gain
     data_wcs *= gain
-    data_bkg *= gain
-    data_bkg_std *= gain
+    data_bkg.scale(gain)
     # fix pixels using function [fixpix]
     fixpix (data_wcs, data_bkg, log, satlevel=satlevel, data_mask=data_mask)
 
     if ref_fits_remap is not None:
         data_ref_remap *= gain
-        data_ref_bkg_remap *= gain
-        data_ref_bkg_std_remap *= gain
+        data_ref_bkg_remap.scale(gain)
         # fix pixels using function [fixpix] also in remapped reference image
         fixpix (data_ref_remap, data_ref_bkg_remap, log, satlevel=satlevel,
                 data_mask=data_ref_remap_mask)
@@ -2446,13 +3254,16 @@ def prep_optimal_subtraction(input_fits, nsubs, imtype, fwhm, header, log,
 
     # add header keyword(s) regarding background
     # pre-fixed with S as background is produced in SExtractor module
-    bkg_mean, bkg_std, bkg_median = clipped_stats(data_bkg, nsigma=10., log=log)
+    # the statistics are determined from the background values
+    # on which the model is based, i.e. the filtered meshes in case
+    # of [C.bkg_method]=2
+    bkg_mean, bkg_std, bkg_median = clipped_stats(data_bkg.values(), nsigma=10., log=log)
     header['S-BKG'] = (bkg_median, '[e-] median background full image')
     header['S-BKGSTD'] = (bkg_std, '[e-] sigma (STD) background full image')
 
     # determine psf of input image with get_psf function - needs to be
     # done before optimal fluxes are determined
-    psf, psf_orig = get_psf(input_fits, header, nsubs, imtype, fwhm, pixscale, log)
+    psf = get_psf(input_fits, header, nsubs, imtype, fwhm, pixscale, log)
 
     # -------------------------------
     # determination of optimal fluxes
@@ -2463,7 +3274,7 @@ def prep_optimal_subtraction(input_fits, nsubs, imtype, fwhm, header, log,
 
     # [mypsffit] determines if PSF-fitting part is also performed;
     # this is different from SExtractor PSF-fitting
-    mypsffit = False
+    mypsffit = C.psffit
 
     newcat = base+'_cat_fluxopt.fits'
     if not os.path.isfile(newcat) or C.redo:
@@ -2497,26 +3308,22 @@ def prep_optimal_subtraction(input_fits, nsubs, imtype, fwhm, header, log,
                                          satlevel=satlevel, replace_satdata=False, log=log)
             )
             
-        # determine 5-sigma limiting flux using
-        # [get_psfoptflux_xycoords] with [get_limflux]=True for random
-        # coordinates across the field
-        nlimits = 101
-        edge = 100
-        xlim = np.random.rand(nlimits)*(xsize-2*edge) + edge
-        ylim = np.random.rand(nlimits)*(ysize-2*edge) + edge
+        # determine 3- and 5-sigma limiting flux on a grid of boxes
+        # across the field using [get_limflux_map], with the PSFs at
+        # the subimage centers and the background model
+        centers, __, __, __, __ = centers_cutouts(C.subimage_size, ysize, xsize, log)
         def calc_limflux (nsigma):
-            # '__' is to disregard the 2nd output array from [get_psfoptflux_xycoords]
-            limflux_array, __ = get_psfoptflux_xycoords (psfex_bintable, data_wcs, data_bkg, data_mask,
-                                                         readnoise, xlim, ylim, satlevel=satlevel,
-                                                         get_limflux=True, limflux_nsigma=nsigma, log=log)
-            limflux_mean, limflux_std, limflux_median = clipped_stats(limflux_array, log=log)
+            limflux_map = get_limflux_map (psf, centers, data_bkg, readnoise, nsigma,
+                                           (ysize, xsize), log)
+            limflux_mean, limflux_std, limflux_median = clipped_stats(limflux_map.ravel(),
+                                                                      log=log)
             if C.verbose:
                 log.info('{}-sigma limiting flux; mean: {}, std: {}, median: {}'
                          .format(nsigma, limflux_mean, limflux_std, limflux_median))
-            return limflux_median
+            return limflux_median, limflux_map
 
-        limflux_3sigma = calc_limflux (3.)
-        limflux_5sigma = calc_limflux (5.)
+        limflux_3sigma, __ = calc_limflux (3.)
+        limflux_5sigma, limflux_5sigma_map = calc_limflux (5.)
 
         # add header keyword(s):
         mask_neg = (flux_opt < 0.)
@@ -2548,7 +3355,7 @@ def prep_optimal_subtraction(input_fits, nsubs, imtype, fwhm, header, log,
         if os.path.isfile(C.cal_cat):
             
             # use WCS solution in input [header] to get RA, DEC of central pixel
-            wcs = WCS(header)
+            wcs = wcs_transform(header)
             ra_center, dec_center = wcs.all_pix2world(xsize/2, ysize/2, 1)
             log.info('ra_center: {}, dec_center: {}'.format(ra_center, dec_center))
 
@@ -2560,81 +3367,18 @@ def prep_optimal_subtraction(input_fits, nsubs, imtype, fwhm, header, log,
             # not defined; if [C.cal_cat] exists, [data_cal] should
             # have been already produced by [run_wcs] so that it can
             # be re-used here.
+            # read the calibration stars in the field-of-view and
+            # select the ones suitable for the calibration of filter
+            # [filt] with function [read_cal_cat], which keeps the
+            # selections in the in-process cache [cal_cache]; if
+            # [data_cal] was provided by [run_wcs], only the latter
+            # selection is needed, using function [filter_cal_cat]
             if data_cal is None:
-                # determine cal_cat fits extensions to read using
-                # [get_ext_list] (each 1 degree strip in declination is
-                # recorded in its own extension in the calibration catalog)
                 fov_half_deg = np.amax([xsize, ysize]) * pixscale / 3600. / 2
-                ext_list = get_ext_list (dec_center, fov_half_deg, zone_size=60.)
-                #print 'dec_center: {}, ext_list: {}'.format(dec_center, ext_list)
-
-                # read calibration catalog
-                data_cal = read_hdulist (C.cal_cat, ext_data=ext_list)
-
-                # use function [find_stars] to select stars in calibration
-                # catalog that are within the current field-of-view
-                mask_field = find_stars(data_cal['ra'], data_cal['dec'], ra_center, dec_center,
-                                        fov_half_deg, log)
-                index_field = np.where(mask_field)[0]
-                data_cal = data_cal[index_field]
-
-            ncalstars = np.shape(data_cal)[0]
-            log.info('number of photometric stars in FOV: {}'.format(ncalstars))
-
-            # test: limit calibration catalog entries
-            if 'chi2' in data_cal.dtype.names:
-                mask_cal = (data_cal['chi2'] <= 10.)
-                #data_cal = data_cal[:][mask_cal]
-                data_cal = data_cal[mask_cal]
-
-            ncalstars = np.shape(data_cal)[0]
-            log.info('number of photometric stars in FOV after chi2 cut: {}'.format(ncalstars))
-
-            # requirements on presence of survey input filters for the
-            # calibration of a ML/BG filter:
-            #u: Gaia and (GALEX NUV or SM u or SM v or SDSS u)
-            #g: Gaia and (GALEX NUV or SM u or SM v or SDSS u or SDSS g)
-            #q: Gaia and (GALEX NUV or SM u or SM v or SDSS u or SDSS g or PS1 g or SM g)
-            #r: Gaia: 0
-            #i: Gaia and (2MASS J or PS1 z or PS1 y or SDSS z or SM z): 0
-            #z: Gaia and (2MASS J or PS1 y): 0
-
-            # prepare [filt_req] dictionary
-            filt_req = {}
-            # these filters are required for all filters, boolean AND
-            filt_req['all'] = ['Gaia2r_G', 'Gaia2r_Gbp', 'Gaia2r_Grp', '2MASS_J']
-            # these filters are required for specific filters, boolean OR
-            filt_req['u'] = ['GALEX_NUV', 'SM_u', 'SM_v', 'SDSS_u']
-            filt_req['g'] = ['GALEX_NUV', 'SM_u', 'SM_v', 'SDSS_u', 'SDSS_g']
-            filt_req['q'] = ['GALEX_NUV', 'SM_u', 'SM_v', 'SDSS_u', 'SDSS_g', 'PS1_g', 'SM_g']
-            filt_req['i'] = ['PS1_z', 'PS1_y', 'SDSS_z', 'SM_z']
-            filt_req['z'] = ['PS1_y']
-
-            mask_cal = np.all([data_cal[col] for col in filt_req['all']], axis=0)
-            data_cal = data_cal[mask_cal]
-            
-            if filt in filt_req.keys():
-                mask_cal = np.any([data_cal[col] for col in filt_req[filt]], axis=0)
-                # if less than [C.phot_ncal_min] stars left, drop filter requirements and hope for the best!
-                if np.sum(mask_cal) >= C.phot_ncal_min:
-                    data_cal = data_cal[mask_cal]
-                else:
-                    log.info('Warning: less than {} calibration stars with default filter requirements'.
-                             format(C.phot_ncal_min))
-                    log.info('filter: {}, requirements (any of these): {}'.format(filt, filt_req[filt]))
-
+                data_cal = read_cal_cat (ra_center, dec_center, fov_half_deg, log, filt=filt)
+            else:
+                data_cal = filter_cal_cat (data_cal, filt, log)
             ncalstars = np.shape(data_cal)[0]
-            log.info('number of photometric stars in FOV after filter cut: {}'.format(ncalstars))
-
-            # pick only main sequence stars
-            if False:
-                if 'spectype' in data_cal.dtype.names:
-                    mask_cal = ['V' in data_cal['spectype'][i] and
-                                'IV' not in data_cal['spectype'][i] and
-                                'M' not in data_cal['spectype'][i]
-                                for i in range(np.shape(data_cal)[0])]
-                    #data_cal = data_cal[:][mask_cal]
-                    data_cal = data_cal[mask_cal]
                 
             # add header keyword(s):
             cal_name = C.cal_cat.split('/')[-1]
@@ -2685,6 +3429,15 @@ def prep_optimal_subtraction(input_fits, nsubs, imtype, fwhm, header, log,
         #limmag_5sigma = zp-2.5*np.log10(limflux_5sigma/exptime)-airmass_sex_median*C.ext_coeff[filt]
         [limmag_5sigma] = apply_zp([limflux_5sigma], zp, airmass_sex_median, exptime, filt, log)
         log.info('5-sigma limiting magnitude: {}'.format(limmag_5sigma))
+
+        # save map of 5-sigma limiting magnitude
+        if C.save_limmag_map:
+            limmag_map = apply_zp(limflux_5sigma_map.ravel(), zp, airmass_sex_median,
+                                  exptime, filt, log)
+            limmag_map = np.array(limmag_map).reshape(limflux_5sigma_map.shape)
+            fits.writeto(base+'_limmag.fits', limmag_map.astype('float32'), overwrite=True)
+            # update header with box size of grid
+            fits.setval(base+'_limmag.fits', 'LIM_SIZE', value=C.limflux_boxsize)
         
         # add header keyword(s):
         header['PC-P'] = (True, 'successfully processed by phot. calibration?')
@@ -2703,6 +3456,11 @@ def prep_optimal_subtraction(input_fits, nsubs, imtype, fwhm, header, log,
         data_sex = append_fields(data_sex, ['MAG_OPT','MAGERR_OPT'] ,
                                  [mag_opt, magerr_opt], usemask=False, asrecarray=True)
 
+        if mypsffit:
+            data_sex = append_fields(data_sex, ['FLUX_PSF','FLUXERR_PSF','X_PSF','Y_PSF'] ,
+                                     [flux_psf, fluxerr_psf, x_psf, y_psf],
+                                     usemask=False, asrecarray=True)
+
         # write updated catalog to file
         fits.writeto(newcat, data_sex, overwrite=True)
                         
@@ -2723,7 +3481,6 @@ def prep_optimal_subtraction(input_fits, nsubs, imtype, fwhm, header, log,
     if ref_fits_remap is not None:
         data = data_ref_remap
         data_bkg = data_ref_bkg_remap
-        data_bkg_std = data_ref_bkg_std_remap
         data_mask = data_ref_remap_mask
     else:
         data = data_wcs
@@ -2740,8 +3497,8 @@ def prep_optimal_subtraction(input_fits, nsubs, imtype, fwhm, header, log,
         subcutfft = cuts_ima_fft[nsub]
         index_fftdata = [slice(subcutfft[0],subcutfft[1]), slice(subcutfft[2],subcutfft[3])]
         fftdata[nsub][index_fft] = data[index_fftdata]
-        fftdata_bkg[nsub][index_fft] = data_bkg[index_fftdata]
-        fftdata_bkg_std[nsub][index_fft] = data_bkg_std[index_fftdata]
+        fftdata_bkg[nsub][index_fft] = data_bkg.get('bkg', index_fftdata)
+        fftdata_bkg_std[nsub][index_fft] = data_bkg.get_std(index_fftdata)
         fftdata_mask[nsub][index_fft] = data_mask[index_fftdata]
 
     if C.timing:
@@ -2765,8 +3522,8 @@ def prep_optimal_subtraction(input_fits, nsubs, imtype, fwhm, header, log,
                 mag_opt = data_sex['MAG_OPT']
                 magerr_opt = data_sex['MAGERR_OPT']
             if mypsffit:
-                flux_mypsf = data_sex['FLUX_PSF']
-                fluxerr_mypsf = data_sex['FLUXERR_PSF']
+                flux_psf = data_sex['FLUX_PSF']
+                fluxerr_psf = data_sex['FLUXERR_PSF']
                 x_psf = data_sex['X_PSF']
                 y_psf = data_sex['Y_PSF']
             # read a few extra header keywords needed below
@@ -2912,11 +3669,10 @@ def prep_optimal_subtraction(input_fits, nsubs, imtype, fwhm, header, log,
     #if C.verbose:
     #    log.info('fftdata.dtype {}'.format(fftdata.dtype))
     #    log.info('psf.dtype {}'.format(psf.dtype))
-    #    log.info('psf_orig.dtype {}'.format(psf_orig.dtype))
     #    log.info('fftdata_bkg.dtype {}'.format(fftdata_bkg.dtype))
     #    log.info('fftdata_bkg_std.dtype {}'.format(fftdata_bkg_std.dtype))
     
-    return fftdata, psf, psf_orig, fftdata_bkg, fftdata_bkg_std, fftdata_mask
+    return fftdata, psf, fftdata_bkg, fftdata_bkg_std, fftdata_mask
     
 
 ################################################################################
@@ -2955,38 +3711,34 @@ def get_zp (ra_sex, dec_sex, airmass_sex, flux_opt, fluxerr_opt,
     mag_cal = mag_cal[index_sort]
     magerr_cal = magerr_cal[index_sort]
 
-    ncal = np.shape(ra_cal)[0]
-    nmatch = 0
-    # loop calibration stars and find a match in SExtractor sources
-    for i in range(ncal):
-
-        mask_match = find_stars(ra_sex, dec_sex, ra_cal[i], dec_cal[i],
-                                dist_max, log, search='circle')
-
-        if np.sum(mask_match)==1:
-            # there's one match, calculate its zeropoint
-            # need to calculate airmass for each star, as around A=2,
-            # difference in airmass across the FOV is 0.1, i.e. a 5% change
-            zp_array[mask_match] = (mag_cal[i] - mag_sex_inst[mask_match] +
-                                    airmass_sex[mask_match]*C.ext_coeff[filt])
-
-            if C.verbose: 
-                if 'spectype' in data_cal.dtype.names:
-                    log.info('ra_cal: {}, dec_cal: {}, mag_cal: {}, magerr_sex: {}, zp_array: {}, spectype: {}, chi2: {}, absdev: {}'.
-                             format(ra_cal[i], dec_cal[i], mag_cal[i],
-                                    magerr_sex_inst[mask_match], zp_array[mask_match],
-                                    data_cal['spectype'][i], data_cal['chi2'][i], data_cal['absdev'][i]))
-                else:
-                    log.info('ra_cal: {}, dec_cal: {}, mag_cal: {}, magerr_sex: {}, zp_array: {}'.
-                             format(ra_cal[i], dec_cal[i], mag_cal[i],
-                                    magerr_sex_inst[mask_match], zp_array[mask_match]))
+    # find the SExtractor source matching each calibration star
+    # using function [match_radec]; only calibration stars with a
+    # single match are used
+    index_match, dist, unique, dra, ddec = match_radec (ra_cal, dec_cal, ra_sex, dec_sex,
+                                                        dist_max)
+    index_cal = np.nonzero(unique)[0][0:C.phot_ncal_max]
+    index_match = index_match[index_cal]
+    nmatch = len(index_cal)
+
+    # zeropoints of the matching sources; need to calculate airmass
+    # for each star, as around A=2, difference in airmass across the
+    # FOV is 0.1, i.e. a 5% change
+    zp_array[index_match] = (mag_cal[index_cal] - mag_sex_inst[index_match] +
+                             airmass_sex[index_match]*C.ext_coeff[filt])
 
-                    
-            # done when number of matches equals [C.phot_ncal_max]
-            nmatch += 1
-            if nmatch == C.phot_ncal_max:
-                break
-                
+    if C.verbose:
+        for i, i_sex in zip(index_cal, index_match):
+            if 'spectype' in data_cal.dtype.names:
+                i_data = index_sort[i]
+                log.info('ra_cal: {}, dec_cal: {}, mag_cal: {}, magerr_sex: {}, zp_array: {}, spectype: {}, chi2: {}, absdev: {}'.
+                         format(ra_cal[i], dec_cal[i], mag_cal[i],
+                                magerr_sex_inst[i_sex], zp_array[i_sex],
+                                data_cal['spectype'][i_data], data_cal['chi2'][i_data],
+                                data_cal['absdev'][i_data]))
+            else:
+                log.info('ra_cal: {}, dec_cal: {}, mag_cal: {}, magerr_sex: {}, zp_array: {}'.
+                         format(ra_cal[i], dec_cal[i], mag_cal[i],
+                                magerr_sex_inst[i_sex], zp_array[i_sex]))
                 
     # determine median zeropoint
     zp_mean, zp_std, zp_median = clipped_stats(zp_array, clip_zeros=True, make_hist=C.make_plots,
@@ -3107,7 +3859,7 @@ def haversine (ra1, dec1, ra2, dec2):
     
     a = np.sin(d_dec/2)**2 + np.cos(dec1) * np.cos(dec2) * np.sin(d_ra/2)**2
     c = 2*np.arcsin(np.sqrt(a))
-    return map(np.degrees, [c])[0]
+    return np.degrees(c)
 
 
 ################################################################################
@@ -3130,21 +3882,541 @@ def get_ext_list (dec_center, fov_half_deg, zone_size=60):
     return range(ext_min, ext_max+1)
 
     
+################################################################################
+
+def ang2pix_nest (nside, ra, dec):
+
+    """Function that returns the HEALPix pixel numbers in the nested
+    scheme of the positions [ra] and [dec] (in degrees) for the
+    resolution parameter [nside], which should be a power of 2."""
+
+    ra = np.asarray(ra, dtype='float64')
+    dec = np.asarray(dec, dtype='float64')
+    z = np.sin(np.radians(dec))
+    za = np.abs(z)
+    # tt is in range [0,4)
+    tt = np.mod(np.radians(ra), 2*np.pi) / (0.5*np.pi)
+    tt[tt>=4] = 0.
+
+    face = np.zeros(z.shape, dtype='int64')
+    ix = np.zeros(z.shape, dtype='int64')
+    iy = np.zeros(z.shape, dtype='int64')
+
+    # equatorial region
+    mask_eq = (za <= 2./3)
+    temp1 = nside*(0.5+tt[mask_eq])
+    temp2 = nside*(z[mask_eq]*0.75)
+    jp = (temp1-temp2).astype('int64')
+    jm = (temp1+temp2).astype('int64')
+    ifp = jp // nside
+    ifm = jm // nside
+    face[mask_eq] = np.where(ifp==ifm, ifp | 4, np.where(ifp<ifm, ifp, ifm+8))
+    ix[mask_eq] = jm & (nside-1)
+    iy[mask_eq] = nside - (jp & (nside-1)) - 1
+
+    # polar caps
+    mask_pol = ~mask_eq
+    ntt = np.minimum(3, tt[mask_pol].astype('int64'))
+    tp = tt[mask_pol] - ntt
+    tmp = nside*np.sqrt(3*(1-za[mask_pol]))
+    jp = np.minimum(nside-1, (tp*tmp).astype('int64'))
+    jm = np.minimum(nside-1, ((1-tp)*tmp).astype('int64'))
+    north = (z[mask_pol] > 0)
+    face[mask_pol] = np.where(north, ntt, ntt+8)
+    ix[mask_pol] = np.where(north, nside-jm-1, jp)
+    iy[mask_pol] = np.where(north, nside-jp-1, jm)
+
+    # interleave the bits of ix and iy
+    ipix = np.zeros(z.shape, dtype='int64')
+    for b in range(int(np.log2(nside))):
+        ipix |= ((ix >> b) & 1) << (2*b)
+        ipix |= ((iy >> b) & 1) << (2*b+1)
+
+    return face*nside**2 + ipix
+
+
+################################################################################
+
+def healpix_in_circle (nside, ra, dec, radius, margin=0.):
+
+    """Function that returns the HEALPix pixel numbers (nested scheme)
+    for resolution [nside] that overlap with the circle with [radius]
+    around [ra] and [dec], plus [margin] (all in degrees), by
+    sampling positions on a grid that covers this area with a spacing
+    much smaller than the pixel size."""
+
+    pixsize = np.degrees(np.sqrt(4*np.pi/(12*nside**2)))
+    size = radius + margin
+    step = pixsize/6.
+    dec_grid = np.linspace(max(-90., dec-size), min(90., dec+size),
+                           int(2*size/step)+2)
+    cos_dec_min = np.cos(np.radians(np.amax(np.abs(dec_grid))))
+    if cos_dec_min <= size/180.:
+        ra_size = 180.
+    else:
+        ra_size = min(180., size/cos_dec_min)
+    ra_grid = np.linspace(ra-ra_size, ra+ra_size, int(2*ra_size/step)+2)
+    dec_grid, ra_grid = np.meshgrid(dec_grid, ra_grid)
+    
+    return np.unique(ang2pix_nest(nside, ra_grid.ravel(), dec_grid.ravel()))
+
+
+################################################################################
+
+def make_cal_store (cal_cat, store_dir, nside=32, log=None):
+
+    """Function that converts the calibration catalog [cal_cat], a
+    binary fits table with the stars recorded in 1-degree declination
+    zones in consecutive extensions, to a column-oriented store in
+    directory [store_dir], with the rows sorted by their HEALPix
+    pixel (nested scheme) with resolution [nside]. Each column is
+    saved as a separate numpy file that can be memory mapped, and the
+    file index.npy contains the row offsets of the HEALPix pixels.
+    The store can be queried with [query_cal_store].
+
+    """
+
+    t = time.time()
+    if log is not None:
+        log.info('Executing make_cal_store ...')
+
+    with fits.open(cal_cat, memmap=True) as hdulist:
+
+        # extensions containing data
+        ext_list = [ext for ext in range(1, len(hdulist))
+                    if hdulist[ext].data is not None]
+        names = hdulist[ext_list[0]].columns.names
+        
+        # HEALPix pixel number of each row and sorting index
+        ipix = np.concatenate([ang2pix_nest(nside, hdulist[ext].data['ra'],
+                                            hdulist[ext].data['dec'])
+                               for ext in ext_list])
+        index_sort = np.argsort(ipix, kind='stable')
+        offsets = np.concatenate(([0], np.cumsum(np.bincount(ipix, minlength=12*nside**2))))
+        
+        if not os.path.isdir(store_dir):
+            os.makedirs(store_dir)
+        np.save(os.path.join(store_dir, 'index.npy'), offsets)
+        np.save(os.path.join(store_dir, 'columns.npy'), np.array(names))
+
+        # save columns one at a time to limit the memory use
+        for name in names:
+            column = np.concatenate([np.asarray(hdulist[ext].data[name])
+                                     for ext in ext_list])
+            np.save(os.path.join(store_dir, name+'.npy'), column[index_sort])
+            
+    if log is not None:
+        log.info('number of stars recorded in {}: {}'.format(store_dir, offsets[-1]))
+        log_timing_memory (t0=t, label='make_cal_store', log=log)
+        
+    return
+
+
+################################################################################
+
+def query_cal_store (store_dir, ra, dec, dist, log, search='box', columns=None):
+
+    """Function that selects the stars in the calibration catalog store
+    [store_dir] (see [make_cal_store]) within [dist] (degrees) of
+    [ra] and [dec], where [search] can be 'box' or 'circle' (as in
+    [find_stars]). Only the [columns] requested (default: all) of the
+    HEALPix pixels overlapping with the search area are read. Returns
+    a numpy structured array.
+
+    """
+
+    if C.timing: t = time.time()
+    log.info('Executing query_cal_store ...')
+
+    offsets = np.load(os.path.join(store_dir, 'index.npy'), mmap_mode='r')
+    nside = int(np.sqrt((len(offsets)-1)/12))
+    if columns is None:
+        columns = list(np.load(os.path.join(store_dir, 'columns.npy')))
+
+    # radius of the circle enclosing the search area
+    radius = dist
+    if search=='box':
+        radius *= np.sqrt(2)
+    
+    # determine the HEALPix pixels overlapping with the search area
+    # plus a margin of one pixel size
+    pixsize = np.degrees(np.sqrt(4*np.pi/(12*nside**2)))
+    ipix = healpix_in_circle (nside, ra, dec, radius, margin=pixsize)
+
+    # rows of these pixels; merge consecutive pixels into single
+    # slices
+    i1 = np.asarray(offsets[ipix])
+    i2 = np.asarray(offsets[ipix+1])
+    mask_new = np.ones(len(ipix), dtype=bool)
+    mask_new[1:] = (ipix[1:] != ipix[:-1]+1)
+    i1 = i1[mask_new]
+    i2 = i2[np.append(np.nonzero(mask_new)[0][1:]-1, len(ipix)-1)]
+    
+    # read the columns of these rows, including the coordinates
+    # needed for the selection below
+    data = {}
+    for name in list(columns) + [c for c in ['ra', 'dec'] if c not in columns]:
+        column = np.load(os.path.join(store_dir, name+'.npy'), mmap_mode='r')
+        data[name] = np.concatenate([column[a:b] for a, b in zip(i1, i2)])
+
+    # select the stars within the search area
+    mask_field = find_stars(data['ra'], data['dec'], ra, dec, dist, log, search=search)
+
+    data_cal = np.zeros(np.sum(mask_field), dtype=[(name, data[name].dtype)
+                                                   for name in columns])
+    for name in columns:
+        data_cal[name] = data[name][mask_field]
+
+    if C.timing:
+        log_timing_memory (t0=t, label='query_cal_store', log=log)
+
+    return data_cal
+
+
+################################################################################
+
+class CalCache:
+
+    """Bounded, least-recently-used cache of selections of calibration
+    stars, which is kept in memory by a long-lived process that
+    processes many images of the same fields. Each entry is keyed by
+    the field center, the radius of the selection and the filter; an
+    entry without a filter contains all stars within a circle around
+    the field center, and can be used for any field that is fully
+    inside that circle. An entry with a filter contains the stars of
+    the same circle that were selected for that filter by
+    [filter_cal_cat], and is used in the same way.
+
+    The total size of the cached arrays is limited to [maxmem] bytes,
+    beyond which the least recently used entries are evicted. All
+    entries are discarded when the modification time or size of the
+    calibration catalog changes.
+
+    """
+
+    def __init__(self, maxmem):
+
+        self.maxmem = maxmem
+        self.entries = collections.OrderedDict()
+        self.nbytes = 0
+        self.signature = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+        
+    def check(self, filename):
+
+        """Discard all entries if [filename] changed since the previous
+        call."""
+
+        stat = os.stat(filename)
+        signature = (filename, stat.st_mtime, stat.st_size)
+        if signature != self.signature:
+            if len(self.entries) > 0:
+                self.invalidations += 1
+            self.entries.clear()
+            self.nbytes = 0
+            self.signature = signature
+
+            
+    def get(self, ra, dec, radius, filt=None):
+
+        """Return the cached array and its key (ra, dec, radius, filter)
+        of a circle for [filt] that encloses the circle centered at
+        [ra], [dec] with [radius] (degrees), or None and None if not
+        available."""
+
+        for key in reversed(self.entries):
+            ra_c, dec_c, radius_c, filt_c = key
+            if filt_c != filt:
+                continue
+            dist = haversine(ra, dec, ra_c, dec_c)
+            if dist + radius <= radius_c:
+                data = self.entries.pop(key)
+                self.entries[key] = data
+                self.hits += 1
+                return data, key
+
+        self.misses += 1
+        return None, None
+
+    
+    def put(self, ra, dec, radius, filt, data):
+
+        """Add [data] to the cache, evicting the least recently used
+        entries if needed."""
+
+        nbytes = data.nbytes
+        if nbytes > self.maxmem:
+            return
+        
+        key = (float(ra), float(dec), float(radius), filt)
+        if key in self.entries:
+            self.nbytes -= self.entries.pop(key).nbytes
+            
+        while self.nbytes + nbytes > self.maxmem:
+            __, data_evict = self.entries.popitem(last=False)
+            self.nbytes -= data_evict.nbytes
+            self.evictions += 1
+
+        self.entries[key] = data
+        self.nbytes += nbytes
+
+        
+    def stats(self):
+
+        """Return a string with the cache statistics."""
+        
+        return ('cal_cache entries: {}, size: {:.1f} MB, hits: {}, misses: {}, '
+                'evictions: {}, invalidations: {}'
+                .format(len(self.entries), self.nbytes/1e6, self.hits, self.misses,
+                        self.evictions, self.invalidations))
+
+
+# [cal_cache] is created by the first call to [read_cal_cat]
+cal_cache = None
+
+
+################################################################################
+
+def read_cal_cat (ra_center, dec_center, fov_half_deg, log, filt=None):
+
+    """Function that returns the stars in the calibration catalog
+    within a box with half-size [fov_half_deg] around [ra_center] and
+    [dec_center]. If [filt] is provided, only the stars suitable for
+    the calibration of that filter are returned (see
+    [filter_cal_cat]). If the calibration catalog store
+    [C.cal_cat_store] exists (see [make_cal_store]), it is queried
+    using [query_cal_store], otherwise the relevant declination zones
+    of [C.cal_cat] are read. If [C.cal_cache_maxmem] is nonzero, the
+    selections are kept in the in-process cache [cal_cache] (see
+    [CalCache]), so that subsequent images of the same field do not
+    need to read the catalog again."""
+
+    global cal_cache
+    if C.cal_cache_maxmem > 0:
+        if cal_cache is None:
+            cal_cache = CalCache(C.cal_cache_maxmem*1e6)
+        if os.path.isdir(C.cal_cat_store):
+            cal_cache.check(os.path.join(C.cal_cat_store, 'index.npy'))
+        else:
+            cal_cache.check(C.cal_cat)
+        use_cache = True
+    else:
+        use_cache = False
+        
+    # radius of the circle enclosing the box; the cached selection
+    # adopts a larger radius so that it can also be used for nearby
+    # field centers
+    radius = np.sqrt(2) * fov_half_deg
+
+    if use_cache and filt is not None:
+        data_cal, __ = cal_cache.get(ra_center, dec_center, radius, filt=filt)
+        if data_cal is not None:
+            # select the stars within the box; if fewer than
+            # [C.phot_ncal_min] are left, [filter_cal_cat] may drop
+            # the filter requirements for this field, so then the
+            # selection is made from the unfiltered stars below
+            mask_field = find_stars(data_cal['ra'], data_cal['dec'], ra_center, dec_center,
+                                    fov_half_deg, log)
+            data_cal = data_cal[mask_field]
+            if len(data_cal) >= C.phot_ncal_min:
+                log.info('using cached selection of calibration stars for filter {}'
+                         .format(filt))
+                if C.verbose:
+                    log.info(cal_cache.stats())
+                return data_cal
+
+    data_cal = None
+    if use_cache:
+        data_cal, key = cal_cache.get(ra_center, dec_center, radius)
+
+    if data_cal is None:
+        if use_cache:
+            radius_read = radius + C.cal_cache_margin
+            search = 'circle'
+        else:
+            radius_read = fov_half_deg
+            search = 'box'
+        if os.path.isdir(C.cal_cat_store):
+            data_cal = query_cal_store (C.cal_cat_store, ra_center, dec_center,
+                                        radius_read, log, search=search)
+        else:
+            # determine cal_cat fits extensions to read using
+            # [get_ext_list] (each 1 degree strip in declination is
+            # recorded in its own extension in the calibration catalog)
+            ext_list = get_ext_list (dec_center, radius_read, zone_size=60.)
+            # read calibration catalog
+            data_cal = read_hdulist (C.cal_cat, ext_data=ext_list)
+            # use function [find_stars] to select stars in calibration
+            # catalog that are within the current field-of-view
+            mask_field = find_stars(data_cal['ra'], data_cal['dec'], ra_center, dec_center,
+                                    radius_read, log, search=search)
+            index_field = np.where(mask_field)[0]
+            data_cal = data_cal[index_field]
+
+        if use_cache:
+            cal_cache.put(ra_center, dec_center, radius_read, None, data_cal)
+            key = (ra_center, dec_center, radius_read, None)
+
+    if use_cache:
+        if filt is not None:
+            # cache the stars of the whole circle that are suitable for
+            # [filt], for the next images of this field in this filter
+            cal_cache.put(key[0], key[1], key[2], filt, filter_cal_cat (data_cal, filt, log))
+        # select the stars within the box
+        mask_field = find_stars(data_cal['ra'], data_cal['dec'], ra_center, dec_center,
+                                fov_half_deg, log)
+        data_cal = data_cal[mask_field]
+
+    if filt is not None:
+        data_cal = filter_cal_cat (data_cal, filt, log)
+
+    if use_cache and C.verbose:
+        log.info(cal_cache.stats())
+            
+    return data_cal
+
+
+################################################################################
+
+def filter_cal_cat (data_cal, filt, log):
+
+    """Function that selects the stars in the calibration catalog array
+    [data_cal] that are suitable for the photometric calibration of
+    filter [filt], based on the chi2 of their spectral fit and the
+    presence of the survey filters used to infer their magnitude in
+    [filt]."""
+
+    ncalstars = np.shape(data_cal)[0]
+    log.info('number of photometric stars in FOV: {}'.format(ncalstars))
+
+    # test: limit calibration catalog entries
+    if 'chi2' in data_cal.dtype.names:
+        mask_cal = (data_cal['chi2'] <= 10.)
+        #data_cal = data_cal[:][mask_cal]
+        data_cal = data_cal[mask_cal]
+
+    ncalstars = np.shape(data_cal)[0]
+    log.info('number of photometric stars in FOV after chi2 cut: {}'.format(ncalstars))
+
+    # requirements on presence of survey input filters for the
+    # calibration of a ML/BG filter:
+    #u: Gaia and (GALEX NUV or SM u or SM v or SDSS u)
+    #g: Gaia and (GALEX NUV or SM u or SM v or SDSS u or SDSS g)
+    #q: Gaia and (GALEX NUV or SM u or SM v or SDSS u or SDSS g or PS1 g or SM g)
+    #r: Gaia: 0
+    #i: Gaia and (2MASS J or PS1 z or PS1 y or SDSS z or SM z): 0
+    #z: Gaia and (2MASS J or PS1 y): 0
+
+    # prepare [filt_req] dictionary
+    filt_req = {}
+    # these filters are required for all filters, boolean AND
+    filt_req['all'] = ['Gaia2r_G', 'Gaia2r_Gbp', 'Gaia2r_Grp', '2MASS_J']
+    # these filters are required for specific filters, boolean OR
+    filt_req['u'] = ['GALEX_NUV', 'SM_u', 'SM_v', 'SDSS_u']
+    filt_req['g'] = ['GALEX_NUV', 'SM_u', 'SM_v', 'SDSS_u', 'SDSS_g']
+    filt_req['q'] = ['GALEX_NUV', 'SM_u', 'SM_v', 'SDSS_u', 'SDSS_g', 'PS1_g', 'SM_g']
+    filt_req['i'] = ['PS1_z', 'PS1_y', 'SDSS_z', 'SM_z']
+    filt_req['z'] = ['PS1_y']
+
+    mask_cal = np.all([data_cal[col] for col in filt_req['all']], axis=0)
+    data_cal = data_cal[mask_cal]
+    
+    if filt in filt_req.keys():
+        mask_cal = np.any([data_cal[col] for col in filt_req[filt]], axis=0)
+        # if less than [C.phot_ncal_min] stars left, drop filter requirements and hope for the best!
+        if np.sum(mask_cal) >= C.phot_ncal_min:
+            data_cal = data_cal[mask_cal]
+        else:
+            log.info('Warning: less than {} calibration stars with default filter requirements'.
+                     format(C.phot_ncal_min))
+            log.info('filter: {}, requirements (any of these): {}'.format(filt, filt_req[filt]))
+
+    ncalstars = np.shape(data_cal)[0]
+    log.info('number of photometric stars in FOV after filter cut: {}'.format(ncalstars))
+
+    # pick only main sequence stars
+    if False:
+        if 'spectype' in data_cal.dtype.names:
+            mask_cal = ['V' in data_cal['spectype'][i] and
+                        'IV' not in data_cal['spectype'][i] and
+                        'M' not in data_cal['spectype'][i]
+                        for i in range(np.shape(data_cal)[0])]
+            #data_cal = data_cal[:][mask_cal]
+            data_cal = data_cal[mask_cal]
+
+    return data_cal
+
+
 ################################################################################
 
 def get_airmass (ra, dec, obsdate, log):
 
+    """Function that returns the airmass of positions [ra] and [dec]
+    (ICRS, in degrees) at [obsdate] for the observatory location
+    defined by [C.obs_lat], [C.obs_long] and [C.obs_height]. The
+    parts of the transformation to the local horizon that do not
+    depend on the position - the velocity of the Earth, the rotation
+    from the GCRS to the CIRS frame and the local Earth rotation
+    angle, i.e. the sidereal time with respect to the CIO - are
+    determined once with astropy, after which the annual aberration,
+    hour angle and zenith distance are calculated with numpy for all
+    positions. This is much faster than transforming all positions to
+    astropy's AltAz frame, with which it agrees to better than 1e-4
+    in airmass up to a zenith distance of 80 degrees. If
+    [C.airmass_hardie] is True, the secant of the zenith distance is
+    corrected with the polynomial from Hardie (1962)."""
+    
     if C.timing: t = time.time()
     log.info('Executing get_airmass ...')
 
     location = EarthLocation(lat=C.obs_lat, lon=C.obs_long, height=C.obs_height)
-    coords = SkyCoord(ra, dec, frame='icrs', unit='deg')
-    coords_altaz = coords.transform_to(AltAz(obstime=Time(obsdate), location=location))
+    obstime = Time(obsdate, location=location)
+
+    # velocity of the Earth in units of the speed of light
+    __, vel_earth = get_body_barycentric_posvel('earth', obstime)
+    beta = (vel_earth.xyz / const.c).to('').value
+    
+    # rotation matrix from GCRS to CIRS, inferred from the
+    # transformation of the unit vectors, which end up in its columns
+    gcrs = SkyCoord(x=[1,0,0], y=[0,1,0], z=[0,0,1], representation_type='cartesian',
+                    frame=GCRS(obstime=obstime))
+    rot_cirs = gcrs.transform_to(CIRS(obstime=obstime)).cartesian.xyz.value
+    
+    # local Earth rotation angle
+    jd_ut1 = obstime.ut1.jd1 - 2451545.0 + obstime.ut1.jd2
+    era_local = (2*np.pi*(0.7790572732640 + 0.00273781191135448*jd_ut1 + np.mod(jd_ut1, 1.))
+                 + np.radians(C.obs_long))
+    
+    # apply annual aberration to the positions and rotate them to the
+    # CIRS frame
+    xyz = radec2xyz(np.atleast_1d(ra), np.atleast_1d(dec))
+    xyz += beta - np.dot(xyz, beta)[:,None] * xyz
+    xyz = np.dot(xyz, rot_cirs.T)
+    
+    # hour angle and zenith distance
+    hour_angle = era_local - np.arctan2(xyz[:,1], xyz[:,0])
+    sin_dec = xyz[:,2] / np.sqrt(np.sum(xyz**2, axis=1))
+    cos_dec = np.sqrt(1 - sin_dec**2)
+    lat = np.radians(C.obs_lat)
+    secz = 1. / (np.sin(lat)*sin_dec + np.cos(lat)*cos_dec*np.cos(hour_angle))
+    
+    if C.airmass_hardie:
+        secz_1 = secz - 1
+        airmass = secz - 0.0018167*secz_1 - 0.002875*secz_1**2 - 0.0008083*secz_1**3
+    else:
+        airmass = secz
 
+    if np.ndim(ra) == 0:
+        airmass = airmass[0]
+        
     if C.timing:
         log_timing_memory (t0=t, label='get_airmass', log=log)
 
-    return coords_altaz.secz
+    return airmass
 
         
 ################################################################################
@@ -3216,6 +4488,80 @@ def fixpix (data, data_bkg, log, satlevel=60000., data_mask=None):
     return
 
         
+################################################################################
+
+def get_objmask (data, fwhm, log):
+
+    """Function that returns a boolean mask of the pixels in [data] that
+    are part of an object, as an in-process alternative to
+    SExtractor's -OBJECTS check-image. A first estimate of the
+    background and its standard deviation is determined with
+    [get_back] without any object masking. The background-subtracted
+    image is smoothed with a Gaussian with FWHM [fwhm] and pixels where
+    the smoothed image is above [C.bkg_objmask_nsigma] times the
+    standard deviation of the unsmoothed background are flagged, as
+    SExtractor does for its filtered detection image. Groups of
+    connected pixels smaller than [C.bkg_objmask_minarea] are
+    discarded and the remaining objects are dilated by one pixel.
+
+    """
+
+    if C.timing: t = time.time()
+    log.info('Executing get_objmask ...')
+
+    # first estimate of background and its std
+    mesh_bkg, mesh_std = get_back(data, np.zeros(data.shape, dtype=bool), log)
+    bkg_model = BackgroundModel(data.shape, mesh_bkg=mesh_bkg, mesh_std=mesh_std)
+
+    # smooth background-subtracted image with Gaussian with the
+    # FWHM of the image, similar to the filtering done by
+    # SExtractor before detection; as in SExtractor, the threshold
+    # is relative to the standard deviation of the unfiltered
+    # background
+    sigma = fwhm / (2.*np.sqrt(2.*np.log(2.)))
+
+    # this is done in blocks of [nrows_block] rows, so that the
+    # background and its std are only evaluated for one block at a
+    # time rather than for the full frame; the blocks are extended by
+    # the radius of the Gaussian kernel (ndimage.gaussian_filter
+    # truncates it at 4 sigma) so that the smoothed image is identical
+    # to that of the full frame
+    ysize, xsize = data.shape
+    nrows_block = 512
+    overlap = int(4.*sigma + 0.5)
+    mask_obj = np.zeros(data.shape, dtype=bool)
+    for y1 in range(0, ysize, nrows_block):
+        y2 = min(y1+nrows_block, ysize)
+        y1_ext = max(y1-overlap, 0)
+        y2_ext = min(y2+overlap, ysize)
+        index_ext = (slice(y1_ext, y2_ext), slice(0, xsize))
+        data_filt = ndimage.gaussian_filter(data[index_ext] - bkg_model.get('bkg', index_ext),
+                                            sigma)
+        index = (slice(y1, y2), slice(0, xsize))
+        mask_obj[index] = (data_filt[y1-y1_ext:y2-y1_ext] >
+                           C.bkg_objmask_nsigma * bkg_model.get_std(index))
+    del data_filt
+    
+    # discard objects with fewer than [C.bkg_objmask_minarea] pixels
+    data_label, nlabels = ndimage.label(mask_obj)
+    obj_sizes = np.bincount(data_label.ravel())
+    mask_keep = (obj_sizes >= C.bkg_objmask_minarea)
+    mask_keep[0] = False
+    mask_obj = mask_keep[data_label]
+    del data_label
+
+    # grow objects by one pixel
+    mask_obj = ndimage.binary_dilation(mask_obj, structure=np.ones((3,3)).astype('bool'))
+    if C.verbose:
+        log.info('number of objects in object mask: {}, fraction of pixels masked: {:.3f}'
+                 .format(np.sum(mask_keep), np.sum(mask_obj)/float(mask_obj.size)))
+    
+    if C.timing:
+        log_timing_memory (t0=t, label='get_objmask', log=log)
+
+    return mask_obj
+
+
 ################################################################################
 
 def get_back (data, objmask, log, use_photutils=False, clip=True):
@@ -3375,17 +4721,21 @@ def mesh2back (mesh_filt, shape_data, log, order_interp=3, bkg_boxsize=None):
     if C.timing: t = time.time()
     log.info('Executing mesh2back ...')
 
+    if bkg_boxsize is None:
+        bkg_boxsize = C.bkg_boxsize
+
     # resize low-resolution meshes, with order [order_interp], where
     # order=0: nearest
     # order=1: bilinear spline interpolation
     # order=2: quadratic spline interpolation
     # order=3: cubic spline interpolation
-    background = ndimage.zoom(mesh_filt, C.bkg_boxsize, order=order_interp)
+    background = ndimage.zoom(mesh_filt, bkg_boxsize, order=order_interp)
 
     # if shape of the background is not equal to input [data]
     # then pad the background images
-    if shape_data != background.shape:
+    if tuple(shape_data) != background.shape:
         t1 = time.time()
+        ysize, xsize = shape_data
         ypad = ysize - background.shape[0]
         xpad = xsize - background.shape[1]
         background = np.pad(background, ((0,ypad),(0,xpad)), 'edge')
@@ -3403,6 +4753,439 @@ def mesh2back (mesh_filt, shape_data, log, order_interp=3, bkg_boxsize=None):
     return background
 
 
+################################################################################
+
+class WCSTransform:
+
+    """Pixel to sky transformation of an image, with methods
+    [all_pix2world] and [all_world2pix] that behave like those of
+    astropy.wcs.WCS, which is created only once per image by
+    [wcs_transform]. For large numbers of positions (at least
+    [C.wcs_interp_nmin]), the sky to pixel transformation is
+    evaluated with bicubic splines of the exact transformation on a
+    dense grid rather than with the WCS itself, which for distorted
+    (e.g. TPV) solutions requires iterations per position. The pixel
+    to sky transformation is not iterative and is always evaluated
+    with the WCS itself. The splines are fitted to the pixel
+    coordinates on a grid of standard coordinates with respect to
+    the image center, extending beyond the image. The grid spacing,
+    starting at [C.wcs_interp_step] pixels, is halved until the
+    maximum error at the centers of the grid cells, which is saved in
+    [interp_err] in pixels, is below [C.wcs_interp_tol] pixels.
+    Positions further than one grid step from the image are
+    transformed exactly.
+
+    """
+
+    def __init__(self, header):
+
+        self.wcs = WCS(header)
+        self.shape = (header.get('NAXIS2', 0), header.get('NAXIS1', 0))
+        # grids, splines and their errors are defined by method
+        # [interpolate]
+        self.grids = None
+        self.interp_err = None
+
+        
+    def all_pix2world(self, x, y, origin):
+        return self.wcs.all_pix2world(x, y, origin)
+
+    
+    def all_world2pix(self, ra, dec, origin):
+
+        ra = np.asarray(ra, dtype='float64')
+        dec = np.asarray(dec, dtype='float64')
+        if not self._use_interp(ra.size):
+            return self.wcs.all_world2pix(ra, dec, origin)
+
+        self.interpolate()
+        x = np.zeros(ra.shape)
+        y = np.zeros(ra.shape)
+        xi, eta = self._project(ra, dec)
+        grid = self.grids['world']
+        mask_in = self._inside(grid, eta, xi)
+        x[mask_in] = self._evaluate(grid, 'x', eta[mask_in], xi[mask_in]) - (1-origin)
+        y[mask_in] = self._evaluate(grid, 'y', eta[mask_in], xi[mask_in]) - (1-origin)
+        if np.any(~mask_in):
+            x[~mask_in], y[~mask_in] = self.wcs.all_world2pix(ra[~mask_in], dec[~mask_in],
+                                                              origin)
+        return x, y
+
+    
+    def interpolate(self):
+        """Fit the splines to the exact sky to pixel transformation, if
+        not done already."""
+
+        if self.grids is not None:
+            return
+
+        # tangent point of the standard coordinates at the image center
+        ysize, xsize = self.shape
+        ra0, dec0 = self.wcs.all_pix2world((xsize+1)/2., (ysize+1)/2., 1)
+        self.n0 = radec2xyz(ra0, dec0)[0]
+        self.e_east = np.array([-np.sin(np.radians(ra0)), np.cos(np.radians(ra0)), 0.])
+        self.e_north = np.cross(self.n0, self.e_east)
+
+        step = float(C.wcs_interp_step)
+        nmargin = 6
+        while True:
+
+            # pixel grid covering the image plus a margin of [nmargin]
+            # steps, which defines the area covered by the grid of
+            # standard coordinates; the splines are used up to 1 step
+            # from the image
+            ny = int(np.ceil(ysize/step)) + 2*nmargin + 1
+            nx = int(np.ceil(xsize/step)) + 2*nmargin + 1
+            grid_pix = {'origin': (0.5-nmargin*step, 0.5-nmargin*step), 'step': (step, step),
+                        'limits': (0.5-step, ysize+0.5+step, 0.5-step, xsize+0.5+step)}
+            yy, xx = self._nodes(grid_pix, ny, nx)
+            ra, dec = self.wcs.all_pix2world(xx, yy, 1)
+            xi, eta = self._project(ra, dec)
+
+            # grid of standard coordinates with the same number of
+            # nodes and covering the same area
+            limits = self._limits(grid_pix, xi, eta)
+            step_eta = (limits[1]-limits[0]) / (ny-2*nmargin-1)
+            step_xi = (limits[3]-limits[2]) / (nx-2*nmargin-1)
+            grid_world = {'origin': (limits[0]-(nmargin-1)*step_eta,
+                                     limits[2]-(nmargin-1)*step_xi),
+                          'step': (step_eta, step_xi), 'limits': limits}
+            etaeta, xixi = self._nodes(grid_world, ny, nx)
+            ra, dec = self._deproject(xixi, etaeta)
+            xmap, ymap = self.wcs.all_world2pix(ra, dec, 1)
+            grid_world['x'] = self._spline(xmap)
+            grid_world['y'] = self._spline(ymap)
+
+            # maximum error at the centers of the grid cells inside
+            # the limits, in pixels
+            etac, xic = self._centers(grid_world, ny, nx)
+            ra, dec = self._deproject(xic, etac)
+            xc, yc = self.wcs.all_world2pix(ra, dec, 1)
+            self.interp_err = np.amax(np.hypot(self._evaluate(grid_world, 'x', etac, xic) - xc,
+                                               self._evaluate(grid_world, 'y', etac, xic) - yc))
+            
+            if self.interp_err <= C.wcs_interp_tol or step <= 4:
+                break
+            step /= 2
+
+        self.grids = {'world': grid_world}
+
+
+    def _use_interp(self, npos):
+        return (C.wcs_interp and npos >= C.wcs_interp_nmin and 0 not in self.shape)
+
+    
+    def _nodes(self, grid, ny, nx):
+        # coordinates of the grid nodes
+        (y0, x0), (dy, dx) = grid['origin'], grid['step']
+        return np.meshgrid(y0+np.arange(ny)*dy, x0+np.arange(nx)*dx, indexing='ij')
+
+    
+    def _centers(self, grid, ny, nx):
+        # coordinates of the centers of the grid cells inside the limits
+        yy, xx = self._nodes(grid, ny-1, nx-1)
+        yy += grid['step'][0]/2
+        xx += grid['step'][1]/2
+        mask = self._inside(grid, yy, xx)
+        return yy[mask], xx[mask]
+
+    
+    def _limits(self, grid, xi, eta):
+        # limits of the standard coordinates of the nodes inside the
+        # limits of the pixel grid
+        yy, xx = self._nodes(grid, xi.shape[0], xi.shape[1])
+        mask = self._inside(grid, yy, xx)
+        return (np.amin(eta[mask]), np.amax(eta[mask]), np.amin(xi[mask]), np.amax(xi[mask]))
+
+    
+    def _inside(self, grid, y, x):
+        ymin, ymax, xmin, xmax = grid['limits']
+        return ((y >= ymin) & (y <= ymax) & (x >= xmin) & (x <= xmax))
+
+    
+    def _spline(self, values):
+        # spline coefficients of [values] on a grid, after subtracting
+        # the best-fit plane, which is returned as well; the mirrored
+        # boundary condition of the splines then affects only the
+        # outer parts of the margin of the grid
+        ny, nx = values.shape
+        yy, xx = np.meshgrid(np.arange(ny), np.arange(nx), indexing='ij')
+        A = np.column_stack([np.ones(values.size), yy.ravel(), xx.ravel()])
+        plane = np.linalg.lstsq(A, values.ravel(), rcond=None)[0]
+        values = values - (plane[0] + plane[1]*yy + plane[2]*xx)
+        coeffs = ndimage.spline_filter(values, order=3, output=np.float64, mode='mirror')
+        return coeffs, plane
+
+    
+    def _evaluate(self, grid, key, y, x):
+        (y0, x0), (dy, dx) = grid['origin'], grid['step']
+        coeffs, plane = grid[key]
+        iy = (y-y0)/dy
+        ix = (x-x0)/dx
+        return (ndimage.map_coordinates(coeffs, [iy, ix], order=3, mode='mirror', prefilter=False)
+                + plane[0] + plane[1]*iy + plane[2]*ix)
+
+    
+    def _project(self, ra, dec):
+        # gnomonic projection of [ra], [dec] (degrees) onto standard
+        # coordinates (degrees) with respect to the image center
+        shape = np.shape(ra)
+        xyz = radec2xyz(np.ravel(ra), np.ravel(dec))
+        w = np.dot(xyz, self.n0)
+        xi = np.degrees(np.dot(xyz, self.e_east)/w)
+        eta = np.degrees(np.dot(xyz, self.e_north)/w)
+        return xi.reshape(shape), eta.reshape(shape)
+
+    
+    def _deproject(self, xi, eta):
+        # inverse of [_project]
+        shape = np.shape(xi)
+        xyz = (self.n0 + np.radians(np.ravel(xi))[:,None] * self.e_east +
+               np.radians(np.ravel(eta))[:,None] * self.e_north)
+        ra = np.mod(np.degrees(np.arctan2(xyz[:,1], xyz[:,0])), 360.)
+        dec = np.degrees(np.arcsin(xyz[:,2] / np.sqrt(np.sum(xyz**2, axis=1))))
+        return ra.reshape(shape), dec.reshape(shape)
+
+
+# [wcs_cache] holds the [WCSTransform]s returned by [wcs_transform]
+wcs_cache = collections.OrderedDict()
+
+def wcs_transform (header):
+
+    """Function that returns the [WCSTransform] for an image with
+    [header], which is created only once for each WCS solution; the
+    transformations of the last [C.wcs_cache_size] solutions are
+    kept in [wcs_cache]."""
+
+    # key consisting of the WCS keywords and image size
+    key = tuple(card.image for card in header.cards
+                if re.match('(NAXIS[12]|CTYPE|CUNIT|CRVAL|CRPIX|CD[12]_|PC[12]_|CDELT|CROTA|'
+                            'PV[12]_|[AB]P?_|LONPOLE|LATPOLE|RADESYS|EQUINOX)', card.keyword))
+    if key in wcs_cache:
+        transform = wcs_cache.pop(key)
+    else:
+        transform = WCSTransform(header)
+        while len(wcs_cache) >= C.wcs_cache_size:
+            wcs_cache.popitem(last=False)
+    wcs_cache[key] = transform
+    return transform
+
+
+################################################################################
+
+class BackgroundModel:
+
+    """Background model that holds the filtered background and
+    background STD meshes determined by [get_back] and evaluates the
+    full-resolution background and its standard deviation only for the
+    pixels that are requested, e.g. a subimage or the pixels selected
+    by a boolean mask. The interpolation is identical to that of
+    [mesh2back], i.e. ndimage.zoom with spline order [order_bkg] for
+    the background and [order_std] for its STD, and pixels beyond the
+    last complete mesh adopt the edge value. The spline coefficients
+    are determined once, when the model is created, so no full-frame
+    background arrays are needed.
+
+    If the full-frame arrays [data_bkg] and [data_std] are provided
+    instead of the meshes (for [C.bkg_method] 1 or 3), the model simply
+    returns the corresponding parts of these arrays.
+
+    Indexing the model with a list of two slices or a boolean mask
+    with the same shape as the image returns the background, just like
+    indexing a full-frame background array would, so it can be used
+    directly in functions [fixpix] and [get_psfoptflux_xycoords].
+
+    """
+    
+    def __init__(self, shape, mesh_bkg=None, mesh_std=None, bkg_boxsize=None,
+                 order_bkg=2, order_std=1, data_bkg=None, data_std=None):
+
+        self.shape = tuple(shape)
+        self.factor = 1.
+        # [remap_grid] is defined by method [remap]
+        self.remap_grid = None
+        
+        if mesh_bkg is not None and mesh_std is not None:
+            if bkg_boxsize is None:
+                bkg_boxsize = C.bkg_boxsize
+            self.bkg_boxsize = bkg_boxsize
+            self.mesh = {'bkg': np.asarray(mesh_bkg, dtype='float64'),
+                         'std': np.asarray(mesh_std, dtype='float64')}
+            self.order = {'bkg': order_bkg, 'std': order_std}
+            # spline coefficients; mode 'mirror' reproduces the
+            # boundary treatment of ndimage.zoom
+            self.coeffs = {}
+            for key in ['bkg', 'std']:
+                if self.order[key] > 1:
+                    self.coeffs[key] = ndimage.spline_filter(self.mesh[key], order=self.order[key],
+                                                             output=np.float64, mode='mirror')
+                else:
+                    self.coeffs[key] = self.mesh[key]
+            self.data = None
+        else:
+            self.mesh = None
+            self.data = {'bkg': data_bkg, 'std': data_std}
+
+
+    def __getitem__(self, index):
+        return self.get('bkg', index)
+
+
+    def scale(self, factor):
+        """Multiply background and STD by [factor], e.g. the gain to convert
+        counts to electrons."""
+        self.factor *= factor
+
+
+    def values(self, key='bkg'):
+        """Return the (scaled) filtered mesh, or the full-frame array if the
+        model is not mesh-based; useful for statistics."""
+        if self.mesh is not None:
+            return (self.mesh[key] * self.factor).astype('float32')
+        else:
+            return self.data[key] * self.factor
+
+
+    def get(self, key='bkg', index=None):
+        """Return the background ([key]='bkg') or its standard deviation
+        ([key]='std') for [index], which can be None (full frame), a list
+        or tuple of two slices or a boolean mask with the same shape as
+        the image."""
+
+        if index is None:
+            index = [slice(0, self.shape[0]), slice(0, self.shape[1])]
+            
+        if isinstance(index, np.ndarray) and index.dtype == bool:
+            y_index, x_index = np.nonzero(index)
+            return self.at(key, y_index, x_index)
+
+        yslice, xslice = index
+        y_index = np.arange(*yslice.indices(self.shape[0]))
+        x_index = np.arange(*xslice.indices(self.shape[1]))
+
+        if (self.remap_grid is None and self.mesh is not None and
+            len(y_index)*len(x_index) > 256**2):
+            # separable spline evaluation for large subimages: the
+            # background on the rectangular grid is [wy] x [coeffs] x
+            # [wx]^T; small cutouts are evaluated directly below
+            wy = self._interp_matrix(key, y_index, axis=0)
+            wx = self._interp_matrix(key, x_index, axis=1)
+            result = np.dot(np.dot(wy, self.coeffs[key]), wx.T)
+            return (result * self.factor).astype('float32')
+        else:
+            yy, xx = np.meshgrid(y_index, x_index, indexing='ij')
+            return self.at(key, yy, xx)
+
+
+    def get_std(self, index=None):
+        return self.get('std', index)
+
+    
+    def at(self, key, y_index, x_index):
+        """Return background ([key]='bkg') or its STD ([key]='std') at the
+        pixel indices [y_index] and [x_index] (arrays with the same
+        shape)."""
+
+        y_index = np.asarray(y_index, dtype='float64')
+        x_index = np.asarray(x_index, dtype='float64')
+        
+        if self.remap_grid is not None:
+            # pixel indices in the frame of the image on which the
+            # model was determined, interpolated from the coarse grid
+            ymap, xmap, step = self.remap_grid
+            coords = [y_index/step, x_index/step]
+            y_index = ndimage.map_coordinates(ymap, coords, order=1, mode='nearest')
+            x_index = ndimage.map_coordinates(xmap, coords, order=1, mode='nearest')
+
+        if self.mesh is not None:
+            coords = [self._mesh_coords(y_index, axis=0), self._mesh_coords(x_index, axis=1)]
+            result = ndimage.map_coordinates(self.coeffs[key], coords, order=self.order[key],
+                                             mode='mirror', prefilter=False)
+        else:
+            ysize, xsize = self.data[key].shape
+            y_index = np.clip(np.round(y_index), 0, ysize-1).astype(int)
+            x_index = np.clip(np.round(x_index), 0, xsize-1).astype(int)
+            result = self.data[key][y_index, x_index]
+
+        return (result * self.factor).astype('float32')
+
+
+    def remap(self, header, header_target, shape_target, step=16):
+        """Return a copy of the model that is evaluated in the pixel frame of
+        the image with header [header_target] and shape [shape_target],
+        rather than in the frame defined by [header] of the image on
+        which the background was determined. This replaces the SWarp
+        remapping of full-frame background images. The pixel mapping is
+        computed on a coarse grid with spacing [step] pixels and
+        bilinearly interpolated in between."""
+
+        ysize, xsize = shape_target
+        ny = int(np.ceil((ysize-1)/float(step))) + 1
+        nx = int(np.ceil((xsize-1)/float(step))) + 1
+        yy, xx = np.meshgrid(np.arange(ny)*step, np.arange(nx)*step, indexing='ij')
+        wcs_target = wcs_transform(header_target)
+        ra, dec = wcs_target.all_pix2world(xx+1, yy+1, 1)
+        wcs = wcs_transform(header)
+        xmap, ymap = wcs.all_world2pix(ra, dec, 0)
+
+        model = BackgroundModel.__new__(BackgroundModel)
+        model.__dict__.update(self.__dict__)
+        model.shape = tuple(shape_target)
+        model.remap_grid = (ymap, xmap, float(step))
+        return model
+
+    
+    def _mesh_coords(self, index, axis):
+        # convert pixel indices to (fractional) mesh coordinates in the
+        # same way as ndimage.zoom, where pixels beyond the zoomed
+        # image (if the image size is not an integer multiple of the
+        # mesh size) are assigned the edge value
+        nmesh = self.mesh['bkg'].shape[axis]
+        nzoom = nmesh * self.bkg_boxsize
+        if nmesh == 1:
+            return np.zeros(np.shape(index))
+        coords = np.asarray(index) * (nmesh-1) / float(nzoom-1)
+        return np.clip(coords, 0, nmesh-1)
+
+
+    def _interp_matrix(self, key, index, axis):
+        # matrix with shape (len(index), nmesh) with the spline weights
+        # of the mesh coefficients along [axis]
+        nmesh = self.mesh[key].shape[axis]
+        coords = self._mesh_coords(index, axis)
+        matrix = np.zeros((len(index), nmesh))
+        for i in range(nmesh):
+            unit = np.zeros(nmesh)
+            unit[i] = 1.
+            matrix[:,i] = ndimage.map_coordinates(unit, [coords], order=self.order[key],
+                                                  mode='mirror', prefilter=False)
+        return matrix
+
+
+################################################################################
+
+def read_bkg_model (base, shape, log):
+
+    """Function that returns a [BackgroundModel] for the image with base
+    name [base] and shape [shape]. If [C.bkg_method] is 2, the model
+    is built from the filtered meshes [base]_bkg_mesh.fits and
+    [base]_bkg_std_mesh.fits saved by [run_sextractor]; otherwise the
+    full-frame images [base]_bkg.fits and [base]_bkg_std.fits are
+    read."""
+
+    if C.bkg_method == 2:
+        mesh_bkg, header_mesh = read_hdulist (base+'_bkg_mesh.fits', ext_data=0, ext_header=0)
+        mesh_std = read_hdulist (base+'_bkg_std_mesh.fits', ext_data=0)
+        bkg_boxsize = header_mesh.get('BKG_SIZE', C.bkg_boxsize)
+        log.info('background model built from meshes with box size {}'.format(bkg_boxsize))
+        return BackgroundModel(shape, mesh_bkg=mesh_bkg, mesh_std=mesh_std,
+                               bkg_boxsize=bkg_boxsize, order_bkg=2, order_std=1)
+    else:
+        data_bkg = read_hdulist (base+'_bkg.fits', ext_data=0, dtype='float32')
+        data_std = read_hdulist (base+'_bkg_std.fits', ext_data=0, dtype='float32')
+        return BackgroundModel(shape, data_bkg=data_bkg, data_std=data_std)
+
+
 ################################################################################
 
 def get_median_std (nsub, cuts_ima, data, mask_use, mask_minsize, clip,
@@ -3517,16 +5300,134 @@ def plot_scatter_hist (x, y, limits, color='tab:blue', marker='o', xlabel=None,
             plt.annotate(label[i], xy=(0,0), xytext=labelpos[i],
                          textcoords='figure fraction', fontsize=11)
 
-    if title is not None:
-        axHistx.set_title(title)
-    if filename is not None:
-        plt.savefig(filename)
-    if filename is not None:
-        plt.savefig(filename)
-    if C.show_plots:
-        plt.show()
-    plt.close()
+    if title is not None:
+        axHistx.set_title(title)
+    if filename is not None:
+        plt.savefig(filename)
+    if filename is not None:
+        plt.savefig(filename)
+    if C.show_plots:
+        plt.show()
+    plt.close()
+
+
+################################################################################
+
+def select_psf_stars (x, y, flux, xsize, ysize, nmax, ngrid, log):
+
+    """Function that selects at most [nmax] of the PSF-star candidates
+    with pixel coordinates [x], [y] and fluxes [flux], stratified over
+    a grid of [ngrid] x [ngrid] cells covering the image of [xsize] x
+    [ysize] pixels and over flux within each cell, so that the spatial
+    variation of the PSF fitted by PSFEx remains well constrained while
+    its runtime is bounded in dense fields. The number [nmax] is shared
+    evenly among the cells, where the part that is not used by sparsely
+    populated cells is redistributed over the other cells. Within a
+    cell, the stars are picked at evenly spaced ranks in flux. If
+    [nmax] is zero, all candidates are selected. Returns the sorted
+    indices of the selected stars and the number of selected stars per
+    cell with shape ([ngrid], [ngrid])."""
+
+    # grid cell of each star
+    ix = np.clip(((x-0.5)*ngrid/xsize).astype(int), 0, ngrid-1)
+    iy = np.clip(((y-0.5)*ngrid/ysize).astype(int), 0, ngrid-1)
+    icell = iy*ngrid + ix
+    ncell = ngrid**2
+    count_cell = np.bincount(icell, minlength=ncell)
+
+    ncand = len(x)
+    if nmax <= 0 or ncand <= nmax:
+        return np.arange(ncand), count_cell.reshape(ngrid, ngrid)
+    
+    # number of stars to select per cell: go through the cells in order
+    # of increasing number of candidates, each getting at most its
+    # equal share of what is left
+    nsel_cell = np.zeros(ncell, dtype=int)
+    nleft = nmax
+    for k, i in enumerate(np.argsort(count_cell, kind='mergesort')):
+        nsel_cell[i] = min(count_cell[i], nleft // (ncell-k))
+        nleft -= nsel_cell[i]
+
+    # sort the stars by cell and by flux within each cell, and pick
+    # the stars at the centers of [nsel] equal rank intervals
+    index_sort = np.lexsort((flux, icell))
+    index_start = np.append(0, np.cumsum(count_cell)[:-1])
+    index_sel = []
+    for i in np.nonzero(nsel_cell)[0]:
+        rank = ((np.arange(nsel_cell[i])+0.5) * count_cell[i] / nsel_cell[i]).astype(int)
+        index_sel.append(index_sort[index_start[i] + rank])
+
+    index_sel = np.sort(np.concatenate(index_sel))
+    log.info('selected {} out of {} PSF-star candidates'.format(len(index_sel), ncand))
+
+    return index_sel, nsel_cell.reshape(ngrid, ngrid)
+
+
+################################################################################
+
+def make_psfex_ldac (sexcat_ldac, ldac_out, index_psf, image, base, size_vignet,
+                     log):
+
+    """Function that writes the FITS_LDAC catalog [ldac_out] for PSFEx
+    with the sources in the SExtractor catalog [sexcat_ldac] that were
+    selected as PSF stars, i.e. the rows with indices [index_psf]
+    (see [select_psf_stars]), including their VIGNET column: the
+    background-subtracted pixel values around the sources in a square
+    of [size_vignet] pixels. Rather than letting SExtractor save the
+    VIGNETs of all sources, they are cut out here from [image] (using
+    the background model of [base]) for the selected sources only. As
+    in SExtractor, the VIGNETs are centered on the pixel nearest to
+    the source position and pixels beyond the image edge are set to
+    -1e30. Returns the selected sources."""
+
+    if C.timing: t = time.time()
+    log.info('Executing make_psfex_ldac ...')
+
+    data, __ = read_wcs_image (image)
+    ysize, xsize = data.shape
+    data_bkg = read_bkg_model (base, (ysize, xsize), log)
+
+    with fits.open(sexcat_ldac, memmap=True) as hdulist:
+
+        data_ldac = hdulist[2].data[index_psf]
+        nsources = len(data_ldac)
+
+        # pixel indices of the VIGNET centers
+        xc = np.floor(data_ldac['XWIN_IMAGE']-0.5).astype(int)
+        yc = np.floor(data_ldac['YWIN_IMAGE']-0.5).astype(int)
+        offsets = np.arange(size_vignet) - size_vignet//2
+        
+        # gather the VIGNETs in batches to limit the memory used by the
+        # index arrays
+        vignet = np.zeros((nsources, size_vignet, size_vignet), dtype='float32')
+        nbatch = 1000
+        for i1 in range(0, nsources, nbatch):
+            i2 = min(i1+nbatch, nsources)
+            y_index, x_index = np.broadcast_arrays(
+                (yc[i1:i2,None] + offsets)[:,:,None], (xc[i1:i2,None] + offsets)[:,None,:])
+            mask_off = ((y_index<0) | (y_index>=ysize) | (x_index<0) | (x_index>=xsize))
+            y_index = np.clip(y_index, 0, ysize-1)
+            x_index = np.clip(x_index, 0, xsize-1)
+            vignet[i1:i2] = data[y_index, x_index] - data_bkg.at('bkg', y_index, x_index)
+            vignet[i1:i2][mask_off] = -1e30
+
+        columns = [fits.Column(name=col.name, format=col.format, unit=col.unit, dim=col.dim,
+                               array=data_ldac[col.name])
+                   for col in hdulist[2].columns]
+        columns.append(fits.Column(name='VIGNET', format='{}E'.format(size_vignet**2),
+                                   unit='count', dim='({},{})'.format(size_vignet, size_vignet),
+                                   array=vignet))
+        hdu_objects = fits.BinTableHDU.from_columns(columns)
+        hdu_objects.header['EXTNAME'] = 'LDAC_OBJECTS'
+        hdulist_new = fits.HDUList([hdulist[0], hdulist[1], hdu_objects])
+        hdulist_new.writeto(ldac_out, overwrite=True)
+        data_ldac = np.array(data_ldac)
+        
+    if C.timing:
+        log_timing_memory (t0=t, label='make_psfex_ldac', log=log)
 
+    return data_ldac
+        
 
 ################################################################################
 
@@ -3535,7 +5436,10 @@ def get_psf(image, header, nsubs, imtype, fwhm, pixscale, log):
     """Function that takes in [image] and determines the actual Point
     Spread Function as a function of position from the full frame, and
     returns a cube containing the psf for each subimage in the full
-    frame.
+    frame. The cube only contains the small PSF images, with shape
+    (nsubs, psf_size, psf_size); these are padded to the subimage
+    size and fft-shifted only right before their use in [run_ZOGY]
+    (see [center_psf]).
 
     """
 
@@ -3595,24 +5499,47 @@ def get_psf(image, header, nsubs, imtype, fwhm, pixscale, log):
             # SExtractor catalog.  Or feed [get_fratio_dxdy] with this
             # selected catalog instead of full one.
             sexcat_ldac_selected = base+'_ldac_4psfex.fits'
-            with fits.open(sexcat_ldac) as hdulist:
+            with fits.open(sexcat_ldac, memmap=True) as hdulist:
                 data_ldac = hdulist[2].data
+                has_vignet = ('VIGNET' in hdulist[2].columns.names)
                 mask_ok = ((data_ldac['FLAGS']<=1) & (data_ldac['SNR_WIN']>=C.psf_stars_s2n_min))
-                # sort by FLUX_AUTO
-                #index_sort = np.argsort(data_ldac['FLUX_AUTO'][mask_ok])
-                # select the faintest 20,000 above the s2n cut-off
-                #data_ldac = data_ldac[:][mask_ok] #[index_sort][0:20000]
-                data_ldac = data_ldac[mask_ok] #[index_sort][0:20000]
-                hdulist[2].data = data_ldac
-                hdulist_new = fits.HDUList(hdulist)
-                hdulist_new.writeto(sexcat_ldac_selected, overwrite=True)
-                hdulist_new.close()
-
-                if C.make_plots:
-                    result = prep_ds9regions(base+'_ds9regions_psfstars.txt',
-                                             data_ldac['XWIN_IMAGE'],
-                                             data_ldac['YWIN_IMAGE'],
-                                             radius=5., width=2, color='red')
+                index_psf = np.nonzero(mask_ok)[0]
+                # select at most [C.psf_stars_nmax] of these, spread
+                # over the image and over flux
+                index_sel, count_cell = select_psf_stars (
+                    data_ldac['XWIN_IMAGE'][index_psf], data_ldac['YWIN_IMAGE'][index_psf],
+                    data_ldac['FLUX_AUTO'][index_psf], xsize, ysize, C.psf_stars_nmax,
+                    C.psf_stars_ngrid, log)
+                index_psf = index_psf[index_sel]
+
+            header['PSF-NCAN'] = (np.sum(mask_ok), 'number of PSF-star candidates')
+            header['PSF-NSEL'] = (len(index_psf), 'number of PSF-star candidates fed to PSFEx')
+            header['PSF-GRID'] = (C.psf_stars_ngrid, 'PSF-star selection grid size (GRID x GRID)')
+            for iy in range(C.psf_stars_ngrid):
+                for ix in range(C.psf_stars_ngrid):
+                    header['PSF-C{}{}'.format(ix,iy)] = (
+                        count_cell[iy,ix], 'PSF stars selected in grid cell x={}, y={}'.format(ix,iy))
+
+            if not has_vignet:
+                # SExtractor was run without VIGNETs (see
+                # [C.psf_vignet_inproc]); cut them out for the selected
+                # sources with function [make_psfex_ldac]
+                size_vignet = header.get('S-VIGNET', get_vignet_size (imtype, log))
+                data_ldac = make_psfex_ldac (sexcat_ldac, sexcat_ldac_selected, index_psf,
+                                             image, base, size_vignet, log)
+            else:
+                with fits.open(sexcat_ldac) as hdulist:
+                    data_ldac = hdulist[2].data[index_psf]
+                    hdulist[2].data = data_ldac
+                    hdulist_new = fits.HDUList(hdulist)
+                    hdulist_new.writeto(sexcat_ldac_selected, overwrite=True)
+                    hdulist_new.close()
+
+            if C.make_plots:
+                result = prep_ds9regions(base+'_ds9regions_psfstars.txt',
+                                         data_ldac['XWIN_IMAGE'],
+                                         data_ldac['YWIN_IMAGE'],
+                                         radius=5., width=2, color='red')
                             
             log.info('time to create selection of LDAC catalog for PSFEx: {}'
                      .format(time.time()-t_temp))
@@ -3637,6 +5564,10 @@ def get_psf(image, header, nsubs, imtype, fwhm, pixscale, log):
     # fitting.
     sexcat_ldac_psffit = base+'_ldac_psffit.fits'
     if (not os.path.isfile(sexcat_ldac_psffit) or C.redo) and C.dosex_psffit:
+        # if only the header of [image] was saved (see
+        # [read_wcs_image]), use the original image
+        if not os.path.isfile(image):
+            image = image.replace('_wcs.fits', '.fits')
         result = run_sextractor(image, sexcat_ldac_psffit, C.sex_cfg_psffit,
                                 C.sex_par_psffit, pixscale, log, header,
                                 fit_psf=True, update_vignet=False, fwhm=fwhm)
@@ -3693,13 +5624,13 @@ def get_psf(image, header, nsubs, imtype, fwhm, pixscale, log):
         # first infer ra, dec corresponding to x, y pixel positions
         # (centers[:,1] and centers[:,0], respectively, using the WCS
         # solution in [new].wcs file from Astrometry.net
-        header_new_temp = read_hdulist (base_new+'_wcs.fits', ext_header=0)
-        wcs = WCS(header_new_temp)
+        header_new_temp = read_wcs_image (base_new+'_wcs.fits', read_data=False)
+        wcs = wcs_transform(header_new_temp)
         ra_temp, dec_temp = wcs.all_pix2world(centers[:,1], centers[:,0], 1)
         # then convert ra, dec back to x, y in the original ref image;
         # since this block concerns the reference image, the input [header]
         # corresponds to the reference header
-        wcs = WCS(header)
+        wcs = wcs_transform(header)
         centers[:,1], centers[:,0] = wcs.all_world2pix(ra_temp, dec_temp, 1)
         
     # initialize output PSF array
@@ -3727,13 +5658,7 @@ def get_psf(image, header, nsubs, imtype, fwhm, pixscale, log):
     psf_samp_update = float(psf_size) / float(psf_size_config)
     if imtype == 'new': psf_size_new = psf_size
     # [psf_ima] is the corresponding cube of PSF subimages
-    psf_ima = np.zeros((nsubs,psf_size,psf_size))
-    # [psf_ima_center] is [psf_ima] broadcast into images of xsize_fft
-    # x ysize_fft
-    psf_ima_center = np.zeros((nsubs,ysize_fft,xsize_fft))
-    # [psf_ima_shift] is [psf_ima_center] shifted - this is
-    # the input PSF image needed in the [run_ZOGY] function
-    psf_ima_shift = np.zeros((nsubs,ysize_fft,xsize_fft))
+    psf_ima = np.zeros((nsubs,psf_size,psf_size), dtype='float32')
 
     # if [run_psfex] was executed successfully (see above), then add a
     # number of header keywords
@@ -3761,31 +5686,14 @@ def get_psf(image, header, nsubs, imtype, fwhm, pixscale, log):
     # previously this was a loop; now turned to a function to
     # try pool.map multithreading below
     def loop_psf_sub(nsub):
-    
-        x = (centers[nsub,1] - polzero1) / polscal1
-        y = (centers[nsub,0] - polzero2) / polscal2
 
         if nsubs==1 or C.use_single_psf:
-            psf_ima_config = data[0]
+            isub = 0
         else:
-            if poldeg==2:
-                psf_ima_config = (data[0] + data[1] * x + data[2] * x**2 +
-                                  data[3] * y + data[4] * x * y + data[5] * y**2)
-            elif poldeg==3:
-                psf_ima_config = (data[0] + data[1] * x + data[2] * x**2 + data[3] * x**3 +
-                                  data[4] * y + data[5] * x * y + data[6] * x**2 * y +
-                                  data[7] * y**2 + data[8] * x * y**2 + data[9] * y**3)
-
-        # resample PSF image at image pixel scale
-
-        # PMV 2018/11/22: N.B.!: runtime warning (not in log file,
-        # only to STDOUT) related to zoom below:
-        # /usr/lib/python2.7/dist-packages/scipy/ndimage/interpolation.py:600:
-        # UserWarning: From scipy 0.13.0, the output shape of zoom()
-        # is calculated with round() instead of int() - for these
-        # inputs the size of the returned array has changed.",
-        # UserWarning)
-        psf_ima_resized = ndimage.zoom(psf_ima_config, psf_samp_update)
+            isub = nsub
+        psf_ima_config = psf_config_subs[isub]
+        psf_ima_resized = psf_resized_subs[isub]
+        
         # clean and normalize PSF
         psf_ima_resized_norm = clean_norm_psf(psf_ima_resized, C.psf_clean_factor)
 
@@ -3797,23 +5705,6 @@ def get_psf(image, header, nsubs, imtype, fwhm, pixscale, log):
             log.info('np.shape(psf_ima_resized): ' + str(np.shape(psf_ima_resized)))
             log.info('psf_size: ' + str(psf_size))
             
-        # now place this resized and normalized PSF image at the
-        # center of an image with the same size as the fftimage
-        if ysize_fft % 2 != 0 or xsize_fft % 2 != 0:
-            log.info('Warning: image not even in one or both dimensions!')
-            
-        xcenter_fft, ycenter_fft = int(xsize_fft/2), int(ysize_fft/2)
-        if C.verbose and nsub==0:
-            log.info('xcenter_fft, ycenter_fft: ' + str(xcenter_fft) + ', ' + str(ycenter_fft))
-
-        psf_hsize = int(psf_size/2)
-        index = [slice(ycenter_fft-psf_hsize, ycenter_fft+psf_hsize+1), 
-                 slice(xcenter_fft-psf_hsize, xcenter_fft+psf_hsize+1)]
-        psf_ima_center[nsub][index] = psf_ima_resized_norm
-
-        # perform fft shift
-        psf_ima_shift[nsub] = fft.fftshift(psf_ima_center[nsub])
-        
         if C.display and (nsub==0 or nsub==nysubs-1 or nsub==nsubs/2 or
                         nsub==nsubs-nysubs or nsub==nsubs-1):
             if imtype=='new':
@@ -3823,12 +5714,30 @@ def get_psf(image, header, nsubs, imtype, fwhm, pixscale, log):
             fits.writeto(base+'_psf_ima_config_sub'+str(nsub)+'.fits', psf_ima_config, overwrite=True)
             fits.writeto(base+'_psf_ima_resized_norm_sub'+str(nsub)+'.fits',
                          psf_ima_resized_norm.astype('float32'), overwrite=True)
+            psf_ima_shift = center_psf (psf_ima[nsub], (ysize_fft, xsize_fft))
             fits.writeto(base+'_psf_ima_center_sub'+str(nsub)+'.fits',
-                         psf_ima_center[nsub].astype('float32'), overwrite=True)            
+                         fft.ifftshift(psf_ima_shift), overwrite=True)
             fits.writeto(base+'_psf_ima_shift_sub'+str(nsub)+'.fits',
-                         psf_ima_shift[nsub].astype('float32'), overwrite=True)            
+                         psf_ima_shift, overwrite=True)
 
 
+    # build the PSF images at the PSFEx sampling at the centers of all
+    # subimages at once and resample them to the image pixel scale
+    psf_model = PSFModel(data, header_psf)
+    if nsubs==1 or C.use_single_psf:
+        psf_config_subs = data[0:1]
+    else:
+        psf_config_subs = psf_model.get_config([centers[:,1], centers[:,0]])
+
+    # PMV 2018/11/22: N.B.!: runtime warning (not in log file,
+    # only to STDOUT) related to zoom below:
+    # /usr/lib/python2.7/dist-packages/scipy/ndimage/interpolation.py:600:
+    # UserWarning: From scipy 0.13.0, the output shape of zoom()
+    # is calculated with round() instead of int() - for these
+    # inputs the size of the returned array has changed.",
+    # UserWarning)
+    psf_resized_subs = psf_model.resample(psf_config_subs, psf_samp_update)
+        
     # call above function [get_psf_sub] with pool.map
     if C.timing: t1 = time.time()
     pool = ThreadPool(nthreads)
@@ -3839,8 +5748,72 @@ def get_psf(image, header, nsubs, imtype, fwhm, pixscale, log):
         log_timing_memory (t0=t1, label='loop_psf_sub pool', log=log)
         log_timing_memory (t0=t, label='get_psf', log=log)
 
-    return psf_ima_shift.astype('float32'), psf_ima.astype('float32')
+    return psf_ima
+
 
+################################################################################
+
+def center_psf (psf_ima, shape):
+
+    """Function that places the PSF image [psf_ima] at the center of an
+    image with [shape], i.e. the size of the subimages including their
+    borders, and performs an fft shift so that the center of the PSF
+    ends up at pixel [0,0], as required by [run_ZOGY]."""
+
+    ysize_fft, xsize_fft = shape
+    xcenter_fft, ycenter_fft = int(xsize_fft/2), int(ysize_fft/2)
+    psf_hsize = int(psf_ima.shape[0]/2)
+
+    psf_center = np.zeros(shape, dtype=psf_ima.dtype)
+    index = (slice(ycenter_fft-psf_hsize, ycenter_fft+psf_hsize+1),
+             slice(xcenter_fft-psf_hsize, xcenter_fft+psf_hsize+1))
+    psf_center[index] = psf_ima
+
+    return fft.fftshift(psf_center)
+
+
+################################################################################
+
+def read_psfex_cat (psfcat):
+
+    """Function that returns the source number, X_IMAGE, Y_IMAGE and
+    NORM_PSF of the stars with zero FLAGS_PSF in the PSFEx output
+    catalog [psfcat]. This is a FITS_LDAC table (see [run_psfex]), of
+    which only these columns are read from the memory-mapped file;
+    catalogs in the ASCII_HEAD format of older runs are read with the
+    (much slower) astropy ASCII reader instead."""
+
+    with open(psfcat, 'rb') as f:
+        is_fits = (f.read(6) == b'SIMPLE')
+
+    columns = ['SOURCE_NUMBER', 'X_IMAGE', 'Y_IMAGE', 'NORM_PSF']
+    if is_fits:
+        with fits.open(psfcat, memmap=True) as hdulist:
+            # the objects are in the last LDAC_OBJECTS extension
+            ext = [i for i, hdu in enumerate(hdulist)
+                   if hdu.header.get('EXTNAME')=='LDAC_OBJECTS'][-1]
+            data = hdulist[ext].data
+            colnames = data.columns.names
+            # In PSFEx version 3.17.1 (last stable version), only
+            # stars with zero flags are recorded in the output
+            # catalog. However, in PSFEx version 3.18.2 all objects
+            # from the SExtractor catalog are recorded, and in that
+            # case the entries with FLAGS_PSF=0 need to be selected
+            if 'FLAGS_PSF' in colnames:
+                mask_zero = (data['FLAGS_PSF']==0)
+            else:
+                mask_zero = np.ones(len(data), dtype=bool)
+            result = [np.array(data[col][mask_zero]) for col in columns]
+    else:
+        table = ascii.read(psfcat, format='sextractor')
+        if 'FLAGS_PSF' in table.colnames:
+            mask_zero = (table['FLAGS_PSF']==0)
+        else:
+            mask_zero = np.ones(len(table), dtype=bool)
+        result = [np.array(table[col][mask_zero]) for col in columns]
+        
+    return result
+        
 
 ################################################################################
 
@@ -3857,97 +5830,40 @@ def get_fratio_dxdy(psfcat_new, psfcat_ref, sexcat_new, sexcat_ref,
     t = time.time()
     log.info('Executing get_fratio_dxdy ...')
     
-    def readcat (psfcat):
-        table = ascii.read(psfcat, format='sextractor')
-        # In PSFEx version 3.17.1 (last stable version), only stars
-        # with zero flags are recorded in the output catalog. However,
-        # in PSFEx version 3.18.2 all objects from the SExtractor
-        # catalog are recorded, and in that case the entries with
-        # FLAGS_PSF=0 need to be selected to speed up this function
-        # significantly in case SExtractor detects many sources.
-        if 'FLAGS_PSF' in table.colnames:
-            mask_zero = (table['FLAGS_PSF']==0)
-        else:
-            mask_zero = np.ones(len(table), dtype=bool)
-        number = table['SOURCE_NUMBER'][mask_zero]
-        x = table['X_IMAGE'][mask_zero]
-        y = table['Y_IMAGE'][mask_zero]
-        norm = table['NORM_PSF'][mask_zero]
-        return number, x, y, norm
-        
     # read psfcat_new
-    number_new, x_new, y_new, norm_new = readcat(psfcat_new)
+    number_new, x_new, y_new, norm_new = read_psfex_cat (psfcat_new)
     # read psfcat_ref
-    number_ref, x_ref, y_ref, norm_ref = readcat(psfcat_ref)
+    number_ref, x_ref, y_ref, norm_ref = read_psfex_cat (psfcat_ref)
 
     if C.verbose:
         log.info('new: number of PSF stars with zero FLAGS: {}'.format(len(x_new)))
         log.info('ref: number of PSF stars with zero FLAGS: {}'.format(len(x_ref)))
     
-    def xy2radec (number, sexcat):
-
-        '''Function to return the RA and DEC from the binary fits SExtractor
-        catalog [sexcat] using the columns ALPHAWIN_J2000 and
-        DELTAWIN_J2000.  [number] is an array of integers, indicating
-        the source number in the SExtractor catalog [sexcat].'''
-
-        # read SExtractor fits table
-        data = read_hdulist (sexcat, ext_data=1)
-        ra_sex = data['ALPHAWIN_J2000']
-        dec_sex = data['DELTAWIN_J2000']
-        # loop numbers and record in ra, dec
-        ra = []
-        dec = []
-        for n in number:
-            ra.append(ra_sex[n-1])
-            dec.append(dec_sex[n-1])
-        return np.array(ra), np.array(dec)
-    
     # get reference ra, dec corresponding to x, y
-    #ra_new, dec_new = xy2radec(number_new, sexcat_new)
-    #ra_ref, dec_ref = xy2radec(number_ref, sexcat_ref)
-    # instead use wcs.all_pix2world
-    wcs = WCS(header_ref)
+    wcs = wcs_transform(header_ref)
     ra_ref, dec_ref = wcs.all_pix2world(x_ref, y_ref, 1)
 
     # convert the reference RA and DEC to pixels in the new frame
-    wcs = WCS(header_new)
+    wcs = wcs_transform(header_new)
     x_ref2new, y_ref2new = wcs.all_world2pix(ra_ref, dec_ref, 1)
 
-    # these can be compared to x_new and y_new
-    # to find matching entries
-    x_new_match = []
-    y_new_match = []
-    dx_match = []
-    dy_match = []
-    fratio_match = []
-    nmatch = 0
+    # these can be compared to x_new and y_new to find matching
+    # entries using function [match_coords]
     dist_max = 5. #pixels
-    for i_new in range(len(x_new)):
-        # calculate distance to ref objects
-        dx_temp = x_new[i_new] - x_ref2new
-        dy_temp = y_new[i_new] - y_ref2new
-        dist = np.sqrt(dx_temp**2 + dy_temp**2)
-        # minimum distance and its index
-        dist_min, i_ref = np.amin(dist), np.argmin(dist)
-        if dist_min <= dist_max:
-            nmatch += 1
-            x_new_match.append(x_new[i_new])
-            y_new_match.append(y_new[i_new])
-            dx_match.append(dx_temp[i_ref])
-            dy_match.append(dy_temp[i_ref])
-            # append ratio of normalized counts to fratios
-            fratio_match.append(norm_new[i_new] / norm_ref[i_ref])
+    index_new, index_ref, dist = match_coords (np.column_stack([x_new, y_new]),
+                                               np.column_stack([x_ref2new, y_ref2new]),
+                                               dist_max)
+    nmatch = len(index_new)
+    x_new_match = np.asarray(x_new[index_new])
+    y_new_match = np.asarray(y_new[index_new])
+    dx_match = np.asarray(x_new_match - x_ref2new[index_ref])
+    dy_match = np.asarray(y_new_match - y_ref2new[index_ref])
+    # ratio of normalized counts
+    fratio_match = np.asarray(norm_new[index_new] / norm_ref[index_ref])
                         
     if C.verbose:
         log.info('fraction of PSF stars that match: ' + str(float(nmatch)/len(x_new)))
 
-    x_new_match = np.asarray(x_new_match)
-    y_new_match = np.asarray(y_new_match)
-    dx_match = np.asarray(dx_match)
-    dy_match = np.asarray(dy_match)
-    fratio_match = np.asarray(fratio_match)
-        
     # now also determine arrays for fratio, dx and dy to be used in
     # function [zogy_subloop]:
     fratio_sub = np.zeros(nsubs)
@@ -3989,41 +5905,39 @@ def get_fratio_dxdy(psfcat_new, psfcat_ref, sexcat_new, sexcat_ref,
             return value_local
 
         
+    # assign the matches to the subimages in a single pass using
+    # function [bin_subimages]
+    y_index = (y_new_match-0.5).astype(int)
+    x_index = (x_new_match-0.5).astype(int)
+    index_sub = bin_subimages (y_index, x_index, cuts_ima)
+    
     # loop subimages
     for nsub in range(nsubs):
         
-        # [subcut] defines the pixel indices [y1 y2 x1 x2] identifying
-        # the corners of the subimage in the entire input/output image
-        # coordinate frame; used various times below
-        subcut = cuts_ima[nsub]
-
         # start with full-frame values
         fratio_mean, fratio_std, fratio_median = fratio_mean_full, fratio_std_full, fratio_median_full
         dx = dx_full
         dy = dy_full
         
-        # determine mask of full-frame matched values belonging to
-        # this subimage
-        y_index = (y_new_match-0.5).astype('uint16')
-        x_index = (x_new_match-0.5).astype('uint16')
-        mask_sub = ((y_index >= subcut[0]) & (y_index < subcut[1]) & 
-                    (x_index >= subcut[2]) & (x_index < subcut[3]))
+        # indices of full-frame matched values belonging to this
+        # subimage
+        index_match_sub = index_sub[nsub]
 
         # require a minimum number of values before adopting local
         # values for fratio, dx and dy
-        if np.sum(mask_sub) >= 15:
+        if len(index_match_sub) >= 15:
             
             if C.fratio_local:
                 # determine local fratios
-                fratio_mean, fratio_std, fratio_median = clipped_stats(fratio_match[mask_sub],
+                fratio_mean, fratio_std, fratio_median = clipped_stats(fratio_match[index_match_sub],
                                                                        log=log)
                 fratio_mean = local_or_full (fratio_mean, fratio_mean_full, fratio_std_full, log)
                     
             # and the same for dx and dy
             if C.dxdy_local:
                 # determine local values
-                dx_mean, dx_std, dx_median = clipped_stats(dx_match[mask_sub], log=log)
-                dy_mean, dy_std, dy_median = clipped_stats(dy_match[mask_sub], log=log)
+                dx_mean, dx_std, dx_median = clipped_stats(dx_match[index_match_sub], log=log)
+                dy_mean, dy_std, dy_median = clipped_stats(dy_match[index_match_sub], log=log)
                 dx = np.sqrt(dx_mean**2 + dx_std**2)
                 dy = np.sqrt(dy_mean**2 + dy_std**2)
 
@@ -4059,28 +5973,10 @@ def get_fratio_radec(psfcat_new, psfcat_ref, sexcat_new, sexcat_ref, log):
     t = time.time()
     log.info('Executing get_fratio_radec ...')
     
-    def readcat (psfcat):
-        table = ascii.read(psfcat, format='sextractor')
-        # In PSFEx version 3.17.1 (last stable version), only stars
-        # with zero flags are recorded in the output catalog. However,
-        # in PSFEx version 3.18.2 all objects from the SExtractor
-        # catalog are recorded, and in that case the entries with
-        # FLAGS_PSF=0 need to be selected to speed up this function
-        # significantly in case SExtractor detects many sources.
-        if 'FLAGS_PSF' in table.colnames:
-            mask_zero = (table['FLAGS_PSF']==0)
-        else:
-            mask_zero = np.ones(len(table), dtype=bool)
-        number = table['SOURCE_NUMBER'][mask_zero]
-        x = table['X_IMAGE'][mask_zero]
-        y = table['Y_IMAGE'][mask_zero]
-        norm = table['NORM_PSF'][mask_zero]
-        return number, x, y, norm
-        
     # read psfcat_new
-    number_new, x_new, y_new, norm_new = readcat(psfcat_new)
+    number_new, x_new, y_new, norm_new = read_psfex_cat (psfcat_new)
     # read psfcat_ref
-    number_ref, x_ref, y_ref, norm_ref = readcat(psfcat_ref)
+    number_ref, x_ref, y_ref, norm_ref = read_psfex_cat (psfcat_ref)
 
     if C.verbose:
         log.info('new: number of PSF stars with zero FLAGS: {}'.format(len(x_new)))
@@ -4097,40 +5993,27 @@ def get_fratio_radec(psfcat_new, psfcat_ref, sexcat_new, sexcat_ref, log):
         data = read_hdulist (sexcat, ext_data=1)
         ra_sex = data['ALPHAWIN_J2000']
         dec_sex = data['DELTAWIN_J2000']
-        # loop numbers and record in ra, dec
-        ra = []
-        dec = []
-        for n in number:
-            ra.append(ra_sex[n-1])
-            dec.append(dec_sex[n-1])
-        return np.array(ra), np.array(dec)
+        # select the entries corresponding to [number]
+        index = np.asarray(number) - 1
+        return np.asarray(ra_sex[index]), np.asarray(dec_sex[index])
     
     # get ra, dec corresponding to x, y
     ra_new, dec_new = xy2radec(number_new, sexcat_new)
     ra_ref, dec_ref = xy2radec(number_ref, sexcat_ref)
 
-    # now find matching entries
-    x_new_match = []
-    y_new_match = []
-    dra_match = []
-    ddec_match = []
-    fratio = []
-    nmatch = 0
-    for i_new in range(len(x_new)):
-        # calculate distance to ref objects
-        dra = 3600.*(ra_new[i_new]-ra_ref)*np.cos(dec_new[i_new]*np.pi/180.)
-        ddec = 3600.*(dec_new[i_new]-dec_ref)
-        dist = np.sqrt(dra**2 + ddec**2)
-        # minimum distance and its index
-        dist_min, i_ref = np.amin(dist), np.argmin(dist)
-        if dist_min < 3.:
-            nmatch += 1
-            x_new_match.append(x_new[i_new])
-            y_new_match.append(y_new[i_new])
-            dra_match.append(dra[i_ref])
-            ddec_match.append(ddec[i_ref])
-            # append ratio of normalized counts to fratios
-            fratio.append(norm_new[i_new] / norm_ref[i_ref])
+    # now find matching entries using function [match_coords] on
+    # the unit vectors of the positions on the sphere
+    dist_max = 3. #arcsec
+    index_new, index_ref, dist = match_coords (radec2xyz(ra_new, dec_new),
+                                               radec2xyz(ra_ref, dec_ref),
+                                               dist_max, unit='arcsec')
+    nmatch = len(index_new)
+    x_new_match = np.asarray(x_new[index_new])
+    y_new_match = np.asarray(y_new[index_new])
+    dra_match = 3600.*(ra_new[index_new]-ra_ref[index_ref])*np.cos(dec_new[index_new]*np.pi/180.)
+    ddec_match = 3600.*(dec_new[index_new]-dec_ref[index_ref])
+    # ratio of normalized counts
+    fratio = np.asarray(norm_new[index_new] / norm_ref[index_ref])
                         
     if C.verbose:
         log.info('fraction of PSF stars that match: ' + str(float(nmatch)/len(x_new)))
@@ -4142,6 +6025,180 @@ def get_fratio_radec(psfcat_new, psfcat_ref, sexcat_new, sexcat_ref, log):
             np.array(dra_match), np.array(ddec_match))
 
 
+################################################################################
+
+def match_coords (coords1, coords2, dist_max, mutual=False, unit=None):
+
+    """Function that matches each entry of [coords1] with shape (N,k) to
+    its nearest entry in [coords2] with shape (M,k), using a KD-tree
+    of [coords2]. Only matches within a distance [dist_max] are
+    returned. If [mutual] is True, a match is only accepted if the
+    entry in [coords1] is also the nearest to the entry in [coords2].
+    If [unit] is 'arcsec' or 'deg', the coordinates are assumed to be
+    unit vectors on the sphere (see [radec2xyz]), and [dist_max] and
+    the output distances are angular separations in that unit.
+    Returns the indices in [coords1] and [coords2] of the matches and
+    their distance.
+
+    """
+
+    coords1 = np.asarray(coords1, dtype='float64')
+    coords2 = np.asarray(coords2, dtype='float64')
+    
+    # convert angular distance to chord length
+    if unit is not None:
+        angle_max = dist_max / {'arcsec': 3600., 'deg': 1.}[unit] * np.pi/180.
+        dist_max_tree = 2.*np.sin(min(angle_max, np.pi)/2.)
+    else:
+        dist_max_tree = dist_max
+
+    if len(coords1)==0 or len(coords2)==0:
+        return np.zeros(0, dtype=int), np.zeros(0, dtype=int), np.zeros(0)
+        
+    tree2 = cKDTree(coords2)
+    dist, index2 = tree2.query(coords1, k=1, distance_upper_bound=dist_max_tree)
+    # non-matches have infinite distance
+    mask_match = np.isfinite(dist)
+    index1 = np.nonzero(mask_match)[0]
+    index2 = index2[mask_match]
+    dist = dist[mask_match]
+
+    if mutual and len(index1) > 0:
+        tree1 = cKDTree(coords1)
+        __, index1_nearest = tree1.query(coords2[index2], k=1)
+        mask_mutual = (index1_nearest == index1)
+        index1 = index1[mask_mutual]
+        index2 = index2[mask_mutual]
+        dist = dist[mask_mutual]
+
+    # convert chord length back to angular distance
+    if unit is not None:
+        dist = 2.*np.arcsin(np.minimum(dist/2., 1.)) * 180./np.pi
+        dist *= {'arcsec': 3600., 'deg': 1.}[unit]
+        
+    return index1, index2, dist
+
+
+################################################################################
+
+def radec2xyz (ra, dec):
+
+    """Function that converts [ra] and [dec] (in degrees) to unit vectors
+    with shape (N,3) on the sphere."""
+
+    ra_rad = np.radians(np.asarray(ra, dtype='float64'))
+    dec_rad = np.radians(np.asarray(dec, dtype='float64'))
+    cos_dec = np.cos(dec_rad)
+    return np.column_stack([cos_dec*np.cos(ra_rad), cos_dec*np.sin(ra_rad),
+                            np.sin(dec_rad)])
+
+
+################################################################################
+
+def match_radec (ra1, dec1, ra2, dec2, dist_max):
+
+    """Function that matches each position in [ra1] and [dec1] to the
+    nearest position in [ra2] and [dec2] within [dist_max], using a
+    KD-tree of the unit vectors on the sphere (see [radec2xyz]). All
+    input coordinates and [dist_max] are in degrees. Returns for each
+    entry in [ra1]: the index of the nearest entry in [ra2] (-1 if
+    there is no match), the distance to it, a boolean indicating
+    whether it is the only entry of [ra2] within [dist_max], and the
+    signed RA and DEC offsets (in degrees) of the matching entry with
+    respect to [ra1] and [dec1], where the RA offset is the angle
+    along the declination of the matching entry.
+
+    """
+
+    ra1 = np.asarray(ra1, dtype='float64')
+    dec1 = np.asarray(dec1, dtype='float64')
+    ra2 = np.asarray(ra2, dtype='float64')
+    dec2 = np.asarray(dec2, dtype='float64')
+    
+    n1 = len(ra1)
+    index_match = np.full(n1, -1)
+    dist = np.zeros(n1)
+    unique = np.zeros(n1, dtype=bool)
+    dra = np.zeros(n1)
+    ddec = np.zeros(n1)
+    if n1 == 0 or len(ra2) == 0:
+        return index_match, dist, unique, dra, ddec
+
+    # query the two nearest neighbours within the chord length
+    # corresponding to [dist_max]; the second is used to determine
+    # whether the match is unique
+    chord_max = 2.*np.sin(np.radians(min(dist_max, 180.))/2.)
+    k = min(2, len(ra2))
+    tree = cKDTree(radec2xyz(ra2, dec2))
+    chord, index = tree.query(radec2xyz(ra1, dec1), k=k,
+                              distance_upper_bound=chord_max)
+    if k == 1:
+        chord = chord[:,None]
+        index = index[:,None]
+        
+    mask_match = np.isfinite(chord[:,0])
+    index_match[mask_match] = index[mask_match,0]
+    dist[mask_match] = np.degrees(2.*np.arcsin(np.minimum(chord[mask_match,0]/2., 1.)))
+    if k == 2:
+        unique[mask_match] = ~np.isfinite(chord[mask_match,1])
+    else:
+        unique[mask_match] = True
+
+    # signed offsets; the RA offset is determined with [haversine]
+    # along the declination of the matching entry
+    i2 = index_match[mask_match]
+    ddec[mask_match] = dec2[i2] - dec1[mask_match]
+    dra[mask_match] = haversine(ra2[i2], dec2[i2], ra1[mask_match], dec2[i2])
+    # add the sign (haversine provides absolute distances), taking
+    # into account the RA wrap at 360 degrees
+    mask_neg = (((ra2[i2] - ra1[mask_match] + 180.) % 360.) - 180. < 0)
+    dra[np.nonzero(mask_match)[0][mask_neg]] *= -1
+    
+    return index_match, dist, unique, dra, ddec
+
+
+################################################################################
+
+def bin_subimages (y_index, x_index, cuts_ima):
+
+    """Function that assigns the pixel indices [y_index] and [x_index]
+    to the subimages defined by [cuts_ima] in a single pass. Returns
+    a list with, for each subimage, the indices of the input entries
+    located in it.
+
+    """
+
+    nsubs = len(cuts_ima)
+    y_index = np.asarray(y_index)
+    x_index = np.asarray(x_index)
+    
+    # edges of the subimages along the y- and x-axis
+    y_edges = np.unique(cuts_ima[:,0])
+    x_edges = np.unique(cuts_ima[:,2])
+    # subimage number for each combination of y and x bin
+    map_sub = np.full((len(y_edges), len(x_edges)), nsubs)
+    map_sub[np.searchsorted(y_edges, cuts_ima[:,0]),
+            np.searchsorted(x_edges, cuts_ima[:,2])] = np.arange(nsubs)
+
+    # y and x bins of the input entries
+    iy = np.searchsorted(y_edges, y_index, side='right') - 1
+    ix = np.searchsorted(x_edges, x_index, side='right') - 1
+    mask_in = ((iy >= 0) & (ix >= 0) & (y_index < np.amax(cuts_ima[:,1])) &
+               (x_index < np.amax(cuts_ima[:,3])))
+    index_sub = np.full(len(y_index), nsubs)
+    index_sub[mask_in] = map_sub[iy[mask_in], ix[mask_in]]
+    # discard entries outside the subimage itself, e.g. in case the
+    # subimages do not cover the full image
+    mask_in[mask_in] = ((y_index[mask_in] < cuts_ima[index_sub[mask_in],1]) &
+                        (x_index[mask_in] < cuts_ima[index_sub[mask_in],3]))
+    index_sub[~mask_in] = nsubs
+
+    # sort the entries by subimage and split
+    index_sort = np.argsort(index_sub, kind='stable')
+    counts = np.bincount(index_sub, minlength=nsubs+1)
+    return np.split(index_sort, np.cumsum(counts)[:nsubs])[:nsubs]
+
+
 ################################################################################
 
 def centers_cutouts(subsize, ysize, xsize, log, get_remainder=False):
@@ -4230,6 +6287,328 @@ def ds9_arrays(regions=None, **kwargs):
     result = subprocess.call(cmd)
 
     
+################################################################################
+
+def verify_wcs (header, data_bright, width, height, pixscale, log):
+
+    """Function that checks whether the WCS solution already present in
+    [header] is accurate enough to skip Astrometry.net. The positions
+    of the bright SExtractor sources in [data_bright] are converted to
+    RA, DEC with this WCS and matched to the calibration catalog
+    within [C.wcs_verify_dist] arcseconds. The WCS is accepted if its
+    pixel scale is consistent with [pixscale], if the fraction of the
+    sources matched is at least [C.wcs_verify_minfrac] and if the
+    median and the standard deviation of the offsets are below
+    [C.wcs_verify_maxoff] and [C.wcs_verify_maxstd] arcseconds,
+    respectively. Returns True if the WCS is accepted."""
+
+    if C.timing: t = time.time()
+    log.info('Executing verify_wcs ...')
+
+    def verified (result, reason):
+        log.info('existing WCS {}accepted: {}'.format('' if result else 'not ', reason))
+        header['A-VERIFY'] = (result, 'existing WCS verified; Astrometry.net skipped?')
+        if C.timing:
+            log_timing_memory (t0=t, label='verify_wcs', log=log)
+        return result
+
+    if not os.path.isfile(C.cal_cat) and not os.path.isdir(C.cal_cat_store):
+        return verified (False, 'calibration catalog {} not found'.format(C.cal_cat))
+
+    try:
+        wcs = WCS(header)
+    except Exception as e:
+        return verified (False, 'WCS could not be read from header: {}'.format(e))
+
+    if not wcs.has_celestial:
+        return verified (False, 'no celestial WCS in header')
+
+    # check that the pixel scale of the WCS is consistent with the
+    # expected one
+    pixscale_wcs = np.sqrt(np.abs(np.linalg.det(wcs.celestial.pixel_scale_matrix))) * 3600.
+    if np.abs(pixscale_wcs/pixscale-1) > C.pixscale_varyfrac:
+        return verified (False, 'pixel scale of {:.4f} arcsec/pix differs from {:.4f}'
+                         .format(pixscale_wcs, pixscale))
+    
+    # read the calibration stars in the field-of-view; if the WCS is
+    # accepted, these are the same stars used in [run_wcs]
+    ra_center, dec_center = wcs.all_pix2world(width/2, height/2, 1)
+    fov_half_deg = np.amax([width, height]) * pixscale / 3600. / 2
+    data_cal = read_cal_cat (ra_center, dec_center, fov_half_deg, log)
+
+    # match the bright sources to the calibration stars
+    ra_bright, dec_bright = wcs.all_pix2world(data_bright['XWIN_IMAGE'],
+                                              data_bright['YWIN_IMAGE'], 1)
+    index_match, dist, unique, dra, ddec = match_radec (ra_bright, dec_bright,
+                                                        data_cal['ra'], data_cal['dec'],
+                                                        C.wcs_verify_dist/3600.)
+    mask_match = (index_match >= 0)
+    nmatch = np.sum(mask_match)
+    frac_match = nmatch / max(len(ra_bright), 1.)
+    header['A-VFRAC'] = (frac_match, 'fraction of bright sources matched to cal. cat.')
+    if nmatch < 10 or frac_match < C.wcs_verify_minfrac:
+        return verified (False, 'only {} ({:.2f}) of {} bright sources matched'
+                         .format(nmatch, frac_match, len(ra_bright)))
+    
+    # offsets in arcseconds
+    dra_mean, dra_std, dra_median = clipped_stats(dra[mask_match]*3600., nsigma=5, log=log)
+    ddec_mean, ddec_std, ddec_median = clipped_stats(ddec[mask_match]*3600., nsigma=5, log=log)
+    off = np.sqrt(dra_median**2 + ddec_median**2)
+    std = np.sqrt(dra_std**2 + ddec_std**2)
+    header['A-VSTD'] = (std, '[arcsec] sigma (STD) offsets existing WCS')
+    if off > C.wcs_verify_maxoff or std > C.wcs_verify_maxstd:
+        return verified (False, 'median offset: {:.3f} arcsec, sigma: {:.3f} arcsec'
+                         .format(off, std))
+
+    header['A-PSCALE'] = (pixscale_wcs, '[arcsec/pix] pixel scale WCS solution')
+    return verified (True, '{} ({:.2f}) of bright sources matched with median offset '
+                     '{:.3f} arcsec and sigma {:.3f} arcsec'.format(nmatch, frac_match, off, std))
+
+
+################################################################################
+
+def tpv_terms (order):
+
+    """Function that returns a list of (term number, power of x, power
+    of y) of the non-radial terms of a TPV polynomial up to [order],
+    i.e. the keywords PV1_[term number] of the RA---TPV axis; for the
+    DEC--TPV axis (PV2_[term number]) the roles of x and y are
+    swapped."""
+
+    terms = []
+    i = 0
+    for n in range(order+1):
+        for k in range(n+1):
+            terms.append((i, n-k, k))
+            i += 1
+        # skip the radial term that follows the odd orders
+        if n % 2 == 1:
+            i += 1
+
+    return terms
+        
+
+################################################################################
+
+def refine_wcs (header, data_bright, width, height, pixscale, log):
+
+    """Function that refines the approximate WCS solution in [header]
+    by matching the bright SExtractor sources in [data_bright] to the
+    calibration catalog and fitting a TPV distortion polynomial of
+    order [C.astronet_tweak_order] to the standard coordinates of the
+    matched calibration stars, iteratively with linear least squares
+    and rejection of outliers. The reference pixel, CRVAL and CD
+    matrix of the input WCS are kept, and the fitted polynomial also
+    absorbs any offset, rotation and scale error. If the scatter of
+    the residuals is below [C.wcs_verify_maxstd] arcseconds, the TPV
+    solution is written to [header] and True is returned, otherwise
+    [header] is not changed and False is returned."""
+
+    if C.timing: t = time.time()
+    log.info('Executing refine_wcs ...')
+
+    def refined (result, reason):
+        log.info('WCS {}refined: {}'.format('' if result else 'not ', reason))
+        header['A-REFINE'] = (result, 'existing WCS refined; Astrometry.net skipped?')
+        if C.timing:
+            log_timing_memory (t0=t, label='refine_wcs', log=log)
+        return result
+
+    if not os.path.isfile(C.cal_cat) and not os.path.isdir(C.cal_cat_store):
+        return refined (False, 'calibration catalog {} not found'.format(C.cal_cat))
+
+    try:
+        wcs = WCS(header)
+    except Exception as e:
+        return refined (False, 'WCS could not be read from header: {}'.format(e))
+
+    if not wcs.has_celestial:
+        return refined (False, 'no celestial WCS in header')
+
+    wcs = wcs.celestial
+    crpix = wcs.wcs.crpix
+    ra0, dec0 = wcs.wcs.crval
+    cd = wcs.pixel_scale_matrix
+
+    # unit vectors of the tangent point and the east and north
+    # directions in the tangent plane
+    n0 = radec2xyz(ra0, dec0)[0]
+    e_east = np.array([-np.sin(np.radians(ra0)), np.cos(np.radians(ra0)), 0.])
+    e_north = np.cross(n0, e_east)
+
+    def project (ra, dec):
+        # gnomonic projection of [ra], [dec] onto standard
+        # coordinates xi, eta (degrees)
+        xyz = radec2xyz(ra, dec)
+        w = np.dot(xyz, n0)
+        return np.degrees(np.dot(xyz, e_east)/w), np.degrees(np.dot(xyz, e_north)/w)
+
+    # read the calibration stars in the field-of-view and project
+    # them onto the tangent plane
+    ra_center, dec_center = wcs.all_pix2world(width/2, height/2, 1)
+    fov_half_deg = np.amax([width, height]) * pixscale / 3600. / 2
+    data_cal = read_cal_cat (ra_center, dec_center, fov_half_deg, log)
+    xi_cal, eta_cal = project (data_cal['ra'], data_cal['dec'])
+    coords_cal = np.column_stack([xi_cal, eta_cal])
+    
+    # intermediate world coordinates (degrees) of the bright sources
+    # with the CD matrix of the input WCS, normalised with [norm] to
+    # keep the least-squares problem well conditioned
+    pix = np.column_stack([data_bright['XWIN_IMAGE'], data_bright['YWIN_IMAGE']]) - crpix
+    uv = np.dot(pix, cd.T)
+    norm = np.amax(np.abs(uv))
+    u = uv[:,0]/norm
+    v = uv[:,1]/norm
+
+    # design matrices of the TPV polynomials of both axes
+    terms = tpv_terms (C.astronet_tweak_order)
+    A_xi = np.column_stack([u**px * v**py for (i, px, py) in terms])
+    A_eta = np.column_stack([v**px * u**py for (i, px, py) in terms])
+    scale = np.array([norm**(px+py) for (i, px, py) in terms])
+    
+    # initial standard coordinates of the sources from the input WCS
+    ra_bright, dec_bright = wcs.all_pix2world(data_bright['XWIN_IMAGE'],
+                                              data_bright['YWIN_IMAGE'], 1)
+    xi, eta = project (ra_bright, dec_bright)
+
+    # iteratively match, fit and reject outliers, starting with the
+    # matching radius [C.wcs_refine_dist]
+    dist_max = C.wcs_refine_dist / 3600.
+    nmin = 3 * len(terms)
+    for it in range(C.wcs_refine_niter):
+
+        index_src, index_cal, dist = match_coords (np.column_stack([xi, eta]), coords_cal,
+                                                   dist_max, mutual=True)
+        if len(index_src) < nmin:
+            return refined (False, 'only {} bright sources matched'.format(len(index_src)))
+
+        # fit, rejecting outliers of the residuals
+        mask_fit = np.ones(len(index_src), dtype=bool)
+        for it_clip in range(5):
+            i_src = index_src[mask_fit]
+            i_cal = index_cal[mask_fit]
+            coeff_xi = np.linalg.lstsq(A_xi[i_src], xi_cal[i_cal], rcond=None)[0]
+            coeff_eta = np.linalg.lstsq(A_eta[i_src], eta_cal[i_cal], rcond=None)[0]
+            dxi = np.dot(A_xi[index_src], coeff_xi) - xi_cal[index_cal]
+            deta = np.dot(A_eta[index_src], coeff_eta) - eta_cal[index_cal]
+            resid = np.sqrt(dxi**2 + deta**2)
+            std = np.sqrt(np.mean(resid[mask_fit]**2)/2)
+            mask_fit_new = (resid <= C.wcs_refine_nsigma * np.sqrt(2) * std)
+            if np.sum(mask_fit_new) < nmin or np.array_equal(mask_fit_new, mask_fit):
+                break
+            mask_fit = mask_fit_new
+            
+        # standard coordinates of all sources with this solution; for
+        # the next iteration the matching radius is narrowed down
+        xi = np.dot(A_xi, coeff_xi)
+        eta = np.dot(A_eta, coeff_eta)
+        dist_max = max(C.wcs_refine_nsigma * np.sqrt(2) * std, 0.5 * C.wcs_verify_dist / 3600.)
+
+    nfit = np.sum(mask_fit)
+    std *= 3600.
+    log.info('WCS refinement: {} of {} matched sources used, sigma: {:.3f} arcsec'
+             .format(nfit, len(index_src), std))
+    if std > C.wcs_verify_maxstd:
+        return refined (False, 'sigma of {:.3f} arcsec exceeds {} arcsec'
+                        .format(std, C.wcs_verify_maxstd))
+
+    # replace WCS keywords in header with the TPV solution
+    for key in list(header.keys()):
+        if (key.startswith(('A_', 'B_', 'AP_', 'BP_', 'PV1_', 'PV2_', 'PC1_', 'PC2_'))
+            or key in ['CDELT1', 'CDELT2', 'CROTA2', 'LONPOLE', 'LATPOLE']):
+            del header[key]
+    header['CTYPE1'] = ('RA---TPV', 'TPV projection')
+    header['CTYPE2'] = ('DEC--TPV', 'TPV projection')
+    header['CRVAL1'] = (ra0, 'RA of reference point')
+    header['CRVAL2'] = (dec0, 'DEC of reference point')
+    header['CRPIX1'] = (crpix[0], 'X reference pixel')
+    header['CRPIX2'] = (crpix[1], 'Y reference pixel')
+    header['CUNIT1'] = ('deg', 'X pixel scale units')
+    header['CUNIT2'] = ('deg', 'Y pixel scale units')
+    header['CD1_1'] = (cd[0,0], 'Transformation matrix')
+    header['CD1_2'] = (cd[0,1], 'Transformation matrix')
+    header['CD2_1'] = (cd[1,0], 'Transformation matrix')
+    header['CD2_2'] = (cd[1,1], 'Transformation matrix')
+    coeff_xi /= scale
+    coeff_eta /= scale
+    for j, (i, px, py) in enumerate(terms):
+        header['PV1_{}'.format(i)] = (coeff_xi[j], 'TPV distortion coefficient')
+    for j, (i, px, py) in enumerate(terms):
+        header['PV2_{}'.format(i)] = (coeff_eta[j], 'TPV distortion coefficient')
+    pixscale_wcs = np.sqrt(np.abs(np.linalg.det(cd) * (coeff_xi[1]*coeff_eta[1] -
+                                                       coeff_xi[2]*coeff_eta[2]))) * 3600.
+    header['A-PSCALE'] = (pixscale_wcs, '[arcsec/pix] pixel scale WCS solution')
+    header['A-RSTD'] = (std, '[arcsec] sigma (STD) residuals WCS refinement')
+
+    return refined (True, '{} sources used, sigma: {:.3f} arcsec'.format(nfit, std))
+
+
+################################################################################
+
+# [anet_index_info] holds the HEALPix tile and resolution of each
+# Astrometry.net index file, and [anet_index_cache] the index files
+# selected for each field ID by [select_anet_index]
+anet_index_info = None
+anet_index_cache = {}
+
+def select_anet_index (ra, dec, radius, field_id, log):
+
+    """Function that returns the Astrometry.net index files in
+    [C.astronet_index_dir] that overlap with the circle with [radius]
+    around [ra] and [dec] (all in degrees). Index files that cover a
+    single HEALPix tile (header keywords HEALPIX and HPNSIDE) are only
+    selected if their tile overlaps with the circle, while all-sky
+    index files are always selected. Astrometry.net numbers the tiles
+    as [base pixel]*nside**2 + x*nside + y, where the bits of x and y
+    are the even and odd bits of the pixel number within the base
+    pixel in the HEALPix nested scheme (see healpixl_nested_to_xy in
+    Astrometry.net's healpix.c). The selection is kept in
+    [anet_index_cache] for [field_id], if it is not None."""
+
+    if C.timing: t = time.time()
+    log.info('Executing select_anet_index ...')
+
+    global anet_index_info
+    if field_id is not None and field_id in anet_index_cache:
+        index_files = anet_index_cache[field_id]
+        log.info('using cached selection of {} index files for field ID {}'
+                 .format(len(index_files), field_id))
+        return index_files
+
+    # read the HEALPix tile of all index files once
+    if anet_index_info is None:
+        anet_index_info = []
+        for index_file in sorted(glob.glob(os.path.join(C.astronet_index_dir, 'index-*.fits'))):
+            header_index = read_hdulist (index_file, ext_header=0)
+            anet_index_info.append((index_file, header_index.get('HEALPIX', -1),
+                                    header_index.get('HPNSIDE', 1)))
+
+    # tiles overlapping with the circle, for each resolution
+    tiles = {}
+    for nside in set([info[2] for info in anet_index_info if info[1] != -1]):
+        ipix = healpix_in_circle (nside, ra, dec, radius)
+        face = ipix // nside**2
+        ipix_face = ipix % nside**2
+        x = np.zeros(len(ipix), dtype='int64')
+        y = np.zeros(len(ipix), dtype='int64')
+        for b in range(int(np.log2(nside))):
+            x |= ((ipix_face >> (2*b)) & 1) << b
+            y |= ((ipix_face >> (2*b+1)) & 1) << b
+        tiles[nside] = set(face*nside**2 + x*nside + y)
+
+    index_files = [index_file for (index_file, healpix, nside) in anet_index_info
+                   if healpix == -1 or healpix in tiles[nside]]
+    log.info('selected {} of {} index files'.format(len(index_files), len(anet_index_info)))
+    
+    if field_id is not None:
+        anet_index_cache[field_id] = index_files
+        
+    if C.timing:
+        log_timing_memory (t0=t, label='select_anet_index', log=log)
+
+    return index_files
+
+
 ################################################################################
 
 def run_wcs(image_in, image_out, ra, dec, pixscale, width, height, header, log):
@@ -4266,101 +6645,129 @@ def run_wcs(image_in, image_out, ra, dec, pixscale, width, height, header, log):
                                  data_sexcat['YWIN_IMAGE'][mask_use][index_sort][-nbright:],
                                  radius=5., width=2, color='green')
         
-    #scampcat = image_in.replace('.fits','.scamp')
-    cmd = ['solve-field', '--no-plots', #'--no-fits2fits', cloud version of astrometry does not have this arg
-           '--x-column', 'XWIN_IMAGE', '--y-column', 'YWIN_IMAGE',
-           '--sort-column', 'FLUX_AUTO',
-           '--no-remove-lines', '--uniformize', '0',
-           # only work on brightest sources
-           #'--objs', '1000',
-           '--width', str(width), '--height', str(height),           
-           #'--keep-xylist', sexcat,
-           # ignore existing WCS headers in FITS input images
-           #'--no-verify', 
-           #'--verbose',
-           #'--verbose',
-           #'--parity', 'neg',
-           #'--code-tolerance', str(0.01), 
-           #'--quad-size-min', str(0.1),
-           # for KMTNet images restrict the max quad size:
-           #'--quad-size-max', str(0.1),
-           # number of field objects to look at:
-           '--depth', '50,150,200,250,300,350,400,450,500',
-           #'--scamp', scampcat,
-           sexcat_bright,
-           '--tweak-order', str(C.astronet_tweak_order), '--scale-low', str(scale_low),
-           '--scale-high', str(scale_high), '--scale-units', 'app',
-           '--ra', str(ra), '--dec', str(dec), '--radius', str(C.astronet_radius),
-           '--new-fits', image_out, '--overwrite',
-           '--out', base
-    ]
+    # before running Astrometry.net, check with function
+    # [verify_wcs] whether the WCS already present in the header
+    # (e.g. from a previous exposure of the same field) is accurate
+    # enough; if so, solve-field is skipped
+    wcs_verified = False
+    if C.wcs_verify:
+        wcs_verified = verify_wcs (header, data_sexcat[mask_use][index_sort][-nbright:],
+                                   width, height, pixscale, log)
+        # if not, try to refine it with function [refine_wcs]
+        if not wcs_verified and C.wcs_refine:
+            wcs_verified = refine_wcs (header, data_sexcat[mask_use][index_sort][-nbright:],
+                                       width, height, pixscale, log)
+
+    if not wcs_verified:
+
+        #scampcat = image_in.replace('.fits','.scamp')
+        cmd = ['solve-field', '--no-plots', #'--no-fits2fits', cloud version of astrometry does not have this arg
+               '--x-column', 'XWIN_IMAGE', '--y-column', 'YWIN_IMAGE',
+               '--sort-column', 'FLUX_AUTO',
+               '--no-remove-lines', '--uniformize', '0',
+               # only work on brightest sources
+               #'--objs', '1000',
+               '--width', str(width), '--height', str(height),           
+               #'--keep-xylist', sexcat,
+               # ignore existing WCS headers in FITS input images
+               #'--no-verify', 
+               #'--verbose',
+               #'--verbose',
+               #'--parity', 'neg',
+               #'--code-tolerance', str(0.01), 
+               #'--quad-size-min', str(0.1),
+               # for KMTNet images restrict the max quad size:
+               #'--quad-size-max', str(0.1),
+               # number of field objects to look at:
+               '--depth', '50,150,200,250,300,350,400,450,500',
+               #'--scamp', scampcat,
+               sexcat_bright,
+               '--tweak-order', str(C.astronet_tweak_order), '--scale-low', str(scale_low),
+               '--scale-high', str(scale_high), '--scale-units', 'app',
+               '--ra', str(ra), '--dec', str(dec), '--radius', str(C.astronet_radius),
+               '--new-fits', 'none' if C.wcs_header_only else image_out, '--overwrite',
+               '--out', base
+        ]
+
+        # only let solve-field load the index files that overlap with
+        # the field, using a backend configuration file for this run
+        if C.astronet_index_dir is not None and os.path.isdir(C.astronet_index_dir):
+            fov_half_deg = np.amax([width, height]) * pixscale / 3600. / 2
+            radius = C.astronet_radius + np.sqrt(2) * fov_half_deg
+            index_files = select_anet_index (ra, dec, radius, header.get(C.key_fieldid), log)
+            if len(index_files) > 0:
+                backend_cfg = base+'_backend.cfg'
+                with open(backend_cfg, 'w') as f:
+                    if C.astronet_inparallel:
+                        f.write('inparallel\n')
+                    for index_file in index_files:
+                        f.write('index {}\n'.format(index_file))
+                cmd += ['--backend-config', backend_cfg]
+
+        # log cmd executed
+        cmd_str = ' '.join(cmd)
+        log.info('Astrometry.net command executed:\n{}'.format(cmd_str))
+    
+        process=subprocess.Popen(cmd,stdout=subprocess.PIPE,stderr=subprocess.PIPE)
+        (stdoutstr,stderrstr) = process.communicate()
+        status = process.returncode
+        log.info(stdoutstr)
+        log.info(stderrstr)
+
+        # read header of .match file, which describes the quad match that
+        # solved the image
+        data_match = read_hdulist (base+'.match', ext_data=1)
+        
+        if os.path.exists("%s.solved"%base) and status==0:
+            os.remove("%s.solved"%base)
+            #os.remove("%s.match"%base)
+            #os.remove("%s.rdls"%base)
+            #os.remove("%s.corr"%base)
+            #os.remove("%s-indx.xyls"%base)
+        else:
+            log.error("Solving WCS failed.")
+            return 'error'
 
-    # log cmd executed
-    cmd_str = ' '.join(cmd)
-    log.info('Astrometry.net command executed:\n{}'.format(cmd_str))
+        if C.timing: t2 = time.time()
+
+        # read header saved in .wcs 
+        wcsfile = base+'.wcs'
+        header_wcs = read_hdulist (wcsfile, ext_header=0)
+
+        # remove HISTORY, COMMENT and DATE fields from Astrometry.net header
+        # they are still present in the base+'.wcs' file
+        header_wcs.pop('HISTORY', None)
+        header_wcs.pop('COMMENT', None)
+        header_wcs.pop('DATE', None)
     
-    process=subprocess.Popen(cmd,stdout=subprocess.PIPE,stderr=subprocess.PIPE)
-    (stdoutstr,stderrstr) = process.communicate()
-    status = process.returncode
-    log.info(stdoutstr)
-    log.info(stderrstr)
+        # add specific keyword indicating index file of match
+        if data_match['HEALPIX'][0]!=-1:
+            anet_index = 'index-{}-{:02d}.fits'.format(data_match['INDEXID'][0], data_match['HEALPIX'][0])
+        else:
+            anet_index = 'index-{}.fits'.format(data_match['INDEXID'][0])
+        header_wcs['A-INDEX'] = (anet_index, 'name of index file WCS solution')
+        # and pixelscale
+        anet_pixscale = np.average(np.abs(data_match['CD'][0][1:3]))*3600.
+        header_wcs['A-PSCALE'] = (anet_pixscale, '[arcsec/pix] pixel scale WCS solution')
 
-    # read header of .match file, which describes the quad match that
-    # solved the image
-    data_match = read_hdulist (base+'.match', ext_data=1)
-        
-    if os.path.exists("%s.solved"%base) and status==0:
-        os.remove("%s.solved"%base)
-        #os.remove("%s.match"%base)
-        #os.remove("%s.rdls"%base)
-        #os.remove("%s.corr"%base)
-        #os.remove("%s-indx.xyls"%base)
-    else:
-        log.error("Solving WCS failed.")
-        return 'error'
+        # convert SIP header keywords from Astrometry.net to PV keywords
+        # that swarp, scamp (and sextractor) understand using this module
+        # from David Shupe: sip_to_pv
 
-    if C.timing: t2 = time.time()
+        # using the old version of sip_to_pv (before June 2017):
+        #status = sip_to_pv(image_out, image_out, log, tpv_format=True)
+        #if status == False:
+        #    log.error('sip_to_pv failed.')
+        #    return 'error'
 
-    # read image_in
-    data = read_hdulist (image_in, ext_data=0)
+        # new version (June 2017) of sip_to_pv works on image header
+        # rather than header+image (see below); the header is modified in
+        # place; compared to the old version this saves an image write
+        result = sip_to_pv(header_wcs, tpv_format=True, preserve=False)
 
-    # read header saved in .wcs 
-    wcsfile = base+'.wcs'
-    header_wcs = read_hdulist (wcsfile, ext_header=0)
+        # update input header with [header_wcs]
+        header += header_wcs
 
-    # remove HISTORY, COMMENT and DATE fields from Astrometry.net header
-    # they are still present in the base+'.wcs' file
-    header_wcs.pop('HISTORY', None)
-    header_wcs.pop('COMMENT', None)
-    header_wcs.pop('DATE', None)
-    
-    # add specific keyword indicating index file of match
-    if data_match['HEALPIX'][0]!=-1:
-        anet_index = 'index-{}-{:02d}.fits'.format(data_match['INDEXID'][0], data_match['HEALPIX'][0])
-    else:
-        anet_index = 'index-{}.fits'.format(data_match['INDEXID'][0])
-    header_wcs['A-INDEX'] = (anet_index, 'name of index file WCS solution')
-    # and pixelscale
-    anet_pixscale = np.average(np.abs(data_match['CD'][0][1:3]))*3600.
-    header_wcs['A-PSCALE'] = (anet_pixscale, '[arcsec/pix] pixel scale WCS solution')
-
-    # convert SIP header keywords from Astrometry.net to PV keywords
-    # that swarp, scamp (and sextractor) understand using this module
-    # from David Shupe: sip_to_pv
-
-    # using the old version of sip_to_pv (before June 2017):
-    #status = sip_to_pv(image_out, image_out, log, tpv_format=True)
-    #if status == False:
-    #    log.error('sip_to_pv failed.')
-    #    return 'error'
-
-    # new version (June 2017) of sip_to_pv works on image header
-    # rather than header+image (see below); the header is modified in
-    # place; compared to the old version this saves an image write
-    result = sip_to_pv(header_wcs, tpv_format=True, preserve=False)
-
-    # update input header with [header_wcs]
-    header += header_wcs
 
     # use astropy.WCS to find RA, DEC corresponding to XWIN_IMAGE,
     # YWIN_IMAGE, based on WCS info saved by Astrometry.net in .wcs
@@ -4373,7 +6780,7 @@ def run_wcs(image_in, image_out, ra, dec, pixscale, width, height, header, log):
     # N.B.: WCS accepts header objects - gets rid of old warning about
     # axis mismatch, as .wcs files have NAXIS=0, while proper image
     # header files have NAXIS=2
-    wcs = WCS(header)
+    wcs = wcs_transform(header)
     newra, newdec = wcs.all_pix2world(data_sexcat['XWIN_IMAGE'],
                                       data_sexcat['YWIN_IMAGE'],
                                       1)
@@ -4396,30 +6803,18 @@ def run_wcs(image_in, image_out, ra, dec, pixscale, width, height, header, log):
         ra_center, dec_center = wcs.all_pix2world(xsize/2, ysize/2, 1)
         log.info('ra_center: {}, dec_center: {}'.format(ra_center, dec_center))
 
-        # determine cal_cat min and max declination zone of field
-        # to determine fits extensions (=zone+1) to read
+        # read the calibration stars in the field-of-view with
+        # function [read_cal_cat]; N.B.: this [data_cal] array is
+        # returned by this function [run_wcs] so that it can be
+        # re-used for the the photometric calibration in
+        # [prep_optimal_subtraction]
         fov_half_deg = np.amax([xsize, ysize]) * pixscale / 3600. / 2
-        ext_list = get_ext_list (dec_center, fov_half_deg, zone_size=60.)
-        print('dec_center: {}, ext_list: {}'.format(dec_center, ext_list))
-
-        t4 = time.time()
-        # read calibration catalog
-        data_cal = read_hdulist (C.cal_cat, ext_data=ext_list)
-
-        # use function [find_stars] to select stars in calibration
-        # catalog that are within the current field-of-view
-        mask_field = find_stars(data_cal['ra'], data_cal['dec'],
-                                ra_center, dec_center, fov_half_deg, log)
-        index_field = np.where(mask_field)[0]
-        # N.B.: this [data_cal] array is returned by this function
-        # [run_wcs] and also by [run_wcs] so that it can be re-used
-        # for the the photometric calibration in [prep_optimal_subtraction]
-        data_cal = data_cal[index_field]
+        data_cal = read_cal_cat (ra_center, dec_center, fov_half_deg, log)
         ra_ast = data_cal['ra']
         dec_ast = data_cal['dec']
         mag_ast = data_cal[C.ast_filter]
 
-        n_aststars = np.shape(index_field)[0]
+        n_aststars = np.shape(data_cal)[0]
         log.info('number of astrometric stars in FOV: {}'.format(n_aststars))
         
         # add header keyword(s):
@@ -4477,8 +6872,13 @@ def run_wcs(image_in, image_out, ra, dec, pixscale, width, height, header, log):
         log.info('Warning: calibration catalog {} not found!'.format(C.cal_cat))
         data_cal = None
         
-    # write image_out including header
-    fits.writeto(image_out, data, header=header, overwrite=True)
+    # write image_out including header, or only its header if
+    # [C.wcs_header_only] is True
+    if C.wcs_header_only:
+        write_header_file (header, image_out.replace('.fits','.head'))
+    else:
+        data = read_hdulist (image_in, ext_data=0)
+        fits.writeto(image_out, data, header=header, overwrite=True)
     
     if C.timing:
         log_timing_memory (t0=t3, label='calculate offset wrt external catalog', log=log)
@@ -4496,40 +6896,16 @@ def calc_offsets (ra_sex, dec_sex, ra_ast, dec_ast, log):
     if C.timing: t = time.time()
     log.info('Executing calc_offsets ...')
 
-    # number of astrometry comparison sources
-    n_ast = np.shape(ra_ast)[0]
-
-    # prepare output arrays
-    dra_array = np.zeros(n_ast)
-    ddec_array = np.zeros(n_ast)
-    
-    # loop astrometry stars and find a match in SExtractor sources
+    # find the SExtractor source matching each astrometry star using
+    # function [match_radec], which also provides the RA, DEC offsets
+    # including the sign; no match or multiple matches will return a
+    # zero offset for that star
     dist_max = 1./3600
-    for i in range(n_ast):
-        
-        # make a big cut in declination in the SExtractor arrays to
-        # speed up distance calculation below
-        mask_cut = (np.abs(dec_sex-dec_ast[i])<=dist_max)
-        ra_sex_temp = ra_sex[mask_cut]
-        dec_sex_temp = dec_sex[mask_cut]
-        
-        # calculate distances using function [haversine]
-        dist = haversine(ra_sex_temp, dec_sex_temp, ra_ast[i], dec_ast[i])
-        
-        # mask with match(es) between subset of ra_sex and dec_sex and
-        # the source in the astrometry catalog
-        mask_match = (dist <= dist_max)
-        
-        if np.sum(mask_match)==1:
-            # if there's one match, calculate the RA, DEC offsets;
-            # including the sign!
-            ddec_array[i] = dec_sex_temp[mask_match]-dec_ast[i]
-            # for RA, use the haversine function to get the right offset
-            dra_array[i] = haversine(ra_sex_temp[mask_match], dec_sex_temp[mask_match],
-                                     ra_ast[i], dec_sex_temp[mask_match])
-            # add the sign (haversine provides absolute distances):
-            if ra_sex_temp[mask_match] < ra_ast[i]:
-                dra_array[i] *= -1
+    index_match, dist, unique, dra_array, ddec_array = match_radec (ra_ast, dec_ast,
+                                                                    ra_sex, dec_sex,
+                                                                    dist_max)
+    dra_array[~unique] = 0.
+    ddec_array[~unique] = 0.
                         
     if C.timing:
         log_timing_memory (t0=t, label='calc_offsets', log=log)
@@ -4659,8 +7035,8 @@ def run_remap(image_new, image_ref, image_out, image_out_size,
     if C.timing: t = time.time()
     log.info('Executing run_remap ...')
 
-    header_new = read_hdulist (image_new, ext_header=0)
-    header_ref = read_hdulist (image_ref, ext_header=0)
+    header_new = read_wcs_image (image_new, read_data=False)
+    header_ref = read_wcs_image (image_ref, read_data=False)
     
     # create .head file with header info from [image_new]
     header_out = header_new[:]
@@ -4677,24 +7053,39 @@ def run_remap(image_new, image_ref, image_out, image_out_size,
     for key in ['WCSAXES', 'NAXIS1', 'NAXIS2']:
         if key in header_out: del header_out[key]
     # write to .head file
-    with open(image_out.replace('.fits','.head'),'w') as newrefhdr:
-        for card in header_out.cards:
-            newrefhdr.write(str(card)+'\n')
-
-    size_str = str(image_out_size[1]) + ',' + str(image_out_size[0]) 
-    cmd = ['swarp', image_ref, '-c', config, '-IMAGEOUT_NAME', image_out, 
-           '-IMAGE_SIZE', size_str, '-GAIN_DEFAULT', str(gain),
-           '-RESAMPLE', resample,
-           '-RESAMPLING_TYPE', resampling_type,
-           '-PROJECTION_ERR', str(projection_err),
-           '-NTHREADS', str(nthreads)]
-
-    # log cmd executed
-    cmd_str = ' '.join(cmd)
-    log.info('SWarp command executed:\n{}'.format(cmd_str))
-
-    process=subprocess.Popen(cmd,stdout=subprocess.PIPE,stderr=subprocess.PIPE)
-    (stdoutstr,stderrstr) = process.communicate()
+    write_header_file (header_out, image_out.replace('.fits','.head'))
+
+    # if [image_ref] was not written because only its header was
+    # saved (see [read_wcs_image]), run SWarp on the original image
+    # instead, with that header provided as a temporary .head file,
+    # which SWarp reads along with the image
+    head_ref = None
+    if not os.path.isfile(image_ref):
+        image_ref = image_ref.replace('_wcs.fits','.fits')
+        head_ref = image_ref.replace('.fits','.head')
+        write_header_file (header_ref, head_ref)
+
+    # make sure the temporary .head file is removed, also if an
+    # exception is raised, as it would otherwise be used in any
+    # later SWarp run on the original image
+    try:
+        size_str = str(image_out_size[1]) + ',' + str(image_out_size[0]) 
+        cmd = ['swarp', image_ref, '-c', config, '-IMAGEOUT_NAME', image_out, 
+               '-IMAGE_SIZE', size_str, '-GAIN_DEFAULT', str(gain),
+               '-RESAMPLE', resample,
+               '-RESAMPLING_TYPE', resampling_type,
+               '-PROJECTION_ERR', str(projection_err),
+               '-NTHREADS', str(nthreads)]
+
+        # log cmd executed
+        cmd_str = ' '.join(cmd)
+        log.info('SWarp command executed:\n{}'.format(cmd_str))
+
+        process=subprocess.Popen(cmd,stdout=subprocess.PIPE,stderr=subprocess.PIPE)
+        (stdoutstr,stderrstr) = process.communicate()
+    finally:
+        if head_ref is not None and os.path.isfile(head_ref):
+            os.remove(head_ref)
     status = process.returncode
     log.info(stdoutstr)
     log.info(stderrstr)
@@ -4830,8 +7221,11 @@ def get_fwhm (cat_ldac, fraction, log, class_sort=False, get_elongation=False):
 
 ################################################################################
 
-def update_vignet_size (sex_par_in, sex_par_out, imtype, log):
+def get_vignet_size (imtype, log):
 
+    """Function that returns the size of the square VIGNETs of the
+    sources in image type [imtype] ('new' or 'ref')."""
+    
     if imtype=="ref":
         # set vignet size to the value defined in [C.size_vignet_ref]
         size_vignet = C.size_vignet_ref
@@ -4855,6 +7249,15 @@ def update_vignet_size (sex_par_in, sex_par_out, imtype, log):
             # otherwise set it to the value defined for the ref image
             size_vignet = C.size_vignet_ref
 
+    return size_vignet
+
+
+################################################################################
+
+def update_vignet_size (sex_par_in, sex_par_out, imtype, log):
+
+    size_vignet = get_vignet_size (imtype, log)
+
     # append the VIGNET size to the SExtractor parameter file
     # [sex_par_in] and write it to a temporary file [sex_par_out] to
     # be used by SExtractor
@@ -4888,12 +7291,16 @@ def run_sextractor(image, cat_out, file_config, file_params, pixscale, log, head
        will be run on a fraction [fraction] of the area of the full
        image. Sextractor will use the input value [fwhm], which is
        important for the star-galaxy classification. If [save-bkg] is
-       True, the background image, its standard deviation and the
-       -OBJECTS image (background-subtracted image with all objects
-       masked with zero values), all produced by SExtractor, will be
-       saved. If [C.bkg_method] is not set to 1 (use SExtractor's
-       background), then improve the estimates of the background and
-       its standard deviation."""
+       True and [C.bkg_method] is set to 1 (use SExtractor's
+       background), the background image and its standard deviation
+       produced by SExtractor will be saved. If [C.bkg_method] is not
+       set to 1, the -OBJECTS image (background-subtracted image with
+       all objects masked with zero values) is saved instead and used
+       to improve the estimates of the background and its standard
+       deviation; for [C.bkg_method]=2 only the filtered background
+       meshes are saved (see [read_bkg_model]). If in addition
+       [C.bkg_objmask_inproc] is True, the object mask is created with
+       [get_objmask] and SExtractor does not save any check-images."""
 
     if C.timing: t = time.time()
     log.info('Executing run_sextractor ...')
@@ -4937,10 +7344,15 @@ def run_sextractor(image, cat_out, file_config, file_params, pixscale, log, head
     apphot_diams = np.array(C.apphot_radii) * 2 * fwhm
     apphot_diams_str = ",".join(apphot_diams.astype(str))
 
-    # update size of VIGNET
+    # update size of VIGNET; if [C.psf_vignet_inproc] is True,
+    # SExtractor does not save the VIGNETs, which are only cut out for
+    # the PSF stars by [make_psfex_ldac], so only their size is needed
     if update_vignet:
-        size_vignet = update_vignet_size (file_params, file_params+'_temp', imtype, log)
-        file_params = file_params+'_temp'
+        if C.psf_vignet_inproc:
+            size_vignet = get_vignet_size (imtype, log)
+        else:
+            size_vignet = update_vignet_size (file_params, file_params+'_temp', imtype, log)
+            file_params = file_params+'_temp'
         # write vignet_size to header
         header['S-VIGNET'] = (size_vignet, '[pix] size square VIGNET used in SExtractor')
         
@@ -4975,16 +7387,24 @@ def run_sextractor(image, cat_out, file_config, file_params, pixscale, log, head
            '-BACK_SIZE', str(C.bkg_boxsize), '-BACK_FILTERSIZE', str(C.bkg_filtersize),
            '-NTHREADS', str(nthreads)]
 
-    # add commands to produce BACKGROUND, BACKGROUND_RMS and
-    # background-subtracted image with all pixels where objects were
-    # detected set to zero (-OBJECTS). These are used to build an
-    # improved background map. 
+    # add commands to produce BACKGROUND and BACKGROUND_RMS if
+    # SExtractor's background is used ([C.bkg_method]=1), otherwise
+    # only the background-subtracted image with all pixels where
+    # objects were detected set to zero (-OBJECTS) is needed to build
+    # an improved background map.
     if save_bkg:
         fits_bkg = base+'_bkg.fits'
         fits_bkg_std = base+'_bkg_std.fits'
         fits_objmask = base+'_objmask.fits'
-        cmd += ['-CHECKIMAGE_TYPE', 'BACKGROUND,BACKGROUND_RMS,-OBJECTS',
-                '-CHECKIMAGE_NAME', fits_bkg+','+fits_bkg_std+','+fits_objmask]
+        if C.bkg_method == 1:
+            cmd += ['-CHECKIMAGE_TYPE', 'BACKGROUND,BACKGROUND_RMS',
+                    '-CHECKIMAGE_NAME', fits_bkg+','+fits_bkg_std]
+        elif C.bkg_method == 3 or not C.bkg_objmask_inproc:
+            cmd += ['-CHECKIMAGE_TYPE', '-OBJECTS',
+                    '-CHECKIMAGE_NAME', fits_objmask]
+        # if [C.bkg_objmask_inproc] is True, no check-images are
+        # needed for [C.bkg_method]=2; the object mask is then
+        # created by [get_objmask] below
     
     # in case of fraction being less than 1: only care about higher S/N detections
     if fraction < 1.: cmd += ['-DETECT_THRESH', str(C.fwhm_detect_thresh)]
@@ -5015,14 +7435,18 @@ def run_sextractor(image, cat_out, file_config, file_params, pixscale, log, head
     # background determined by SExtractor)
     if save_bkg and C.bkg_method != 1:
 
-        # read in SExtractor's object mask created above
-        data_objmask = read_hdulist (fits_objmask, ext_data=0)
-        objmask = (data_objmask==0)
-        del data_objmask
-       
         # read in input image
         data = read_hdulist (image, ext_data=0, dtype='float32')
 
+        if C.bkg_method == 2 and C.bkg_objmask_inproc:
+            # create object mask in-process
+            objmask = get_objmask (data, fwhm, log)
+        else:
+            # read in SExtractor's object mask created above
+            data_objmask = read_hdulist (fits_objmask, ext_data=0)
+            objmask = (data_objmask==0)
+            del data_objmask
+
         # construct background image using [get_back]; in the case of
         # the reference image these data need to refer to the image
         # before remapping
@@ -5036,13 +7460,11 @@ def run_sextractor(image, cat_out, file_config, file_params, pixscale, log, head
             fits.setval(base+'_bkg_mesh.fits', 'BKG_SIZE', value=C.bkg_boxsize)
             fits.setval(base+'_bkg_std_mesh.fits', 'BKG_SIZE', value=C.bkg_boxsize)
 
-            # now use function [mesh2back] to turn filtered mesh of median
-            # and std of backgroun regions into full background image and
-            # its standard deviation
-            data_bkg = mesh2back (data_bkg_mesh, data.shape, log,
-                                  order_interp=2, bkg_boxsize=C.bkg_boxsize)
-            data_bkg_std = mesh2back (data_bkg_std_mesh, data.shape, log,
-                                      order_interp=1, bkg_boxsize=C.bkg_boxsize)
+            # the full background image and its standard deviation
+            # are no longer created here; instead the filtered meshes
+            # are read into a [BackgroundModel] (see [read_bkg_model])
+            # that only evaluates the background for the subimages or
+            # pixels that are needed
 
 
         # similar as above, but now photutils' Background2D is used
@@ -5056,11 +7478,9 @@ def run_sextractor(image, cat_out, file_config, file_params, pixscale, log, head
             data_bkg, data_bkg_std = get_back(data, objmask, log,
                                               use_photutils=True)
 
-
-        # write the improved background and standard deviation to fits
-        # overwriting the fits images produced by SExtractor
-        fits.writeto(fits_bkg, data_bkg, overwrite=True)
-        fits.writeto(fits_bkg_std, data_bkg_std, overwrite=True)
+            # write the improved background and standard deviation to fits
+            fits.writeto(fits_bkg, data_bkg, overwrite=True)
+            fits.writeto(fits_bkg_std, data_bkg_std, overwrite=True)
 
 
                 
@@ -5116,7 +7536,11 @@ def run_psfex(cat_in, file_config, cat_out, imtype, log):
     # sufficient large compared to [psf_samp] and [psf_size_config].
     
     # run psfex from the unix command line
+    # N.B.: the output catalog [cat_out] is saved in FITS_LDAC
+    # format, which is much faster to read than the ASCII_HEAD format
+    # defined in the configuration file (see [read_psfex_cat])
     cmd = ['psfex', cat_in, '-c', file_config,'-OUTCAT_NAME', cat_out,
+           '-OUTCAT_TYPE', 'FITS_LDAC',
            '-PSF_SIZE', psf_size_config_str, '-PSF_SAMPLING', str(psf_samp),
            '-SAMPLE_MINSN', str(C.psf_stars_s2n_min),
            '-NTHREADS', str(nthreads)]
@@ -5277,8 +7701,10 @@ def zogy_subloop (nsub, data_ref, data_new,
         
     N = data_new[nsub]
     R = data_ref[nsub]
-    Pn = psf_new[nsub]
-    Pr = psf_ref[nsub]
+    # pad the PSFs to the subimage size and shift their centers to
+    # pixel [0,0]
+    Pn = center_psf (psf_new[nsub], N.shape)
+    Pr = center_psf (psf_ref[nsub], R.shape)
             
     # before running zogy, pixels with zero values in ref need to
     # be set to zero in new as well, and vice versa, to avoid
@@ -5307,7 +7733,9 @@ def zogy_subloop (nsub, data_ref, data_new,
         log.info('dx: {}, dy: {}'.format(dx, dy))
         log.info('sn: {}, sr: {}'.format(sn, sr))
 
-    return run_ZOGY(R,N,Pr,Pn,sr,sn,fr,fn,Vr,Vn,dx,dy, log=log)
+    D, S, Scorr, Fpsf, Fpsferr = run_ZOGY(R,N,Pr,Pn,sr,sn,fr,fn,Vr,Vn,dx,dy, log=log)
+
+    return D, S, Scorr, Fpsf, Fpsferr
 
 
 ################################################################################
@@ -5676,6 +8104,123 @@ def image_shift_fft(Image, DX, DY):
 # end
 # ShiftedImage = abs(ShiftedImage);
 
+################################################################################
+
+def forced_phot (base, ra, dec, log, get_s2n=True):
+
+    """Function that performs forced photometry on the output images of
+    [optimal_subtraction] with base name [base], i.e. [base]_Fpsf.fits
+    and [base]_Fpsferr.fits (and [base]_Scorr.fits if [get_s2n] is
+    True), at the positions [ra],[dec] (arrays in degrees). The
+    pixel coordinates are determined with a single call to the WCS
+    of the Fpsf image, and the images are memory-mapped so that only
+    the parts of the images containing the positions are read. The
+    function returns the pixel coordinates, the PSF flux and its
+    error in electrons (zero for positions off the image) and, if
+    [get_s2n] is True, the signal-to-noise ratio from Scorr.
+
+    """
+
+    if C.timing: t = time.time()
+    log.info('Executing forced_phot ...')
+
+    ra = np.atleast_1d(ra)
+    dec = np.atleast_1d(dec)
+    
+    # convert RA, DEC to pixel coordinates
+    header = read_hdulist (base+'_Fpsf.fits', ext_header=0)
+    wcs = wcs_transform(header)
+    x, y = wcs.all_world2pix(ra, dec, 1)
+    
+    # pixel indices of positions on the image
+    ysize, xsize = header['NAXIS2'], header['NAXIS1']
+    x_index = np.round(x).astype(int) - 1
+    y_index = np.round(y).astype(int) - 1
+    mask_on = ((x_index >= 0) & (x_index < xsize) & (y_index >= 0) & (y_index < ysize))
+    if np.sum(~mask_on) > 0:
+        log.info('Warning: {} positions are off the image'.format(np.sum(~mask_on)))
+        
+    # sort the pixel indices so that the memory-mapped images are
+    # read sequentially
+    index_sort = np.lexsort((x_index[mask_on], y_index[mask_on]))
+    index_on = np.nonzero(mask_on)[0][index_sort]
+    
+    def read_pixels (fits_image):
+        values = np.zeros(len(ra), dtype='float32')
+        with fits.open(fits_image, memmap=True) as hdulist:
+            values[index_on] = hdulist[0].data[y_index[index_on], x_index[index_on]]
+        return values
+    
+    flux = read_pixels (base+'_Fpsf.fits')
+    fluxerr = read_pixels (base+'_Fpsferr.fits')
+    if get_s2n:
+        s2n = read_pixels (base+'_Scorr.fits')
+        
+    if C.timing:
+        log_timing_memory (t0=t, label='forced_phot', log=log)
+
+    if get_s2n:
+        return x, y, flux, fluxerr, s2n
+    else:
+        return x, y, flux, fluxerr
+    
+
+################################################################################
+
+def run_forced_phot (new_fits, radec_file, telescope=None, log=None):
+
+    """Function that reads the coordinates from [radec_file] (an ascii
+    or fits table, with columns RA and DEC in degrees or otherwise the
+    first two columns), performs forced photometry on the output of
+    [optimal_subtraction] for the new image [new_fits] using
+    [forced_phot] and writes the result to the fits table
+    [new_fits]_forced.fits. If the zeropoint of the new image is
+    available in its header, the magnitudes are also determined."""
+
+    global C
+    settings_module = 'Settings.Constants'
+    if telescope is not None:
+        settings_module += '_'+telescope
+    C = importlib.import_module(settings_module)
+
+    if log is None:
+        log = logging.getLogger()
+        log.setLevel(logging.INFO)
+        log.addHandler(logging.StreamHandler())
+
+    # read coordinates
+    if radec_file.endswith('.fits'):
+        table = Table.read(radec_file)
+    else:
+        table = Table.read(radec_file, format='ascii')
+    if 'RA' in table.colnames and 'DEC' in table.colnames:
+        ra, dec = table['RA'], table['DEC']
+    else:
+        ra, dec = table.columns[0], table.columns[1]
+    ra = np.array(ra, dtype=float)
+    dec = np.array(dec, dtype=float)
+
+    base = new_fits.replace('.fits','')
+    x, y, flux, fluxerr, s2n = forced_phot (base, ra, dec, log)
+        
+    table_out = Table([ra, dec, x, y, flux, fluxerr, s2n],
+                      names=('RA','DEC','X_POS','Y_POS','FLUX_PSF','FLUXERR_PSF','S2N'))
+
+    # add magnitudes if zeropoint is available
+    header = read_hdulist (base+'_Fpsf.fits', ext_header=0)
+    if 'PC-ZP' in header and 'PC-AIRM' in header:
+        keywords = ['exptime', 'filter']
+        exptime, filt = read_header(header, keywords, log)
+        mag, magerr = apply_zp(flux, header['PC-ZP'], header['PC-AIRM'], exptime, filt,
+                               log, fluxerr=fluxerr)
+        table_out['MAG_PSF'] = mag
+        table_out['MAGERR_PSF'] = magerr
+
+    table_out.write(base+'_forced.fits', overwrite=True)
+    log.info('forced photometry of {} positions written to {}'
+             .format(len(ra), base+'_forced.fits'))
+
+    
 ################################################################################
 
 def main():
@@ -5690,6 +8235,12 @@ def main():
     parser.add_argument('--log', default=None, help='help')
     parser.add_argument('--verbose', default=None, help='verbose')
     parser.add_argument('--nthreads', default=1, type=int, help='number of threads to use')
+    parser.add_argument('--radec_file', default=None, help='ascii or fits table with '
+                        'RA and DEC (deg) at which to perform forced photometry on the existing '
+                        'output of [new_fits] instead of running optimal_subtraction')
+    parser.add_argument('--make_cal_store', action='store_true', help='convert the '
+                        'calibration catalog [cal_cat] of the [telescope] settings to the '
+                        'store [cal_cat_store] instead of running optimal_subtraction')
     
     #global_pars(args.telescope)
     # replaced [global_pars] function with importing
@@ -5697,6 +8248,20 @@ def main():
     # parameters are now referred to as C.[parameter name]
     args = parser.parse_args()
 
+    if args.radec_file is not None:
+        run_forced_phot(args.new_fits, args.radec_file, telescope=args.telescope)
+        return
+
+    if args.make_cal_store:
+        settings_module = 'Settings.Constants'
+        if args.telescope is not None:
+            settings_module += '_'+args.telescope
+        C_cal = importlib.import_module(settings_module)
+        log = logging.getLogger()
+        log.setLevel(logging.INFO)
+        log.addHandler(logging.StreamHandler())
+        make_cal_store(C_cal.cal_cat, C_cal.cal_cat_store, log=log)
+        return
 
     optimal_subtraction(args.new_fits, args.ref_fits, args.new_fits_mask, args.ref_fits_mask,
                         args.telescope, args.log, args.verbose, args.nthreads)